@@ -0,0 +1,96 @@
+""" Coverage benchmark for the ReachSample sampling modes. For every workspace type and trial count, schedules are drawn
+    with the random sampler and with the scrambled quasi-random modes ('halton', and 'sobol' when scipy is installed),
+    over a number of seeds, and two measures are recorded (mean over the seeds):
+
+    discrepancy: the centered L2 discrepancy of the unit-cube points the sampler maps to positions, one point of
+        as many dimensions as the sampler draws per trial. Lower is more even.
+    coverage: the fraction of the reachable voxels (those reached by a large random reference schedule) that the
+        schedule visits, with voxels of side --voxel-size cm.
+
+    Results are printed as a table and optionally written as JSON.
+
+    Usage:
+        python benchmarks/coverage_benchmark.py --n-trials 16 64 256 1024 --seeds 5 --output coverage.json
+"""
+import argparse
+import json
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import numpy as np  # noqa: E402
+import utils.command_utils as c_d  # noqa: E402
+import utils.qmc_utils as qu  # noqa: E402
+import utils.spatial_utils as sp  # noqa: E402
+
+DEFAULT_N_TRIALS = (16, 64, 256, 1024, 4096)
+N_POSITIONS = 9
+REFERENCE_TRIALS = 100000
+WORKSPACES = {'theta': {'length': 0.4, 'radius': 2, 'sample': True},
+              'phi': {'length': 0.4, 'radius': 2, 'sample': True},
+              '2d': {'y_length': 0.4, 'z_length': 1, 'radius': 2, 'sample': True},
+              '3d': {'stride': 0.5, 'y_length': 0.4, 'z_length': 1, 'radius': 2, 'sample': True}}
+
+
+def available_modes():
+    """ The sampling modes that can run here: Sobol needs scipy. """
+    try:
+        import scipy.stats  # noqa: F401
+    except ImportError:
+        return ['random', 'halton']
+    return list(qu.SAMPLING_MODES)
+
+
+def reachable_voxels(kind, params, voxel_size):
+    """ Returns the voxel bounds and the occupied-voxel mask of a large random reference schedule. """
+    points = c_d.sample_workspace(kind, REFERENCE_TRIALS, N_POSITIONS, rng=0, **params).reshape(-1, 3)
+    bounds = np.column_stack((points.min(axis=0), points.max(axis=0)))
+    return bounds, sp.voxel_coverage(points, voxel_size, bounds)['counts'] > 0
+
+
+def run_benchmarks(n_trials_list, modes, seeds, voxel_size, kinds=None):
+    """ Returns one result per workspace type, sampling mode and trial count. """
+    results = []
+    for kind in kinds or WORKSPACES:
+        params = WORKSPACES[kind]
+        n_dims = qu.count_dimensions(lambda counter: c_d.sample_workspace(kind, 1, N_POSITIONS, rng=counter,
+                                                                           **params))
+        bounds, reachable = reachable_voxels(kind, params, voxel_size)
+        for mode in modes:
+            for n_trials in n_trials_list:
+                discrepancy, coverage = [], []
+                for seed in range(seeds):
+                    rng = np.random.default_rng(seed)
+                    discrepancy.append(qu.centered_discrepancy(qu.unit_draws(rng, n_trials, n_dims, mode)))
+                    commands = c_d.sample_workspace(kind, n_trials, N_POSITIONS, rng=seed, sampling=mode, **params)
+                    visited = sp.voxel_coverage(commands, voxel_size, bounds)['counts'] > 0
+                    coverage.append(float(np.count_nonzero(visited & reachable)) / np.count_nonzero(reachable))
+                results.append({'kind': kind, 'sampling': mode, 'n_trials': n_trials, 'n_dims': n_dims,
+                                'discrepancy': float(np.mean(discrepancy)), 'coverage': float(np.mean(coverage))})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-trials', type=int, nargs='+', default=list(DEFAULT_N_TRIALS))
+    parser.add_argument('--kinds', nargs='+', choices=list(WORKSPACES), default=None)
+    parser.add_argument('--modes', nargs='+', choices=qu.SAMPLING_MODES, default=None,
+                        help='Sampling modes to compare (default: every mode available here).')
+    parser.add_argument('--seeds', type=int, default=5, help='Seeds averaged per case.')
+    parser.add_argument('--voxel-size', type=float, default=0.02)
+    parser.add_argument('--output', default=None, help='Write the results as JSON to this file.')
+    args = parser.parse_args(argv)
+    results = run_benchmarks(args.n_trials, args.modes or available_modes(), args.seeds, args.voxel_size, args.kinds)
+    print('%-6s %-7s %8s %6s %12s %9s' % ('kind', 'mode', 'n_trials', 'n_dims', 'discrepancy', 'coverage'))
+    for result in results:
+        print('%(kind)-6s %(sampling)-7s %(n_trials)8d %(n_dims)6d %(discrepancy)12.4f %(coverage)9.3f' % result)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
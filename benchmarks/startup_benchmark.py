@@ -0,0 +1,60 @@
+""" Startup benchmark for ReachSample. Measures, in fresh interpreters, the time taken to import reach_sample and
+    construct a ReachSample, and checks that no plotting or pandas modules are loaded on that path. Exits with a
+    non-zero status when the median startup time exceeds the import-time budget documented in the README.
+
+    Usage: python benchmarks/startup_benchmark.py [--repeats 7] [--budget-ms 300]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+STARTUP_BUDGET_MS = 300.
+DEFERRED_MODULES = ('pandas', 'matplotlib', 'matplotlib.animation', 'pdb')
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_STARTUP_SNIPPET = """
+import json, sys, time
+start = time.perf_counter()
+import reach_sample
+reach_sample.ReachSample()
+elapsed_ms = (time.perf_counter() - start) * 1000.
+print(json.dumps({'elapsed_ms': elapsed_ms, 'loaded': [m for m in %r if m in sys.modules]}))
+""" % (DEFERRED_MODULES,)
+
+
+def measure_startup(repeats=7):
+    """ Runs the startup snippet in repeats fresh interpreters, returning the per-run times (ms) and any deferred
+        modules that were imported. """
+    times, loaded = [], set()
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', _STARTUP_SNIPPET], cwd=REPO_ROOT, check=True,
+                                capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        times.append(result['elapsed_ms'])
+        loaded.update(result['loaded'])
+    return times, sorted(loaded)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=7)
+    parser.add_argument('--budget-ms', type=float, default=STARTUP_BUDGET_MS)
+    args = parser.parse_args(argv)
+    times, loaded = measure_startup(args.repeats)
+    median_ms = statistics.median(times)
+    print(json.dumps({'median_ms': round(median_ms, 1), 'min_ms': round(min(times), 1),
+                      'budget_ms': args.budget_ms, 'deferred_modules_loaded': loaded}, indent=2))
+    if loaded:
+        print('Startup imported deferred modules: ' + ', '.join(loaded))
+        return 1
+    if median_ms > args.budget_ms:
+        print('Startup time %.1f ms exceeds the %.1f ms budget.' % (median_ms, args.budget_ms))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+""" Benchmark and memory-profiling suite for ReachSample. Every workspace type, the command file reader, the export
+    path and the spatial coverage functions (nearest-neighbour distances and coverage reports, up to
+    SPATIAL_MAX_TRIALS trials, about 1e6 positions) are run over a sweep of trial counts, recording the best wall time
+    over a number of repeats and the peak traced memory (tracemalloc, measured in a separate run so tracing does not
+    inflate the timings). Results are written as a JSON baseline; --compare checks a new run against a baseline and
+    exits with a non-zero status when any case regresses by more than --threshold.
+
+    Usage:
+        python benchmarks/workspace_benchmark.py --output baseline.json
+        python benchmarks/workspace_benchmark.py --n-trials 100 10000 --compare baseline.json --threshold 0.25
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import numpy as np  # noqa: E402
+import utils.command_utils as c_d  # noqa: E402
+import utils.export_utils as ex  # noqa: E402
+import utils.spatial_utils as sp  # noqa: E402
+from reach_sample import ReachSample  # noqa: E402
+
+DEFAULT_N_TRIALS = (100, 1000, 10000, 100000, 1000000)
+N_POSITIONS = 9
+SPATIAL_MAX_TRIALS = 100000  # the spatial cases run up to about 1e6 positions
+
+
+def _workspace_cases(n_trials, work_dir):
+    """ Returns the benchmark cases for one trial count as name -> (setup, run) pairs. setup runs untimed and returns
+        the argument passed to run. """
+    sampler = ReachSample(seed=0)
+    commands = c_d.batch_3d_commands(0.5, 0.4, 1, 2, n_trials, N_POSITIONS, sample=True, rng=0)
+    command_file = os.path.join(work_dir, 'commands_%d.csv' % n_trials)
+    export_file = os.path.join(work_dir, 'export.csv')
+
+    def no_setup():
+        return None
+
+    def write_command_file():
+        if not os.path.exists(command_file):
+            ex.export_commands(commands, command_file)
+        return command_file
+
+    def export_setup():
+        return export_file
+
+    def theta(_):
+        sampler.create_theta_workspace(0.4, 2, n_trials, N_POSITIONS, sample=True)
+
+    def phi(_):
+        sampler.create_phi_workspace(0.4, 2, n_trials, N_POSITIONS, sample=True)
+
+    def workspace_2d(_):
+        sampler.create_2d_workspace(1, 1, 2, n_trials, N_POSITIONS, sample=True)
+
+    def workspace_3d(_):
+        sampler.create_3d_workspace(0.5, 0.4, 1, 2, n_trials, N_POSITIONS, sample=True)
+
+    def read(filename):
+        c_d.read_command_file(filename, cache=False)
+
+    def read_cached(filename):
+        c_d.read_command_file(filename)
+
+    def export_csv(filename):
+        ex.export_commands(commands, filename)
+
+    def export_npy(filename):
+        ex.export_commands(commands, filename, formats=('npy',))
+
+    def nearest_neighbors(_):
+        sp.nearest_neighbor_distances(commands.reshape(-1, 3))
+
+    def coverage(_):
+        sp.coverage_report(commands, voxel_size=0.02)
+
+    cases = {'create_theta_workspace': (no_setup, theta), 'create_phi_workspace': (no_setup, phi),
+             'create_2d_workspace': (no_setup, workspace_2d), 'create_3d_workspace': (no_setup, workspace_3d),
+             'read_command_file': (write_command_file, read), 'read_command_file_cached': (write_command_file,
+                                                                                           read_cached),
+             'export_csv': (export_setup, export_csv), 'export_npy': (export_setup, export_npy)}
+    if n_trials <= SPATIAL_MAX_TRIALS:
+        cases.update({'nearest_neighbor_distances': (no_setup, nearest_neighbors),
+                      'coverage_report': (no_setup, coverage)})
+    return cases
+
+
+def measure(setup, run, repeats):
+    """ Returns the best wall time in seconds over repeats and the peak traced memory in bytes of one further run. """
+    argument = setup()
+    run(argument)  # warm caches (e.g. the command file cache) before timing
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run(argument)
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        run(argument)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(seconds), 'peak_bytes': peak}
+
+
+def run_benchmarks(n_trials_sweep=DEFAULT_N_TRIALS, cases=None, repeats=3):
+    """ Runs the selected cases (default: all) for every trial count. Returns the JSON-serializable results. """
+    results = {}
+    work_dir = tempfile.mkdtemp(prefix='reach_sample_benchmark_')
+    try:
+        for n_trials in n_trials_sweep:
+            for name, (setup, run) in _workspace_cases(n_trials, work_dir).items():
+                if cases and name not in cases:
+                    continue
+                results.setdefault(name, {})[str(n_trials)] = measure(setup, run, repeats)
+                print('%-26s n_trials=%-8d %10.4f s %12d bytes' % (name, n_trials,
+                                                                   results[name][str(n_trials)]['seconds'],
+                                                                   results[name][str(n_trials)]['peak_bytes']))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                     'repeats': repeats, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'results': results}
+
+
+def compare(baseline, current, threshold=0.25):
+    """ Returns a list of regressions, each a dict naming the case, trial count, metric and both values, for every
+        metric of current that exceeds the baseline value by more than threshold (a fraction). """
+    regressions = []
+    for name, sweep in current['results'].items():
+        for n_trials, metrics in sweep.items():
+            previous = baseline['results'].get(name, {}).get(n_trials)
+            if previous is None:
+                continue
+            for metric in ('seconds', 'peak_bytes'):
+                if metrics[metric] > previous[metric] * (1. + threshold):
+                    regressions.append({'case': name, 'n_trials': int(n_trials), 'metric': metric,
+                                        'baseline': previous[metric], 'current': metrics[metric],
+                                        'ratio': metrics[metric] / previous[metric] if previous[metric] else None})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-trials', type=int, nargs='+', default=list(DEFAULT_N_TRIALS))
+    parser.add_argument('--cases', nargs='+', default=None, help='Subset of cases to run (default: all).')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', default=None, help='Write the results as JSON to this file.')
+    parser.add_argument('--compare', default=None, help='Baseline JSON to compare against.')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Allowed fractional slowdown or memory growth.')
+    args = parser.parse_args(argv)
+    current = run_benchmarks(args.n_trials, args.cases, args.repeats)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(current, output_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(json.load(baseline_file), current, args.threshold)
+        for regression in regressions:
+            print('REGRESSION %(case)s n_trials=%(n_trials)d %(metric)s: %(baseline)s -> %(current)s' % regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
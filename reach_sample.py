@@ -1,17 +1,23 @@
 """ Program intended to easily collect, visualize, and describe robot command structures using statistics. Robot commands
     are meant to be used within the robot workspace created by the ReachMaster software. """
-import pdb
-
 import numpy as np
+import utils.block_utils as bu
+import utils.checkpoint_utils as ck
 import utils.command_utils as c_d
-import pandas as pd
+import utils.export_utils as ex
+import utils.instrument_utils as iu
+import utils.parallel_utils as pu
+import utils.plan_utils as pl
+import utils.server_utils as su
+import utils.spatial_utils as sp
+import utils.stats_utils as st
 
 
 def create_robot_command(idi, file=None):
     """ Function to in-take the calculated x,y,z command positions within the reaching workspace and
         transform them into commands in the spherical robot workspace. The output of this function may be saved as a
         pandas DataFrame using the savefile option."""
-
+    import pandas as pd
     csv_ob = pd.DataFrame(idi, columns=['r', 'thetay', 'thetaz'])
     if file:
         csv_ob.to_csv(file)
@@ -19,12 +25,37 @@ def create_robot_command(idi, file=None):
         csv_ob.to_csv('new_export_commands.csv')
 
 
+WORKSPACE_ATTRIBUTES = {'theta': 'theta_commands', 'phi': 'phi_commands', '2d': 'commands_2d', '3d': 'commands_3d'}
+
+
 class ReachSample:
-    def __init__(self):
-        self.robot_euclidean_commands = []
-        self.sampled_robot_commands, self.theta_commands, self.phi_commands, self.commands_2d = 0, [], [], []
-        self.commands_3d = []
-        self.initial_commands = c_d.initialize_commands_pilot()
+    def __init__(self, seed=None, headless=False, instrumentation=None, dtype=np.float64, render='points'):
+        if render not in c_d.RENDER_MODES:
+            raise ValueError('Unknown render mode ' + str(render) + ', expected one of ' + str(c_d.RENDER_MODES))
+        self.headless = headless
+        self.render = render  # 'points', or 'voxels' / 'projections' density renderings for large workspaces
+        self.dtype = np.dtype(dtype)
+        self.instrumentation = iu.get_instrumentation(instrumentation)
+        if isinstance(seed, np.random.Generator):
+            self.seed_sequence, self.rng = seed.bit_generator.seed_seq, seed
+        else:
+            self.seed_sequence = pu.root_seed_sequence(seed)
+            self.rng = c_d.get_rng(self.seed_sequence)
+        # Workspaces are utils.block_utils.CommandBlocks (float32 when dtype=np.float32), None until generated.
+        self.sampled_robot_commands, self.theta_commands, self.phi_commands, self.commands_2d = None, None, None, None
+        self.commands_3d = None
+        self._initial_commands = None
+
+    @property
+    def initial_commands(self):
+        """ Pilot experiment command positions, loaded from the data directory on first access. """
+        if self._initial_commands is None:
+            self._initial_commands = c_d.initialize_commands_pilot()
+        return self._initial_commands
+
+    @initial_commands.setter
+    def initial_commands(self, commands):
+        self._initial_commands = commands
 
     def create_new_commands(self, n_positions, n_trials, x_length, y_length, z_length, command_type='1D'):
         """ Method to create and export new commands from supported command types.
@@ -34,93 +65,315 @@ class ReachSample:
            :param y_length: Length sample in y_direction, float
            :param z_length: Length sample in z_direction, float
            :param command_type: Type of command, string
-           :return: Returns vector containing new commands.
+           :return: Returns an empty CommandBlock of size n_trials, n_positions, 3 for the new commands.
         """
-        self.sampled_robot_commands = np.empty((3, n_positions, n_trials))
+        self.sampled_robot_commands = self._block(np.empty((n_trials, n_positions, 3), dtype=self.dtype),
+                                                  command_type)
         return self.sampled_robot_commands
 
+    def _block(self, commands, kind, seed=None):
+        """ Wraps generated commands as a CommandBlock of the instance dtype, tagged with kind and the seed that
+            regenerates them (None when no single seed does). Samplers draw in float64, so a float32 instance halves
+            the memory of the stored block, not the peak memory of generating it. """
+        return bu.as_block(commands, kind=kind, dtype=self.dtype, seed=seed)
+
     def visualize_pilot_workspace(self, create_gif=False):
         """ Visualization function for pilot commands in the ReachMaster system. """
-        c_d.create_pilot_visualizations(self.initial_commands, make_gif_animation=create_gif)
+        c_d.create_pilot_visualizations(self.initial_commands, make_gif_animation=create_gif,
+                                        headless=self.headless)
 
     def create_theta_workspace(self, y_limit, radius, n_trials, n_positions, sample=False, visualize=False,
                                export=False,
-                               animate=False, animate_filename=False, export_filename=False):
+                               animate=False, animate_filename=False, export_filename=False,
+                               export_formats=('csv',), min_separation=None, sampling='random'):
         """ Method to create a 1-D theta (y-plane) task workspace. This method relies on functions from
             utils directory to create, visualize, generalize with statistics, and export command files for
-            a theta robot command position workspace. """
-        self.theta_commands = c_d.sample_theta_commands(y_limit, radius, n_trials, n_positions, extrema=sample)
-        if visualize:
-            c_d.visualize_commands(self.theta_commands, sample=sample, animate=animate,
-                                   animate_filename=animate_filename)
-            c_d.histogram_command_files(self.theta_commands, density=False,
-                                        save_file='visualizations/histogram_theta.png')
-        if export:
-            for il in range(n_trials):
-                for ij in range(0, self.theta_commands[0].shape[0]):
-                    self.robot_euclidean_commands.append(c_d.xform_coords_spherical(self.theta_commands[il, ij, 0],
-                                                                                    self.theta_commands[il, ij, 1],
-                                                                                    self.theta_commands[il, ij, 2]))
-            create_robot_command(self.robot_euclidean_commands, file=export_filename)
-            self.robot_euclidean_commands = []  # Clear memory
+            a theta robot command position workspace. Positions are drawn at random, or from a scrambled
+            'halton' or 'sobol' sequence (see utils.qmc_utils) for more even coverage with fewer trials. """
+        instrument = self.instrumentation
+        with instrument.span('create_theta_workspace', n_trials=n_trials, n_positions=n_positions):
+            with instrument.span('sample'):
+                seed = self.seed_sequence.spawn(1)[0]
+                commands = c_d.sample_workspace('theta', n_trials, n_positions, rng=seed,
+                                                min_separation=min_separation, length=y_limit,
+                                                radius=radius, sample=sample, sampling=sampling)
+                self.theta_commands = self._block(commands, 'theta', seed=seed)
+            instrument.count('points_generated', n_trials * n_positions)
+            if visualize:
+                self._visualize(self.theta_commands, sample, animate, animate_filename)
+                with instrument.span('histogram'):
+                    c_d.histogram_command_files(self.theta_commands, density=False,
+                                                save_file='visualizations/histogram_theta.png', show=not self.headless)
+            if export:
+                with instrument.span('export'):
+                    ex.export_commands(self.theta_commands, export_filename, formats=export_formats,
+                                       instrumentation=instrument)
 
     def create_phi_workspace(self, x_limit, radius, n_trials, n_positions, sample=False, visualize=False, export=False,
-                             animate=False, animate_filename=False, export_filename=False):
+                             animate=False, animate_filename=False, export_filename=False,
+                             export_formats=('csv',), min_separation=None, sampling='random'):
         """ Method to create a 1-D phi (z-plane) task workspace. This method relies on functions from
             utils directory to create, visualize, generalize with statistics, and export command files for
-            a phi robot command position workspace. """
-        self.phi_commands = c_d.sample_phi_commands(x_limit, radius, n_positions, n_trials, extrema=sample)
-        if visualize:
-            c_d.visualize_commands(self.phi_commands, sample=sample, animate=animate, animate_filename=animate_filename)
-            c_d.histogram_command_files(self.phi_commands, density=False, save_file='visualizations/histogram_phi.png')
-        if export:
-            for il in range(n_trials):
-                for ij in range(0, self.phi_commands[0].shape[0]):
-                    self.robot_euclidean_commands.append(
-                        c_d.xform_coords_spherical(self.phi_commands[il, ij, 0], self.phi_commands[il, ij, 1],
-                                                   self.phi_commands[il, ij, 2]))
-            create_robot_command(self.robot_euclidean_commands, file=export_filename)
-            self.robot_euclidean_commands = []  # Clear memory
+            a phi robot command position workspace. Positions are drawn at random, or from a scrambled
+            'halton' or 'sobol' sequence (see utils.qmc_utils) for more even coverage with fewer trials. """
+        instrument = self.instrumentation
+        with instrument.span('create_phi_workspace', n_trials=n_trials, n_positions=n_positions):
+            with instrument.span('sample'):
+                seed = self.seed_sequence.spawn(1)[0]
+                commands = c_d.sample_workspace('phi', n_trials, n_positions, rng=seed,
+                                                min_separation=min_separation, length=x_limit, radius=radius,
+                                                sample=sample, sampling=sampling)
+                self.phi_commands = self._block(commands, 'phi', seed=seed)
+            instrument.count('points_generated', n_trials * n_positions)
+            if visualize:
+                self._visualize(self.phi_commands, sample, animate, animate_filename)
+                with instrument.span('histogram'):
+                    c_d.histogram_command_files(self.phi_commands, density=False,
+                                                save_file='visualizations/histogram_phi.png', show=not self.headless)
+            if export:
+                with instrument.span('export'):
+                    ex.export_commands(self.phi_commands, export_filename, formats=export_formats,
+                                       instrumentation=instrument)
 
     def create_2d_workspace(self, z_length, y_length, radius, n_trials, n_positions, extrema=True, sample=False,
                             visualize=False, export=False, animate=False, animate_filename=False,
-                            export_filename=False):
+                            export_filename=False, export_formats=('csv',), min_separation=None,
+                            sampling='random'):
         """ Method to create a 2-D theta-phi (y-z plane) task workspace. This method relies on functions from
             utils directory to create, visualize, generalize with statistics, and export command files for
-            a theta-phi robot command position workspace. """
-        self.commands_2d = c_d.get_2d_commands(z_length, y_length, radius, n_positions, n_trials, sample=sample,
-                                               extrema=extrema)
-        if visualize:
-            c_d.histogram_command_files(self.commands_2d, density=False, save_file='visualizations/histogram_2d.png')
-            c_d.visualize_commands(self.commands_2d, sample=sample, animate=animate, animate_filename=animate_filename)
-        if export:
-            for il in range(n_trials):
-                for ij in range(0, self.commands_2d[0].shape[0]):
-                    self.robot_euclidean_commands.append(
-                        c_d.xform_coords_spherical(self.commands_2d[il, ij, 0], self.commands_2d[il, ij, 1],
-                                                   self.commands_2d[il, ij, 2]))
-            create_robot_command(self.robot_euclidean_commands, file=export_filename)
-            self.robot_euclidean_commands = []  # Clear memory
+            a theta-phi robot command position workspace. Positions are drawn at random, or from a scrambled
+            'halton' or 'sobol' sequence (see utils.qmc_utils) for more even coverage with fewer trials. """
+        instrument = self.instrumentation
+        with instrument.span('create_2d_workspace', n_trials=n_trials, n_positions=n_positions):
+            with instrument.span('sample'):
+                seed = self.seed_sequence.spawn(1)[0]
+                commands = c_d.sample_workspace('2d', n_trials, n_positions, rng=seed,
+                                                min_separation=min_separation, z_length=z_length,
+                                                y_length=y_length, radius=radius, sample=sample,
+                                                extrema=extrema, sampling=sampling)
+                self.commands_2d = self._block(commands, '2d', seed=seed)
+            instrument.count('points_generated', n_trials * n_positions)
+            if visualize:
+                with instrument.span('histogram'):
+                    c_d.histogram_command_files(self.commands_2d, density=False,
+                                                save_file='visualizations/histogram_2d.png', show=not self.headless)
+                self._visualize(self.commands_2d, sample, animate, animate_filename)
+            if export:
+                with instrument.span('export'):
+                    ex.export_commands(self.commands_2d, export_filename, formats=export_formats,
+                                       instrumentation=instrument)
 
     def create_3d_workspace(self, z_length, y_length, x_length, radius, n_trials, n_positions, extrema=True,
                             sample=False,
                             visualize=False, export=False, animate=False, animate_filename=False,
-                            export_filename=False):
+                            export_filename=False, export_formats=('csv',), min_separation=None,
+                            sampling='random'):
         """ Method to create a 3-D theta-phi (y-z plane) task workspace. This method relies on functions from
             utils directory to create, visualize, generalize with statistics, and export command files for
             a theta-phi robot command position workspace. This workspace is then randomly sampled from either
             +x_length, -x_length, or kept at the originating 2-D x_length, allowing a researcher to randomly
-            sample from the 3-D workspace while keeping as much resembling structure as possible. """
-        self.commands_3d = c_d.sample_3d_structure(x_length, y_length, z_length, radius, n_positions, n_trials,
-                                                   sample=sample, extrema=extrema)
-        if visualize:
-            c_d.histogram_command_files(self.commands_3d, density=False, save_file='visualizations/histogram_3d.png')
-            c_d.visualize_commands(self.commands_3d, sample=sample, animate=animate, animate_filename=animate_filename)
+            sample from the 3-D workspace while keeping as much resembling structure as possible. The sampling argument
+            selects random, 'halton' or 'sobol' draws as for the 2-D workspace. """
+        instrument = self.instrumentation
+        with instrument.span('create_3d_workspace', n_trials=n_trials, n_positions=n_positions):
+            with instrument.span('sample'):
+                seed = self.seed_sequence.spawn(1)[0]
+                commands = c_d.sample_workspace('3d', n_trials, n_positions, rng=seed,
+                                                min_separation=min_separation, stride=x_length,
+                                                y_length=y_length, z_length=z_length, radius=radius,
+                                                sample=sample, extrema=extrema, sampling=sampling)
+                self.commands_3d = self._block(commands, '3d', seed=seed)
+            instrument.count('points_generated', n_trials * n_positions)
+            if visualize:
+                with instrument.span('histogram'):
+                    c_d.histogram_command_files(self.commands_3d, density=False,
+                                                save_file='visualizations/histogram_3d.png', show=not self.headless)
+                self._visualize(self.commands_3d, sample, animate, animate_filename)
+            if export:
+                with instrument.span('export'):
+                    ex.export_commands(self.commands_3d, export_filename, formats=export_formats,
+                                       instrumentation=instrument)
+
+    def _visualize(self, commands, sample, animate, animate_filename):
+        """ Scatter (and optionally animate) a workspace, timed as a 'visualize' span. """
+        with self.instrumentation.span('visualize', animate=bool(animate)):
+            c_d.visualize_commands(commands, sample=sample, animate=animate, animate_filename=animate_filename,
+                                   headless=self.headless, render=self.render)
+        if animate:
+            self.instrumentation.count('frames_rendered', c_d.ANIMATION_FRAMES)
+
+    def run_report(self, filename=None):
+        """ Returns the JSON run report of the instrumentation (phase timings and counters), also writing it to
+            filename when given. Instrumentation is enabled with ReachSample(instrumentation=True) or by passing a
+            utils.instrument_utils.Instrumentation, which may carry sinks for custom reporting. """
+        return self.instrumentation.to_json(filename)
+
+    def iter_workspace(self, kind, n_trials, n_positions, block_size=10000, rng=None, **params):
+        """ Method to generate a workspace lazily. Yields the kind ('theta', 'phi', '2d' or '3d') workspace in blocks
+            of at most block_size trials (block_trials, n_positions, 3), so memory scales with block_size rather than
+            n_trials. Keyword parameters are those of the matching batched sampler in utils.command_utils, for
+            example iter_workspace('theta', 10 ** 6, 9, length=0.4, radius=2, sample=True). Blocks are CommandBlocks
+            of the instance dtype, drawn from rng (default: the instance Generator). """
+        for block in c_d.iter_workspace_blocks(kind, n_trials, n_positions, block_size=block_size,
+                                               rng=self.rng if rng is None else rng, **params):
+            yield self._block(block, kind)
+
+    def stream_workspace(self, kind, n_trials, n_positions, block_size=10000, visualize=False, export=False,
+                         export_filename=False, export_formats=('csv',), statistics=False, max_visualized_trials=500,
+                         **params):
+        """ Method to create, visualize and export a workspace in a single streamed pass over iter_workspace. Each
+            block is exported and added to a utils.stats_utils.CommandStatistics accumulator as it is generated, and at
+            most max_visualized_trials evenly spaced trials are kept for the scatter visualization, so the full
+            schedule is never held in memory. With a 'voxels' or 'projections' render every position is binned into a
+            utils.spatial_utils.DensityGrid instead, and the kept trials only supply its sparse outliers. Returns the
+            accumulated statistics when statistics or visualize is set.
+        """
+        instrument = self.instrumentation
+        with instrument.span('stream_workspace', kind=kind, n_trials=n_trials, n_positions=n_positions):
+            blocks = iu.time_through(self.iter_workspace(kind, n_trials, n_positions, block_size=block_size,
+                                                         **params), instrument, 'sample')
+            writer, command_statistics = None, None
+            if export:
+                writer = ex.CommandExportWriter(export_filename or 'new_export_commands.csv', formats=export_formats,
+                                                instrumentation=instrument)
+                blocks = ex.write_through(blocks, writer)
+            if statistics or visualize:
+                limit = params['radius'] + params.get('stride', 0) + 0.2
+                command_statistics = st.CommandStatistics(ranges=dict.fromkeys(('x', 'y', 'z'), (-limit, limit)),
+                                                          x_offset=2)
+                blocks = st.accumulate_through(blocks, command_statistics, instrumentation=instrument)
+            visualized_trials, density = [], None
+            if visualize:
+                blocks = _keep_every(blocks, max(1, -(-n_trials // max_visualized_trials)), visualized_trials)
+                if self.render != 'points':
+                    density = sp.DensityGrid(_density_bounds(kind, params))
+                    blocks = _bin_through(blocks, density, instrument)
+            try:
+                for block in blocks:
+                    instrument.count('points_generated', block.shape[0] * block.shape[1])
+            finally:
+                if writer is not None:
+                    writer.close()
+            if visualize:
+                with instrument.span('histogram'):
+                    command_statistics.plot(save_file='visualizations/histogram_' + kind + '.png',
+                                            show=not self.headless)
+                visualized = np.concatenate(visualized_trials)
+                if density is not None:
+                    density.collect_outliers(visualized)
+                    visualized = density
+                with instrument.span('visualize', animate=False):
+                    c_d.visualize_commands(visualized, sample=params.get('sample', False), headless=self.headless,
+                                           render=self.render)
+        return command_statistics
+
+    def generate_workspace(self, kind, n_trials, n_positions, n_workers=None, chunk_trials=pu.DEFAULT_CHUNK_TRIALS,
+                           seed=None, **params):
+        """ Method to generate a workspace across n_workers processes (default: all cores). Each call draws from a new
+            SeedSequence spawned from the instance seed, unless seed is given, and the result is bit-identical for the
+            same seed whatever the number of workers. The schedule is returned and kept as the matching theta_commands,
+            phi_commands, commands_2d or commands_3d attribute. """
+        if seed is None:
+            seed = self.seed_sequence.spawn(1)[0]
+        with self.instrumentation.span('generate_workspace', kind=kind, n_trials=n_trials, n_positions=n_positions):
+            commands = pu.generate_schedule(kind, n_trials, n_positions, seed=seed, n_workers=n_workers,
+                                            chunk_trials=chunk_trials, **params)
+        self.instrumentation.count('points_generated', n_trials * n_positions)
+        commands = self._block(commands, kind, seed=seed)
+        setattr(self, WORKSPACE_ATTRIBUTES[kind], commands)
+        return commands
+
+    def export_workspace(self, kind, n_trials, n_positions, export_filename, export_formats=('csv',),
+                         chunk_trials=pu.DEFAULT_CHUNK_TRIALS, seed=None, resume=True, **params):
+        """ Method to generate and export a kind workspace chunk by chunk with a checkpoint beside export_filename, so
+            an interrupted run resumes from its last finished chunk when called again with the same arguments. Each
+            new export draws from a SeedSequence spawned from the instance seed unless seed is given; a resumed
+            export keeps the seed of its checkpoint. See utils.checkpoint_utils.export_schedule. """
+        if seed is None and not (resume and ck.load_checkpoint(export_filename)):
+            seed = self.seed_sequence.spawn(1)[0]
+        return ck.export_schedule(kind, n_trials, n_positions, export_filename, seed=seed, formats=export_formats,
+                                  chunk_trials=chunk_trials, resume=resume, instrumentation=self.instrumentation,
+                                  **params)
+
+    def append_workspace(self, export_filename, n_trials):
+        """ Method to append n_trials trials to a workspace exported with export_workspace, drawn with its seed and
+            sampler parameters, writing only the new trials. """
+        return ck.append_schedule(export_filename, n_trials, instrumentation=self.instrumentation)
+
+    def compile_plan(self, plan, n_workers=None, export=False, export_filename=None, export_formats=None):
+        """ Method to compile an experiment plan (a dict or a JSON or YAML plan file, see utils.plan_utils) into its
+            ordered blocks, generating parameter-identical blocks once and the others concurrently on n_workers
+            processes. A plan without a seed draws from a SeedSequence spawned from the instance seed. Returns the
+            list of CommandBlocks and the plan manifest, exporting the blocks as one schedule when export is set. """
+        if not isinstance(plan, dict):
+            plan = pl.load_plan(plan)
+        if plan.get('seed') is None:
+            plan = dict(plan, seed=self.seed_sequence.spawn(1)[0])
+        commands, manifest = pl.compile_plan(plan, n_workers=n_workers, instrumentation=self.instrumentation)
         if export:
-            for il in range(n_trials):
-                for ij in range(0, self.commands_3d[0].shape[0]):
-                    self.robot_euclidean_commands.append(
-                        c_d.xform_coords_spherical(self.commands_3d[il, ij, 0], self.commands_3d[il, ij, 1],
-                                                   self.commands_3d[il, ij, 2]))
-            create_robot_command(self.robot_euclidean_commands, file=export_filename)
-            self.robot_euclidean_commands = []  # Clear memory
+            pl.write_plan(commands, manifest, filename=export_filename or plan.get('output') or
+                          'new_export_commands.csv', formats=export_formats or plan.get('formats') or ('csv',),
+                          instrumentation=self.instrumentation)
+        return commands, manifest
+
+    def serve(self, kind, n_positions, n_trials=None, block_size=su.DEFAULT_BLOCK_TRIALS, host='127.0.0.1', port=0,
+              prefetch_blocks=su.DEFAULT_PREFETCH_BLOCKS, **params):
+        """ Method to serve a kind workspace to the ReachMaster controller, one trial per request, from a local
+            utils.server_utils.CommandServer. Trials are drawn from iter_workspace in blocks of block_size by a
+            background thread that keeps up to prefetch_blocks blocks transformed and ready; n_trials=None serves
+            until the server is closed. Returns the started server, whose address is the (host, port) to connect
+            to. The prefetch thread draws from its own Generator, seeded from a SeedSequence spawned from the instance
+            seed, so it never shares the instance Generator with the caller. Keyword parameters are those of the
+            matching batched sampler. """
+        rng = c_d.get_rng(self.seed_sequence.spawn(1)[0])
+        if n_trials is None:
+            blocks = self._iter_unbounded(kind, n_positions, block_size, rng, **params)
+        else:
+            blocks = self.iter_workspace(kind, n_trials, n_positions, block_size=block_size, rng=rng, **params)
+        return su.CommandServer(blocks, host=host, port=port, prefetch_blocks=prefetch_blocks).start()
+
+    def _iter_unbounded(self, kind, n_positions, block_size, rng, **params):
+        while True:
+            yield from self.iter_workspace(kind, block_size, n_positions, block_size=block_size, rng=rng, **params)
+
+    def coverage_report(self, kind, voxel_size=0.05, tolerance=1e-9):
+        """ Method to summarize how the last kind workspace covers the reaching volume: nearest-neighbour distances,
+            duplicate positions across the schedule and within trials, and empty voxels of side voxel_size (cm). See
+            utils.spatial_utils.coverage_report. """
+        return sp.coverage_report(getattr(self, WORKSPACE_ATTRIBUTES[kind]), voxel_size=voxel_size,
+                                  tolerance=tolerance)
+
+
+def _density_bounds(kind, params):
+    """ Per-axis DensityGrid bounds of a streamed workspace. Sampled positions keep y and z within their lengths and x
+        between the radius projected past the full y and z lengths and the radius, widened by the 3-D stride; a margin
+        of 1% of the radius keeps flat axes (z of a theta workspace) binnable. Unsampled schedules, whose templates
+        follow other layouts, keep the symmetric cube of the statistics ranges. """
+    radius, stride = params['radius'], params.get('stride', 0)
+    if not params.get('sample', False):
+        limit = radius + stride + 0.2
+        return np.tile((-limit, limit), (3, 1))
+    y = params.get('y_length', params.get('length', 0) if kind == 'theta' else 0)
+    z = params.get('z_length', params.get('length', 0) if kind == 'phi' else 0)
+    margin = 0.01 * radius
+    near = np.sqrt(max(radius ** 2 - y ** 2 - z ** 2, 0.))
+    return np.array([(near - stride - margin, radius + stride + margin), (-y - margin, y + margin),
+                     (-z - margin, z + margin)])
+
+
+def _bin_through(blocks, density, instrumentation):
+    """ Generator that passes blocks through unchanged while adding their positions to a DensityGrid. """
+    for block in blocks:
+        with instrumentation.span('density'):
+            density.update(block)
+        yield block
+
+
+def _keep_every(blocks, step, kept_trials):
+    """ Generator that passes blocks through unchanged while appending a copy of every step-th trial to kept_trials,
+        so the kept trials never hold their block in memory. """
+    offset = 0
+    for block in blocks:
+        kept_trials.append(block[(-offset) % step::step].copy())
+        offset += block.shape[0]
+        yield block
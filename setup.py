@@ -9,9 +9,12 @@ setup(
     author='Brett Nelson',
     author_email='bnelson@lbl.gov',
     license='BSD-3-Clause-LBNL',
-    packages=['ReachSample'],
-    install_requires=['pandas', 'matplotlib.pyplot', 'unittest',
-                      'numpy', 'os', 'pdb', 'ffmpeg'],
+    packages=['ReachSample', 'utils'],
+    py_modules=['reach_sample'],
+    entry_points={'console_scripts': ['reach-sample-plan=utils.plan_utils:main']},
+    install_requires=['numpy', 'pandas', 'matplotlib'],
+    extras_require={'parquet': ['pyarrow'], 'scipy': ['scipy'], 'yaml': ['pyyaml'],
+                    'all': ['pyarrow', 'scipy', 'pyyaml']},
     classifiers=[
         'Development Status :: 1 - Planning',
         'Intended Audience :: Science/Research',
@@ -1,7 +1,31 @@
 import unittest
+import contextlib
+import io
+import json
 import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import numpy as np
 os.chdir('../')
+import reach_sample
 from reach_sample import ReachSample as RS
+import utils.block_utils as b_u
+import utils.checkpoint_utils as ck_u
+import utils.command_utils as c_d
+import utils.export_utils as e_u
+import utils.instrument_utils as i_u
+import utils.parallel_utils as p_u
+import utils.plan_utils as pl_u
+import utils.qmc_utils as q_u
+import utils.render_utils as r_u
+import utils.server_utils as se_u
+import utils.spatial_utils as sp_u
+import utils.stats_utils as s_u
+import utils.store_utils as st_u
 RS_ = RS()
 
 
@@ -37,6 +61,408 @@ class TestReachSample(unittest.TestCase):
         except:
             self.fail("Encountered an unexpected exception.")
 
+    def test_reach_sample_seeded_workspace(self):
+        first, second = RS(seed=7), RS(seed=7)
+        first.create_3d_workspace(0.5, 0.4, 1, 2, 1000, 9, sample=True)
+        second.create_3d_workspace(0.5, 0.4, 1, 2, 1000, 9, sample=True)
+        self.assertEqual(first.commands_3d.shape, (1000, 9, 3))
+        self.assertTrue(np.array_equal(first.commands_3d, second.commands_3d))
+
+    def test_reach_sample_export_formats(self):
+        with tempfile.TemporaryDirectory() as export_dir:
+            export_filename = os.path.join(export_dir, 'commands.csv')
+            RS_.create_2d_workspace(1, 1, 2, 25, 9, sample=True, export=True, export_filename=export_filename,
+                                    export_formats=('csv', 'npy'))
+            robot_commands = np.load(os.path.join(export_dir, 'commands.npy'))
+            with open(export_filename) as csv_file:
+                self.assertEqual(csv_file.readline().strip(), ',r,thetay,thetaz')
+                self.assertEqual(len(csv_file.readlines()), 25 * 9)
+        self.assertEqual(robot_commands.shape, (25 * 9, 3))
+
+    def test_read_command_file_cache(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            command_file = os.path.join(data_dir, 'commands.txt')
+            with open('data/9pt_pidiv3_cone.txt') as pilot_file, open(command_file, 'w') as copy_file:
+                copy_file.write(pilot_file.read())
+            positions = c_d.read_command_file(command_file)
+            self.assertTrue(os.path.exists(c_d.command_cache_filename(command_file)))
+            self.assertTrue(np.array_equal(positions, c_d.read_command_file(command_file)))
+            with open(command_file, 'a') as copy_file:
+                copy_file.write('"10",10,0,0\n')
+            self.assertEqual(c_d.read_command_file(command_file).shape, (3, 10))
+            self.assertEqual(sorted(os.listdir(data_dir)), ['commands.txt', os.path.basename(
+                c_d.command_cache_filename(command_file))])
+
+    def test_reach_sample_lazy_startup(self):
+        loaded = subprocess.run([sys.executable, '-c', 'import sys, reach_sample; reach_sample.ReachSample(); '
+                                 'print(sorted(m for m in ("pandas", "matplotlib") if m in sys.modules))'],
+                                check=True, capture_output=True, text=True).stdout.strip()
+        self.assertEqual(loaded, '[]')
+
+    def test_reach_sample_stream_workspace(self):
+        blocks = RS_.iter_workspace('theta', 25, 9, block_size=10, length=0.4, radius=2, sample=True)
+        self.assertEqual([block.shape for block in blocks], [(10, 9, 3), (10, 9, 3), (5, 9, 3)])
+        with tempfile.TemporaryDirectory() as export_dir:
+            export_filename = os.path.join(export_dir, 'commands.csv')
+            RS_.stream_workspace('3d', 1000, 9, block_size=64, export=True, export_filename=export_filename,
+                                 export_formats=('npy',), stride=0.5, y_length=0.4, z_length=1, radius=2, sample=True)
+            self.assertEqual(np.load(os.path.join(export_dir, 'commands.npy')).shape, (1000 * 9, 3))
+
+    def test_stream_workspace_keeps_copies(self):
+        kept, retained = [], []
+        tracemalloc.start()
+        try:
+            blocks = RS(seed=3).iter_workspace('theta', 20000, 9, block_size=1000, length=0.4, radius=2, sample=True)
+            for block in reach_sample._keep_every(blocks, 40, kept):
+                self.assertFalse(np.shares_memory(kept[-1], block))
+            retained = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        self.assertEqual(sum(len(trials) for trials in kept), 500)
+        self.assertLess(retained, 4 * 1000 * 9 * 3 * 8)  # a few blocks, against 20 for the whole schedule
+
+    def test_reach_sample_parallel_workspace(self):
+        params = dict(stride=0.5, y_length=0.4, z_length=1, radius=2, sample=True)
+        serial = RS(seed=11).generate_workspace('3d', 500, 9, n_workers=1, chunk_trials=64, **params)
+        parallel = RS(seed=11).generate_workspace('3d', 500, 9, n_workers=2, chunk_trials=64, **params)
+        self.assertEqual(serial.shape, (500, 9, 3))
+        self.assertTrue(np.array_equal(serial, parallel))
+
+    def test_headless_render_rotation(self):
+        commands = c_d.batch_theta_commands(0.4, 2, 20, 9, rng=0)
+        with tempfile.TemporaryDirectory() as render_dir:
+            filename = r_u.render_rotation(c_d.func_viz, commands, os.path.join(render_dir, 'rotation.mp4'),
+                                           frames=4, n_workers=2, output_format='gif', figsize=(3, 3), dpi=40)
+            self.assertTrue(filename.endswith('.gif') and os.path.getsize(filename) > 0)
+
+    def test_streaming_command_statistics(self):
+        commands = c_d.batch_3d_commands(0.5, 0.4, 1, 2, 1000, 9, sample=True, rng=3)
+        whole = s_u.statistics_from_blocks([commands])
+        blocks = s_u.statistics_from_blocks([commands[:300]]).merge(s_u.statistics_from_blocks([commands[300:]]))
+        for channel in s_u.CHANNELS:
+            self.assertTrue(np.array_equal(whole.counts[channel], blocks.counts[channel]))
+            self.assertAlmostEqual(whole.variance(channel), blocks.variance(channel))
+        self.assertAlmostEqual(whole.mean['y'], commands[:, :, 1].mean())
+        self.assertAlmostEqual(whole.mean['thetay'], c_d.euclidean_to_robot(commands.reshape(-1, 3))[:, 1].mean())
+        self.assertEqual(whole.underflow['thetaz'] + whole.overflow['thetaz'], 0)
+        self.assertEqual(json.loads(blocks.to_json())['n_trials'], 1000)
+
+    def test_reach_sample_min_separation(self):
+        sampler = RS(seed=5)
+        sampler.create_theta_workspace(0.4, 2, 2000, 9, sample=True, min_separation=0.02)
+        distances = np.linalg.norm(sampler.theta_commands[:, :, None] - sampler.theta_commands[:, None], axis=-1)
+        distances[:, np.arange(9), np.arange(9)] = np.inf
+        self.assertGreaterEqual(distances.min(), 0.02)
+        self.assertEqual(sampler.coverage_report('theta')['n_within_trial_duplicates'], 0)
+
+    def test_nearest_neighbor_distances(self):
+        points = np.random.default_rng(0).random((2000, 3))
+        points[7] = points[3]
+        distances = np.linalg.norm(points[:, None] - points[None], axis=-1)
+        np.fill_diagonal(distances, np.inf)
+        self.assertTrue(np.allclose(sp_u.nearest_neighbor_distances(points), distances.min(axis=1)))
+
+    def test_nearest_neighbor_distances_packed(self):
+        points = np.random.default_rng(1).random((20000, 3))
+        points[:2000, 1:] = 0.5  # a dense line and a few isolated points, which take several cell size doublings
+        points[-10:] = 5 + np.arange(10)[:, None]
+        distances = sp_u.nearest_neighbor_distances(points)
+        sample = np.r_[np.arange(0, len(points), 97), len(points) - 10]
+        expected = [np.delete(np.linalg.norm(points - points[i], axis=1), i).min() for i in sample]
+        self.assertTrue(np.allclose(distances[sample], expected))
+        self.assertTrue(np.allclose(distances[-10:], np.sqrt(3)))
+
+    def test_reach_sample_instrumentation(self):
+        events = []
+        sampler = RS(seed=2, instrumentation=i_u.Instrumentation(sinks=[events.append]))
+        with tempfile.TemporaryDirectory() as export_dir:
+            sampler.create_theta_workspace(0.4, 2, 100, 9, sample=True, export=True,
+                                           export_filename=os.path.join(export_dir, 'theta.csv'))
+            report = json.loads(sampler.run_report(os.path.join(export_dir, 'report.json')))
+            size = os.path.getsize(os.path.join(export_dir, 'theta.csv'))
+        self.assertEqual(report['counters']['points_generated'], 900)
+        self.assertEqual(report['counters']['bytes_written'], size)
+        for phase in ('sample', 'export/transform', 'export/write'):
+            self.assertIn('create_theta_workspace/' + phase, report['spans'])
+        self.assertEqual(events[-1]['path'], 'create_theta_workspace')
+        self.assertIs(RS().instrumentation.span('sample'), i_u.NULL_INSTRUMENTATION.span('other'))
+
+    def test_command_template_cache(self):
+        c_d.clear_template_cache()
+        first = c_d.batch_2d_commands(1, 0.8, 2, 200, 9, rng=4)
+        second = c_d.batch_2d_commands(1, 0.8, 2, 200, 9, rng=4)
+        info = c_d.template_cache_info()
+        self.assertEqual((info.hits, info.misses), (2, 2))
+        self.assertFalse(c_d.command_template('phi', 1., 2., 9).flags.writeable)
+        self.assertTrue(np.array_equal(first, second))
+        phi, theta = c_d.command_template('phi', 1., 2., 9), c_d.command_template('phi', 0.8, 2., 9)
+        even_from_phi = np.all(first[:, ::2] == phi[::2], axis=(1, 2))
+        self.assertTrue(np.all(first[even_from_phi, 1::2] == theta[1::2]))
+        self.assertTrue(np.all(first[~even_from_phi, ::2] == theta[::2]))
+        first[0, 0, 0] = -1.
+        self.assertFalse(np.array_equal(first, c_d.batch_2d_commands(1, 0.8, 2, 200, 9, rng=4)))
+
+    def test_command_block(self):
+        full, compact = RS(seed=6), RS(seed=6, dtype=np.float32)
+        full.create_3d_workspace(0.5, 0.4, 1, 2, 400, 9, sample=True)
+        compact.create_3d_workspace(0.5, 0.4, 1, 2, 400, 9, sample=True)
+        block = compact.commands_3d
+        self.assertIsInstance(block, b_u.CommandBlock)
+        self.assertEqual((block.kind, block.dtype, block.nbytes * 2), ('3d', np.float32, full.commands_3d.nbytes))
+        self.assertTrue(np.allclose(block, full.commands_3d, atol=1e-6))
+        trials = block[100:200]
+        self.assertTrue(np.shares_memory(trials, block) and np.shares_memory(block.y, block))
+        self.assertEqual((trials.kind, trials.n_trials, block.y.shape), ('3d', 100, (400, 9)))
+        self.assertEqual(block.metadata()['seed']['entropy'], 6)
+        regenerated = c_d.sample_workspace('3d', 400, 9, rng=block.seed, stride=1, y_length=0.4, z_length=0.5, radius=2,
+                                           sample=True)
+        np.testing.assert_array_equal(block, regenerated.astype(np.float32))
+        for result in (block[0], block[:, 0], block[..., 0], block.mean(axis=0), block.min(axis=1),
+                       block.reshape(-1, 3), block.ravel()):
+            self.assertIs(type(result), np.ndarray)
+        for result in (block[:5], block[:, 2:5], block[block[:, 0, 0] > 0], block * 2):
+            self.assertEqual((type(result), result.kind), (b_u.CommandBlock, '3d'))
+        robot = full.commands_3d.to_robot()
+        self.assertTrue(np.array_equal(robot.points(), c_d.euclidean_to_robot(full.commands_3d.points())))
+        self.assertTrue(np.allclose(robot.to_euclidean(), full.commands_3d, rtol=0, atol=1e-12))
+        with tempfile.TemporaryDirectory() as export_dir:
+            filenames = [os.path.join(export_dir, name) for name in ('xyz.csv', 'robot.csv')]
+            full.create_3d_workspace(0.5, 0.4, 1, 2, 10, 9, export=True, export_filename=filenames[0])
+            e_u.export_commands(full.commands_3d.to_robot(), filenames[1])
+            with open(filenames[0]) as xyz_file, open(filenames[1]) as robot_file:
+                self.assertEqual(xyz_file.read(), robot_file.read())
+
+    def test_schedule_store(self):
+        sampler = RS(seed=8)
+        with tempfile.TemporaryDirectory() as store_dir:
+            filename = os.path.join(store_dir, 'schedule.csv')
+            sampler.create_2d_workspace(1, 1, 2, 300, 9, sample=True, export=True, export_filename=filename,
+                                        export_formats=('csv', 'store'))
+            robot = sampler.commands_2d.to_robot()
+            store = st_u.open_store(filename)
+            self.assertEqual((len(store), store.metadata['kind'], store.metadata['n_positions']), (300, '2d', 9))
+            self.assertTrue(np.array_equal(store[123], robot[123]) and np.array_equal(store[-1], robot[-1]))
+            self.assertTrue(np.shares_memory(store[5], store.commands))
+            self.assertTrue(np.array_equal(store[40:60], robot[40:60]) and store[40:60].space == 'robot')
+            converted = st_u.open_store(st_u.csv_to_store(filename, os.path.join(store_dir, 'converted'),
+                                                          chunk_trials=64)[0])
+            self.assertTrue(np.array_equal(converted.commands, store.commands))
+            store.close()
+            converted.close()
+
+    def test_command_server(self):
+        params = {'length': 0.4, 'radius': 2, 'sample': True}
+        rng = np.random.default_rng(p_u.root_seed_sequence(9).spawn(1)[0])  # the server draws from a spawned stream
+        blocks = RS(seed=9).iter_workspace('theta', 300, 9, block_size=64, rng=rng, **params)
+        expected = np.concatenate([block.to_robot() for block in blocks])
+        with RS(seed=9).serve('theta', 9, n_trials=300, block_size=64, prefetch_blocks=2, **params) as server, \
+                se_u.CommandClient(server.address) as client:
+            served = [client.next_trial() for _ in range(300)]
+            self.assertIsNone(client.next_trial())
+            stats = client.stats()
+        self.assertTrue(np.array_equal(np.array(served), expected))
+        self.assertEqual(stats['n_served'], 300)
+        self.assertLessEqual(stats['p50_ms'], stats['p99_ms'])
+
+    def test_command_server_stats_while_waiting(self):
+        release = threading.Event()
+
+        def slow_blocks():
+            yield np.ones((1, 9, 3))
+            release.wait(5)  # the prefetch thread falls behind the controller
+        server = se_u.CommandServer(slow_blocks(), prefetch_blocks=1).start()
+        responses = []
+        try:
+            with se_u.CommandClient(server.address) as waiting, se_u.CommandClient(server.address) as other:
+                self.assertEqual(waiting.next_trial().shape, (9, 3))
+                pending = threading.Thread(target=lambda: responses.append(waiting.next_trial()))
+                pending.start()
+                time.sleep(0.3)
+                start = time.perf_counter()
+                stats = other.stats()
+                self.assertLess(time.perf_counter() - start, 1.)
+                self.assertEqual(stats['n_served'], 1)
+                self.assertGreaterEqual(stats['n_waits'], 1)
+                closing = threading.Thread(target=server.close)
+                closing.start()
+                pending.join(2)
+                self.assertEqual(responses, [None])
+                release.set()
+                closing.join()
+        finally:
+            release.set()
+            server.close()
+
+    def test_transform_kernels_round_trip(self):
+        points = np.random.default_rng(1).uniform(-5, 5, (200000, 3))
+        for degrees in (True, False):
+            robot = c_d.euclidean_to_robot(points, degrees=degrees)
+            self.assertLess(np.abs(c_d.robot_to_euclidean(robot, degrees=degrees) - points).max(), 1e-12)
+        in_place = points.copy()
+        c_d.robot_to_euclidean(c_d.euclidean_to_robot(in_place, out=in_place), out=in_place)
+        self.assertLess(np.abs(in_place - points).max(), 1e-12)
+        r, thetay, thetaz = c_d.euclidean_to_robot(points[:100]).T
+        self.assertTrue(np.allclose(np.column_stack(c_d.xform_coords_euclidean(r, thetay, thetaz)), points[:100]))
+        commands = RS(seed=10).generate_workspace('3d', 50, 9, n_workers=1, stride=0.5, y_length=0.4, z_length=1,
+                                                  radius=2, sample=True)
+        with tempfile.TemporaryDirectory() as export_dir:
+            filename = os.path.join(export_dir, 'commands.csv')
+            e_u.export_commands(commands, filename)
+            read_back = c_d.read_command_file(filename, cache=False)
+        self.assertLess(np.abs(read_back.T - commands.points()).max(), 1e-12)
+
+    def test_checkpoint_resume_and_append(self):
+        params = {'stride': 0.5, 'y_length': 0.4, 'z_length': 1, 'radius': 2, 'sample': True}
+        generate_chunk = ck_u.pu.generate_chunk
+        with tempfile.TemporaryDirectory() as export_dir:
+            filenames = [os.path.join(export_dir, name) for name in ('whole.csv', 'resumed.csv')]
+            RS().export_workspace('3d', 1000, 9, filenames[0], export_formats=('csv', 'store'), chunk_trials=128,
+                                  seed=12, **params)
+            calls = []
+
+            def interrupted_chunk(*args):
+                calls.append(args)
+                if len(calls) == 4:
+                    raise KeyboardInterrupt
+                return generate_chunk(*args)
+            ck_u.pu.generate_chunk = interrupted_chunk
+            try:
+                with self.assertRaises(KeyboardInterrupt):
+                    RS().export_workspace('3d', 1000, 9, filenames[1], export_formats=('csv', 'store'),
+                                          chunk_trials=128, seed=12, **params)
+            finally:
+                ck_u.pu.generate_chunk = generate_chunk
+            self.assertEqual(ck_u.load_checkpoint(filenames[1])['n_trials_done'], 384)
+            self.assertFalse([name for name in os.listdir(export_dir) if name.endswith('.tmp')])
+            with self.assertRaisesRegex(ValueError, 'unfinished export of 1000 trials'):
+                RS().export_workspace('3d', 2000, 9, filenames[1], export_formats=('csv', 'store'), chunk_trials=128,
+                                      **params)
+            RS().export_workspace('3d', 1000, 9, filenames[1], export_formats=('csv', 'store'), chunk_trials=128,
+                                  **params)
+            contents = []
+            for filename in filenames:
+                with open(filename, 'rb') as csv_file:
+                    contents.append(csv_file.read())
+            self.assertEqual(contents[0], contents[1])
+            metadata = [st_u.open_store(filename).metadata for filename in filenames]
+            self.assertEqual(metadata[0]['kind'], '3d')
+            self.assertEqual(metadata[0]['seed'], {'entropy': 12, 'spawn_key': [0]})
+            self.assertEqual([metadata[1]['kind'], metadata[1]['seed']], ['3d', metadata[0]['seed']])
+            RS().append_workspace(filenames[0], 200)
+            with open(filenames[0], 'rb') as csv_file:
+                appended = csv_file.read()
+            self.assertTrue(appended.startswith(contents[0]))
+            self.assertEqual(len(appended.splitlines()), 1 + 1200 * 9)
+            self.assertEqual(len(st_u.open_store(filenames[0])), 1200)
+            self.assertEqual(st_u.open_store(filenames[0]).metadata['seed'], metadata[0]['seed'])
+
+    def test_plan_compiler(self):
+        plan = {'seed': 21, 'chunk_trials': 64, 'defaults': {'n_positions': 9, 'radius': 2, 'sample': True},
+                'blocks': [{'name': 'theta', 'kind': 'theta', 'n_trials': 100, 'length': 0.4},
+                           {'name': 'probe', 'kind': '2d', 'n_trials': 30, 'y_length': 0.4, 'z_length': 1,
+                            'seed': 7},
+                           {'name': '3d', 'kind': '3d', 'n_trials': 150, 'stride': 0.5, 'y_length': 0.4,
+                            'z_length': 1},
+                           {'name': 'probe-again', 'kind': '2d', 'n_trials': 30, 'y_length': 0.4, 'z_length': 1,
+                            'seed': 7}]}
+        commands, manifest = pl_u.compile_plan(plan, n_workers=2)
+        self.assertEqual([block.kind for block in commands], ['theta', '2d', '3d', '2d'])
+        self.assertEqual(manifest['n_generated'], 3)
+        self.assertEqual(manifest['blocks'][3]['shared_with'], 'probe')
+        self.assertEqual(manifest['blocks'][2]['first_trial'], 130)
+        self.assertTrue(np.shares_memory(commands[1], commands[3]))
+        theta_seed = p_u.chunk_seed_sequences(21, 4)[0]
+        np.testing.assert_array_equal(commands[0], p_u.generate_schedule('theta', 100, 9, seed=theta_seed,
+                                                                         n_workers=1, chunk_trials=64, length=0.4,
+                                                                         radius=2, sample=True))
+        np.testing.assert_array_equal(commands[1], p_u.generate_schedule('2d', 30, 9, seed=7, n_workers=1,
+                                                                         chunk_trials=64, y_length=0.4, z_length=1,
+                                                                         radius=2, sample=True))
+        with tempfile.TemporaryDirectory() as export_dir:
+            plan_filename = os.path.join(export_dir, 'plan.json')
+            with open(plan_filename, 'w') as plan_file:
+                json.dump(dict(plan, output=os.path.join(export_dir, 'session.csv')), plan_file)
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(pl_u.main([plan_filename, '-f', 'csv', 'store', '-w', '1']), 0)
+            with st_u.open_store(os.path.join(export_dir, 'session')) as store:
+                self.assertEqual(len(store), 310)
+                robot = b_u.CommandBlock(np.concatenate(commands)).to_robot()
+                np.testing.assert_allclose(store[:], robot, atol=1e-12)
+            with open(pl_u.manifest_filename(os.path.join(export_dir, 'session.csv'))) as manifest_file:
+                self.assertEqual(json.load(manifest_file)['blocks'], manifest['blocks'])
+
+    def test_quasi_random_sampling(self):
+        params = {'stride': 0.5, 'y_length': 0.4, 'z_length': 1, 'radius': 2, 'sample': True}
+        random = c_d.sample_workspace('3d', 512, 9, rng=3, **params)
+        halton = c_d.sample_workspace('3d', 512, 9, rng=3, sampling='halton', **params)
+        np.testing.assert_array_equal(halton, c_d.sample_workspace('3d', 512, 9, rng=3, sampling='halton', **params))
+        self.assertTrue(set(np.unique(np.abs(halton[:, [0, 8], 1:]))) <= {0., 0.4, 1.})  # extrema are kept
+        for axis in range(3):
+            self.assertGreaterEqual(halton[:, :, axis].min(), random[:, :, axis].min() - 0.05)
+            self.assertLessEqual(halton[:, :, axis].max(), random[:, :, axis].max() + 0.05)
+        self.assertTrue(set(np.unique(np.round(halton[:, :, 0] - c_d.sample_workspace(
+            '2d', 512, 9, rng=3, sampling='halton', **{k: v for k, v in params.items() if k != 'stride'})[:, :, 0],
+            9))) <= {-0.5, 0., 0.5})
+        n_dims = q_u.count_dimensions(lambda counter: c_d.sample_workspace('2d', 1, 9, rng=counter, y_length=0.4,
+                                                                            z_length=1, radius=2, sample=True))
+        self.assertEqual(n_dims, 13)
+        rng = np.random.default_rng(0)
+        self.assertLess(q_u.centered_discrepancy(q_u.unit_draws(rng, 256, n_dims, 'halton')),
+                        q_u.centered_discrepancy(q_u.unit_draws(rng, 256, n_dims, 'random')))
+        with self.assertRaises(ValueError):
+            c_d.sample_workspace('theta', 10, 9, length=0.4, radius=2, sample=True, sampling='grid')
+        try:
+            import scipy.stats  # noqa: F401
+        except ImportError:
+            with self.assertRaises(ImportError):
+                c_d.sample_workspace('theta', 10, 9, length=0.4, radius=2, sample=True, sampling='sobol')
+        else:
+            sobol = c_d.sample_workspace('theta', 10, 9, length=0.4, radius=2, sample=True, sampling='sobol')
+            self.assertEqual(sobol.shape, (10, 9, 3))
+
+    def test_density_rendering(self):
+        import matplotlib.pyplot as plt
+        commands = c_d.sample_workspace('3d', 2000, 9, rng=4, stride=0.5, y_length=0.4, z_length=1, radius=2,
+                                        sample=True)
+        grid = sp_u.density_grid(commands, bins=(16, 8, 8), max_outlier_count=40, max_outliers=50)
+        counts, _ = np.histogramdd(commands.reshape(-1, 3), bins=(16, 8, 8), range=grid.bounds)
+        np.testing.assert_array_equal(grid.counts, counts)
+        self.assertEqual(grid.n_points, 18000)
+        self.assertLessEqual(len(grid.outliers), 50)
+        self.assertTrue(0 < len(grid.outliers) and np.all(grid.counts_at(grid.outliers) <= 40))
+        np.testing.assert_array_equal(grid.projection((0, 2)), counts.sum(axis=1))
+        streamed = sp_u.DensityGrid(grid.bounds, bins=(16, 8, 8))
+        for block in np.array_split(commands, 7):
+            streamed.update(block)
+        np.testing.assert_array_equal(streamed.counts, grid.counts)
+        centres, occupied = grid.occupied()
+        self.assertEqual(occupied.sum(), 18000)
+        self.assertTrue(np.all(grid.counts_at(centres) == occupied))
+        backend = plt.get_backend()
+        plt.switch_backend('Agg')
+        try:
+            fig = plt.figure()
+            ax = fig.add_subplot(1, 1, 1, projection='3d')
+            c_d.func_viz_density(fig, ax, grid)
+            self.assertEqual(len(ax.collections), 3)
+            c_d.func_viz_sample(fig, fig.add_subplot(1, 2, 1, projection='3d'), commands)
+            c_d.func_viz_projections(plt.figure(), grid)
+        finally:
+            plt.close('all')
+            plt.switch_backend(backend)
+        with self.assertRaises(ValueError):
+            c_d.visualize_commands(commands, render='projections', animate=True, headless=True)
+        with self.assertRaises(ValueError):
+            RS(render='density')
+        for kind, params in (('theta', {'length': 0.4}),
+                             ('phi', {'length': 0.3}),
+                             ('2d', {'y_length': 0.4, 'z_length': 1}),
+                             ('3d', {'stride': 0.5, 'y_length': 0.4, 'z_length': 1})):
+            params = dict(params, radius=2, sample=True)
+            density = sp_u.DensityGrid(reach_sample._density_bounds(kind, params))
+            self.assertEqual(density.update(c_d.sample_workspace(kind, 2000, 9, rng=5, **params)).n_outside, 0)
+            self.assertLess(np.ptp(density.bounds[0]), 2 * 2)
+
 
 if __name__ == "__main__":
     unittest.main()
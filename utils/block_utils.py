@@ -0,0 +1,134 @@
+""" Typed container for ReachMaster command schedules. A CommandBlock is a single contiguous numpy array of shape
+    (n_trials, n_positions, 3), in float64 or float32, that carries the command type, coordinate space, units and
+    seed it was generated with. Because it is an ndarray, every sampler, exporter, statistics and plotting function
+    accepts it directly, and trial slices and coordinate columns are views rather than copies. For use with the
+    ReachSample software. """
+import numpy as np
+import utils.command_utils as c_d
+
+SPACES = ('euclidean', 'robot')
+SPACE_COLUMNS = {'euclidean': ('x', 'y', 'z'), 'robot': ('r', 'thetay', 'thetaz')}
+SPACE_UNITS = {'euclidean': ('cm', 'cm', 'cm'), 'robot': ('mm', 'deg', 'deg')}
+BLOCK_DTYPES = (np.float64, np.float32)
+
+
+class CommandBlock(np.ndarray):
+    """ Command schedule of shape (n_trials, n_positions, 3) with metadata: kind ('theta', 'phi', '2d', '3d' or any
+        label), space ('euclidean' for x, y, z positions in cm or 'robot' for r, thetay, thetaz commands in mm and
+        degrees), units and seed. Indexing by trial (block[10:20], block[mask]) or by trial and position
+        (block[:, 2:5]) returns a CommandBlock view with the same metadata; x, y, z (or r, thetay, thetaz for robot
+        blocks) are zero-copy column views. Any result that is not an (n_trials, n_positions, 3) schedule, such as
+        block[0], block[:, 0], block.mean(axis=0) or block.reshape(-1, 3), is returned as a plain array. """
+
+    def __new__(cls, commands, kind=None, space='euclidean', units=None, seed=None, dtype=None):
+        if space not in SPACES:
+            raise ValueError('Unknown command space ' + str(space) + ', expected one of ' + str(SPACES))
+        array = np.asarray(commands, dtype=dtype)
+        if array.dtype not in BLOCK_DTYPES:
+            array = array.astype(np.float64)
+        if array.ndim != 3 or array.shape[-1] != 3:
+            raise ValueError('Commands must have shape (n_trials, n_positions, 3), got ' + str(array.shape))
+        block = np.ascontiguousarray(array).view(cls)
+        block.kind, block.space, block.seed = kind, space, seed
+        block.units = tuple(units) if units else SPACE_UNITS[space]
+        return block
+
+    def __array_finalize__(self, obj):
+        self.kind = getattr(obj, 'kind', None)
+        self.space = getattr(obj, 'space', 'euclidean')
+        self.units = getattr(obj, 'units', SPACE_UNITS['euclidean'])
+        self.seed = getattr(obj, 'seed', None)
+
+    def __array_wrap__(self, array, context=None, return_scalar=False):
+        if array.ndim != 3 or array.shape[-1] != 3:  # reductions and per-coordinate results are plain arrays
+            array = array.view(np.ndarray)
+            return array[()] if return_scalar else array
+        return super().__array_wrap__(array, context, return_scalar)
+
+    def __getitem__(self, key):
+        result = super().__getitem__(key)
+        indexes_coordinates = isinstance(key, tuple) and (len(key) > 2 or any(k is Ellipsis for k in key))
+        if isinstance(result, CommandBlock) and (result.ndim != 3 or result.shape[-1] != 3 or indexes_coordinates):
+            return result.view(np.ndarray)  # drops the trial or position axis, or indexes the coordinate axis
+        return result
+
+    def reshape(self, *shape, **kwargs):
+        result = super().reshape(*shape, **kwargs)
+        return result if result.ndim == 3 and result.shape[-1] == 3 else result.view(np.ndarray)
+
+    def ravel(self, order='C'):
+        return self.view(np.ndarray).ravel(order)
+
+    def __reduce__(self):
+        reconstruct, arguments, state = super().__reduce__()
+        return reconstruct, arguments, (state, (self.kind, self.space, self.units, self.seed))
+
+    def __setstate__(self, state):
+        array_state, (self.kind, self.space, self.units, self.seed) = state
+        super().__setstate__(array_state)
+
+    @property
+    def n_trials(self):
+        return self.shape[0]
+
+    @property
+    def n_positions(self):
+        return self.shape[1]
+
+    def column(self, name):
+        """ Zero-copy (n_trials, n_positions) view of one coordinate, named as in SPACE_COLUMNS for the block space."""
+        columns = SPACE_COLUMNS[self.space]
+        if name not in columns:
+            raise ValueError('A ' + self.space + ' block holds ' + ', '.join(columns) + ' columns, not ' + str(name))
+        return self.view(np.ndarray)[..., columns.index(name)]
+
+    x = property(lambda self: self.column('x'))
+    y = property(lambda self: self.column('y'))
+    z = property(lambda self: self.column('z'))
+    r = property(lambda self: self.column('r'))
+    thetay = property(lambda self: self.column('thetay'))
+    thetaz = property(lambda self: self.column('thetaz'))
+
+    def points(self):
+        """ Zero-copy (n_trials * n_positions, 3) view of every command. """
+        return self.view(np.ndarray).reshape(-1, 3)
+
+    def to_robot(self):
+        """ Returns the r, thetay, thetaz robot commands (mm, degrees) of a euclidean block as a new robot-space block
+            of the same dtype (see utils.command_utils.euclidean_to_robot). Robot blocks are returned unchanged. """
+        if self.space == 'robot':
+            return self
+        robot = CommandBlock(np.empty(self.shape, dtype=self.dtype), kind=self.kind, space='robot', seed=self.seed)
+        c_d.euclidean_to_robot(self.points(), out=robot.points())
+        return robot
+
+    def to_euclidean(self):
+        """ Returns the x, y, z positions (cm) of a robot block as a new euclidean block of the same dtype (see
+            utils.command_utils.robot_to_euclidean). Euclidean blocks are returned unchanged. """
+        if self.space == 'euclidean':
+            return self
+        euclidean = CommandBlock(np.empty(self.shape, dtype=self.dtype), kind=self.kind, seed=self.seed)
+        c_d.robot_to_euclidean(self.points(), out=euclidean.points())
+        return euclidean
+
+    def metadata(self):
+        """ JSON-serializable description of the block. """
+        seed = self.seed
+        if isinstance(seed, np.random.SeedSequence):
+            seed = {'entropy': seed.entropy, 'spawn_key': list(seed.spawn_key)}
+        return {'kind': self.kind, 'space': self.space, 'units': list(self.units), 'seed': seed,
+                'dtype': self.dtype.name, 'shape': list(self.shape)}
+
+
+def as_block(commands, kind=None, dtype=None, seed=None):
+    """ Wraps x, y, z commands as a euclidean CommandBlock, without copying when they are already contiguous and of the
+        requested dtype. Blocks keep their own metadata unless kind or seed are given. """
+    if isinstance(commands, CommandBlock):
+        block = commands if dtype is None or commands.dtype == dtype else commands.astype(dtype)
+    else:
+        block = CommandBlock(commands, kind=kind, seed=seed, dtype=dtype)
+    if kind is not None:
+        block.kind = kind
+    if seed is not None:
+        block.seed = seed
+    return block
@@ -0,0 +1,130 @@
+""" Checkpointed schedule exports for ReachMaster. A schedule is generated and exported one chunk of trials at a time,
+    chunk i always drawing from the i-th stream spawned from the root seed (see utils.parallel_utils). After every
+    chunk the outputs are flushed and a small JSON checkpoint records the seed, the chunks done and the byte offset
+    reached in each file. An interrupted export therefore resumes from its last finished chunk, truncating anything
+    written after it, and produces exactly the files an uninterrupted run would. The checkpoint is kept once the export
+    completes, so more trials can later be appended: they continue the chunk streams of the same seed and sampler
+    parameters, and only the new data is written. For use with the ReachSample software. """
+import json
+import os
+import tempfile
+import numpy as np
+import utils.block_utils as bu
+import utils.export_utils as ex
+import utils.instrument_utils as iu
+import utils.parallel_utils as pu
+
+CHECKPOINT_SUFFIX = '.checkpoint.json'
+CHECKPOINT_VERSION = 1
+RESUMABLE_FORMATS = ('csv', 'npy', 'store')
+
+
+def checkpoint_filename(filename):
+    """ Returns the checkpoint kept beside an export filename. """
+    return str(filename) + CHECKPOINT_SUFFIX
+
+
+def load_checkpoint(filename):
+    """ Returns the checkpoint of an export, or None when it has none. """
+    try:
+        with open(checkpoint_filename(filename)) as checkpoint_file:
+            return json.load(checkpoint_file)
+    except FileNotFoundError:
+        return None
+
+
+def _write_checkpoint(filename, checkpoint):
+    """ Atomically replaces the checkpoint of an export through a uniquely named temporary file in the same directory,
+        so concurrent writers never share one. """
+    handle, tmp_file = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(checkpoint_filename(filename)) or '.')
+    try:
+        with os.fdopen(handle, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file, indent=2)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(tmp_file, checkpoint_filename(filename))
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def _seed_to_json(seed):
+    seed = pu.root_seed_sequence(seed)
+    return {'entropy': seed.entropy, 'spawn_key': list(seed.spawn_key)}
+
+
+def _seed_from_json(seed):
+    return np.random.SeedSequence(seed['entropy'], spawn_key=tuple(seed['spawn_key']))
+
+
+def _run(filename, checkpoint, n_trials, instrumentation):
+    """ Generates and exports chunks until the export holds n_trials trials, checkpointing after every chunk. """
+    instrumentation = iu.get_instrumentation(instrumentation)
+    chunk_trials, n_positions = checkpoint['chunk_trials'], checkpoint['n_positions']
+    remaining = n_trials - checkpoint['n_trials_done']
+    sizes = [size for _, size in pu.schedule_chunks(remaining, chunk_trials)]
+    seeds = pu.chunk_seed_sequences(_seed_from_json(checkpoint['seed']), checkpoint['n_chunks'] + len(sizes))
+    progress = checkpoint['progress'] if checkpoint['n_trials_done'] else None
+    checkpoint.update(n_trials=n_trials, status='running')
+    with ex.CommandExportWriter(filename, formats=checkpoint['formats'], chunk_trials=chunk_trials,
+                                instrumentation=instrumentation, resume=progress) as writer:
+        for size, seed_sequence in zip(sizes, seeds[checkpoint['n_chunks']:]):
+            with instrumentation.span('sample'):
+                commands = pu.generate_chunk(checkpoint['kind'], size, n_positions, seed_sequence,
+                                             checkpoint['params'])
+            instrumentation.count('points_generated', size * n_positions)
+            writer.write(bu.as_block(commands, kind=checkpoint['kind'], seed=seed_sequence))
+            checkpoint['progress'] = writer.flush()
+            checkpoint['n_chunks'] += 1
+            checkpoint['n_trials_done'] += size
+            _write_checkpoint(filename, checkpoint)
+    checkpoint['status'] = 'complete'  # closing only finalizes headers and sidecars, so the offsets still hold
+    _write_checkpoint(filename, checkpoint)
+    return checkpoint
+
+
+def export_schedule(kind, n_trials, n_positions, filename, seed=None, formats=('csv',),
+                    chunk_trials=pu.DEFAULT_CHUNK_TRIALS, resume=True, instrumentation=None, **params):
+    """ Generates a kind ('theta', 'phi', '2d' or '3d') schedule of n_trials trials straight to filename in the given
+        formats, checkpointing after every chunk of chunk_trials trials. The files are identical to exporting
+        utils.parallel_utils.generate_schedule with the same seed and chunk_trials. When an unfinished checkpoint
+        for filename exists and resume is set, the export continues from it (seed may then be omitted); a
+        checkpoint for different parameters raises ValueError. Keyword parameters go to the batched sampler.
+        Returns the final checkpoint. """
+    for fmt in formats:
+        if fmt not in RESUMABLE_FORMATS:
+            raise ValueError('Checkpointed exports support ' + str(RESUMABLE_FORMATS) + ', not ' + str(fmt))
+    checkpoint = load_checkpoint(filename) if resume else None
+    settings = {'kind': kind, 'n_positions': n_positions, 'chunk_trials': chunk_trials, 'formats': list(formats),
+                'params': params}
+    if checkpoint is not None:
+        recorded = {key: checkpoint[key] for key in settings}
+        if json.loads(json.dumps(settings)) != recorded or (seed is not None and
+                                                             _seed_to_json(seed) != checkpoint['seed']):
+            raise ValueError('The checkpoint of ' + str(filename) + ' was written for different parameters, ' +
+                             'export with resume=False to start over')
+        if checkpoint['status'] == 'complete':
+            if checkpoint['n_trials_done'] == n_trials:
+                return checkpoint
+            raise ValueError(str(filename) + ' already holds ' + str(checkpoint['n_trials_done']) +
+                             ' trials, use append_schedule to add trials')
+        if checkpoint['n_trials'] != n_trials:
+            raise ValueError(str(filename) + ' is an unfinished export of ' + str(checkpoint['n_trials']) +
+                             ' trials, resume it with n_trials=' + str(checkpoint['n_trials']) +
+                             ' (then use append_schedule to add trials) or export with resume=False to start over')
+        return _run(filename, checkpoint, n_trials, instrumentation)
+    checkpoint = dict(settings, version=CHECKPOINT_VERSION, seed=_seed_to_json(seed), n_trials=n_trials,
+                      n_trials_done=0, n_chunks=0, progress=None, status='running')
+    return _run(filename, checkpoint, n_trials, instrumentation)
+
+
+def append_schedule(filename, n_trials, instrumentation=None):
+    """ Appends n_trials trials to a completed checkpointed export, drawn with the same sampler parameters from the
+        chunk streams that follow those already used, and writing only the new data. Returns the checkpoint. """
+    checkpoint = load_checkpoint(filename)
+    if checkpoint is None:
+        raise ValueError(str(filename) + ' has no checkpoint; only checkpointed exports can be appended to')
+    if checkpoint['status'] != 'complete':
+        raise ValueError(str(filename) + ' is unfinished, resume it with export_schedule before appending')
+    return _run(filename, checkpoint, checkpoint['n_trials_done'] + n_trials, instrumentation)
@@ -1,36 +1,102 @@
 """ Functions intended to help replicate robot commands, create new robot commands for different experimental paradigms,
     and to visualize robot commands within the robot workspace. For use with the ReachSample software. Written B Nelson
     7/19/22, UC Berkeley"""
-import pandas as pd
+import functools
+import hashlib
+import os
+import tempfile
+import zipfile
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import animation
-import pdb
+import utils.qmc_utils as qu
+import utils.spatial_utils as sp
+
+COMMAND_CACHE_SUFFIX = '.cache.npz'
+ANIMATION_FRAMES = 360
+TEMPLATE_CACHE_SIZE = 128
+DEG_TO_RAD = np.pi / 180.
+RAD_TO_DEG = 180. / np.pi
+CM_TO_MM = 10.
+MM_TO_CM = .1
+KERNEL_CHUNK_ROWS = 65536
+RENDER_MODES = ('points', 'voxels', 'projections')
 
 # Public functions
 
 
-def read_command_file(filename):
-    """ Function to read robot command files using pandas.
+def read_command_file(filename, cache=True):
+    """ Function to read robot command files using pandas. The converted x, y, z positions are kept in a binary
+        sidecar cache (filename + '.cache.npz') which is reused until the command file's mtime and contents change.
     """
-    positions = pd.read_csv(filename)
-    x_3, y_3, z_3 = [], [], []
-    for index, row in positions.iterrows():
-        x, y, z = xform_coords_euclidean(row['r'], row['thetay'], row['thetaz'])
-        x_3.append(x)
-        y_3.append(y)
-        z_3.append(z)
-    _positions = np.vstack((x_3, y_3, z_3))
+    if cache:
+        _positions = _load_command_cache(filename)
+        if _positions is not None:
+            return _positions
+    import pandas as pd
+    commands = pd.read_csv(filename)[['r', 'thetay', 'thetaz']].to_numpy(dtype=float)
+    _positions = np.empty((3, commands.shape[0]))
+    robot_to_euclidean(commands, out=_positions.T)
+    if cache:
+        _write_command_cache(filename, _positions)
     return _positions
 
 
+def command_cache_filename(filename):
+    """ Returns the binary sidecar cache used by read_command_file for a given command file. """
+    return str(filename) + COMMAND_CACHE_SUFFIX
+
+
+def _hash_command_file(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as command_file:
+        for block in iter(lambda: command_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _load_command_cache(filename):
+    """ Returns cached positions for a command file, or None when the cache is missing, unreadable or stale. A cache
+        whose mtime no longer matches is still used (and refreshed) when the file contents hash the same. """
+    cache_file = command_cache_filename(filename)
+    try:
+        stat = os.stat(filename)
+        with np.load(cache_file) as cache:
+            positions, mtime_ns, size, sha256 = cache['positions'], int(cache['mtime_ns']), int(cache['size']), \
+                str(cache['sha256'])
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+    if size != stat.st_size:
+        return None
+    if mtime_ns != stat.st_mtime_ns:
+        if sha256 != _hash_command_file(filename):
+            return None
+        _write_command_cache(filename, positions, sha256=sha256)
+    return positions
+
+
+def _write_command_cache(filename, positions, sha256=None):
+    """ Atomically writes the sidecar cache for a command file through a uniquely named temporary file in the same
+        directory, so concurrent writers never share one. Caching is skipped if the directory is read-only. """
+    cache_file = command_cache_filename(filename)
+    tmp_file = None
+    try:
+        stat = os.stat(filename)
+        handle, tmp_file = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(cache_file) or '.')
+        with os.fdopen(handle, 'wb') as cache:
+            np.savez(cache, positions=positions, mtime_ns=stat.st_mtime_ns, size=stat.st_size,
+                     sha256=sha256 or _hash_command_file(filename))
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        if tmp_file is not None and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
 def xform_coords_euclidean(r, theta, phi):
     """ Transforms spherical-based robot commands (r, theta, phi) into euclidean-based coordinates. Used for
-        plotting workspaces in reach_sample.
+        plotting workspaces in reach_sample. See robot_to_euclidean for arrays of commands.
     """
-    x = r * np.cos(phi * (np.pi / 180.)) * np.cos(theta * (np.pi / 180.))
-    y = r * np.sin(theta * (np.pi / 180.)) * np.cos(phi * (np.pi / 180.))
-    z = r * np.sin(phi * (np.pi / 180.))
+    x = r * np.cos(phi * DEG_TO_RAD) * np.cos(theta * DEG_TO_RAD)
+    y = r * np.sin(theta * DEG_TO_RAD) * np.cos(phi * DEG_TO_RAD)
+    z = r * np.sin(phi * DEG_TO_RAD)
     x = .1 * x  # cm
     y = .1 * y  # cm
     z = .1 * z  # cm
@@ -45,6 +111,66 @@ def xform_coords_spherical(x, y, z):
     return r, theta, phi
 
 
+def _kernel_out(array, out):
+    """ Validates the (N, 3) input and output of a transform kernel, allocating the output when none is given. """
+    array = np.asarray(array)
+    if array.ndim != 2 or array.shape[1] != 3:
+        raise ValueError('Transform kernels take (N, 3) arrays, got shape ' + str(array.shape))
+    if out is None:
+        out = np.empty(array.shape, dtype=np.result_type(array.dtype, np.float32))
+    elif out.shape != array.shape:
+        raise ValueError('out must have shape ' + str(array.shape) + ', got ' + str(out.shape))
+    return array, out
+
+
+def euclidean_to_robot(points, out=None, degrees=True):
+    """ Transforms (N, 3) x, y, z positions (cm) into r, thetay, thetaz robot commands: r the path length in mm,
+        thetay the azimuth in the x-y plane and thetaz the elevation above it, in degrees (radians when degrees is
+        False). This is the inverse of robot_to_euclidean and of the command file convention read by
+        read_command_file. Results are written into out, which may be points itself, in chunks of KERNEL_CHUNK_ROWS
+        rows through one scratch buffer, so no temporaries scale with N. Returns out. """
+    points, out = _kernel_out(points, out)
+    scratch = np.empty((2, min(len(points), KERNEL_CHUNK_ROWS)), dtype=out.dtype)
+    for start in range(0, len(points), KERNEL_CHUNK_ROWS):
+        x, y, z = (points[start:start + KERNEL_CHUNK_ROWS, i] for i in range(3))
+        r, thetay, thetaz = (out[start:start + KERNEL_CHUNK_ROWS, i] for i in range(3))
+        rho, length = scratch[0, :len(x)], scratch[1, :len(x)]
+        np.hypot(x, y, out=rho)
+        np.hypot(rho, z, out=length)
+        np.arctan2(y, x, out=thetay)  # the inputs of each step are read before out (which may alias them) is written
+        np.arctan2(z, rho, out=thetaz)
+        np.multiply(length, CM_TO_MM, out=r)
+        if degrees:
+            thetay *= RAD_TO_DEG
+            thetaz *= RAD_TO_DEG
+    return out
+
+
+def robot_to_euclidean(commands, out=None, degrees=True):
+    """ Transforms (N, 3) r, thetay, thetaz robot commands (mm, degrees or radians when degrees is False) into x, y, z
+        positions in cm, as xform_coords_euclidean does for single commands. Results are written into out, which may
+        be commands itself, chunk by chunk through one scratch buffer. Returns out. """
+    commands, out = _kernel_out(commands, out)
+    scratch = np.empty((2, min(len(commands), KERNEL_CHUNK_ROWS)), dtype=out.dtype)
+    for start in range(0, len(commands), KERNEL_CHUNK_ROWS):
+        r, thetay, thetaz = (commands[start:start + KERNEL_CHUNK_ROWS, i] for i in range(3))
+        x, y, z = (out[start:start + KERNEL_CHUNK_ROWS, i] for i in range(3))
+        azimuth, elevation = scratch[0, :len(r)], scratch[1, :len(r)]
+        np.multiply(thetay, DEG_TO_RAD if degrees else 1., out=azimuth)
+        np.multiply(thetaz, DEG_TO_RAD if degrees else 1., out=elevation)
+        np.cos(elevation, out=y)  # y holds the x-y plane radius until x is known
+        y *= r
+        y *= MM_TO_CM
+        np.sin(elevation, out=z)
+        z *= r
+        z *= MM_TO_CM
+        np.cos(azimuth, out=x)
+        x *= y
+        np.sin(azimuth, out=elevation)
+        y *= elevation
+    return out
+
+
 def euclidean_distance_from_reaching_start(x, y, z):
     """ Determines the euclidean distance from the tentative center of reaching area.
     """
@@ -72,63 +198,31 @@ def initialize_commands_pilot():
     return np.vstack((zero_mm, ten_mm, twenty_mm, thirty_mm, forty_mm, pilot_3d_positions)).reshape((6, 3, 9))
 
 
-def get_2d_commands(z_length, y_length, radius, n_positions, n_trials, sample=False, extrema=True):
+def get_rng(seed=None):
+    """ Returns a numpy Generator for the batched samplers. Accepts None, an integer seed, a SeedSequence or an existing
+        Generator (which is returned unchanged so that successive calls share one stream). Quasi-random draws (see
+        utils.qmc_utils) are also returned unchanged. """
+    if isinstance(seed, (np.random.Generator, qu.QuasiRandomDraws, qu.DimensionCounter)):
+        return seed
+    return np.random.default_rng(seed)
+
+
+def get_2d_commands(z_length, y_length, radius, n_positions, n_trials, sample=False, extrema=True, rng=None,
+                    sampling='random'):
     """ Function that obtains trial-on-trial ReachMaster command positions for the 2-D spatial dimension of task.
         This function either a) structures points in a symmetric (about x) manner or b) uses randomization to subsample
         points within a given 2-D space. Sub-sampling may either include consistent extrema or none at all. """
-    command_positions_2d = np.zeros((n_trials, n_positions, 3))
-    if sample:
-        for i in range(0, n_trials):  #
-            if extrema:
-                phi_command = obtain_single_phi_command(z_length, radius, n_positions, sample=True)
-                theta_command = obtain_single_theta_command(y_length, radius, n_positions, sample=True)
-            else:
-                phi_command = obtain_single_phi_command(z_length, radius, n_positions, sample=True, extrema=False)
-                theta_command = obtain_single_theta_command(y_length, radius, n_positions, sample=True, extrema=False)
-            s = np.random.binomial(1, 0.5, 1)
-            if s < 1:  # odd split theta, even split phi
-                command_positions_2d[i, ::1, :] = theta_command[::1, :]
-                command_positions_2d[i, ::2, :] = phi_command[::2, :]
-            else:  # even split theta, odd split phi
-                command_positions_2d[i, ::1, :] = phi_command[::1, :]
-                command_positions_2d[i, ::2, :] = theta_command[::2, :]
-    else:
-        phi_command = obtain_single_phi_command(z_length, radius, n_positions)
-        theta_command = obtain_single_phi_command(y_length, radius, n_positions)
-        for i in range(0, n_trials):
-            s = np.random.binomial(1, 0.5, 1)  # draw from binomial distribution
-            if s < 1:  # odd split theta, even split phi
-                command_positions_2d[i, ::1, :] = theta_command[::1, :]
-                command_positions_2d[i, ::2, :] = phi_command[::2, :]
-            else:  # even split theta, odd split phi
-                command_positions_2d[i, ::1, :] = phi_command[::1, :]
-                command_positions_2d[i, ::2, :] = theta_command[::2, :]
-    return command_positions_2d
-
-
-def sample_3d_structure(stride, y_length, z_length,  radius, n_positions, n_trials, sample=False, extrema=True):
+    return batch_2d_commands(z_length, y_length, radius, n_trials, n_positions, sample=sample, extrema=extrema,
+                             rng=rng, sampling=sampling)
+
+
+def sample_3d_structure(stride, y_length, z_length,  radius, n_positions, n_trials, sample=False, extrema=True,
+                        rng=None, sampling='random'):
     """ Function to sample 2-D positional commands in a stride-based symmetric manner. This function requires
         pre-defined x,y,z lengths (stride is the x-length), radius of circle around reaching position, the
         number of positions and number of trials to sample commands over. """
-    commands_3d = np.zeros((n_trials, n_positions, 3))
-    commands_2d = get_2d_commands(z_length, y_length, radius, n_positions, n_trials, sample=sample, extrema=extrema)
-    for l in range(0, n_trials):
-        for ir in range(0, n_positions):
-            choose_axis = np.random.multinomial(1, [1.0 / 3, 1.0 / 3, 1.0 / 3], size=1)
-            #pdb.set_trace()
-            if choose_axis[0, 0] == 1:  # Take selected component stride in +x direction
-                commands_3d[l, ir, 1] = commands_2d[l, ir, 1]
-                commands_3d[l, ir, 2] = commands_2d[l, ir, 2]
-                commands_3d[l, ir, 0] = commands_2d[l, ir, 0] + stride
-            if choose_axis[0, 1] == 1:
-                commands_3d[l, ir, 1] = commands_2d[l, ir, 1]
-                commands_3d[l, ir, 2] = commands_2d[l, ir, 2]
-                commands_3d[l, ir, :] = commands_2d[l, ir, :]
-            if choose_axis[0, 2] == 1:
-                commands_3d[l, ir, 1] = commands_2d[l, ir, 1]
-                commands_3d[l, ir, 2] = commands_2d[l, ir, 2]
-                commands_3d[l, ir, 0] = commands_2d[l, ir, 0] - stride
-    return commands_3d
+    return batch_3d_commands(stride, y_length, z_length, radius, n_trials, n_positions, sample=sample,
+                             extrema=extrema, rng=rng, sampling=sampling)
 
 
 def rand_sample_circle(y_array, radius, n_positions=9):
@@ -187,24 +281,203 @@ def obtain_single_phi_command(length, radius, n_positions, sample=False, extrema
     return np.vstack((x_positions, y_positions, z_positions)).T
 
 
-def sample_theta_commands(length, radius, n_trials, n_positions, extrema=True):
+def sample_theta_commands(length, radius, n_trials, n_positions, extrema=True, rng=None):
     """ Get randomized position commands for theta (1-D) over n trials. Can leave the ends (extrema=True). """
-    theta_commands = np.zeros((n_trials, n_positions, 3))
-    for i in range(0, n_trials):
-        theta_commands[i, :, :] = obtain_single_theta_command(length, radius, n_positions, sample=extrema)
-    return theta_commands
+    return batch_theta_commands(length, radius, n_trials, n_positions, sample=extrema, rng=rng)
 
 
-def sample_phi_commands(length, radius, n_positions, n_trials, extrema=True):
+def sample_phi_commands(length, radius, n_positions, n_trials, extrema=True, rng=None):
     """ Get randomized position commands for phi (1-D) over n trials. Can leave the ends (extrema=True). """
-    phi_commands = np.zeros((n_trials, n_positions, 3))
-    for i in range(0, n_trials):
-        phi_commands[i, :, :] = obtain_single_phi_command(length, radius, n_positions, sample=extrema)
-    return phi_commands
+    return batch_phi_commands(length, radius, n_trials, n_positions, sample=extrema, rng=rng)
+
+
+# Batched sampling engine. Each function below draws every trial of a schedule in a single array operation and
+# returns the same (n_trials, n_positions, 3) layout as the per-trial functions above.
+
+
+def _sampling_rng(rng, sampling, n_trials, sampler):
+    """ Returns the draws of a batched sampler: the Generator for 'random' sampling, or scrambled 'halton' or 'sobol'
+        quasi-random draws over its n_trials trials (see utils.qmc_utils). sampler(rng) draws a single trial, and is
+        run once to count the dimensions a Sobol point set needs. Quasi-random draws passed in by an enclosing sampler
+        are used as they are. """
+    rng = get_rng(rng)
+    if sampling == 'random' or not isinstance(rng, np.random.Generator):
+        return rng
+    n_dims = qu.count_dimensions(sampler) if sampling == 'sobol' else None
+    return qu.QuasiRandomDraws(rng, n_trials, sampling, n_dims=n_dims)
+
+
+def _uniform(rng, low, high, size):
+    """ Uniform draw between low and high in either order, matching np.random.uniform (Generator.uniform rejects
+        high < low, which the theta and phi ranges rely on). """
+    return low + (high - low) * rng.random(size)
+
+
+@functools.lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def command_template(kind, length, radius, n_positions):
+    """ Returns the deterministic (non-sampled) single-trial command of a 'theta' or 'phi' workspace, (n_positions, 3).
+        Templates are pure functions of their parameters and are kept in a bounded LRU cache (see
+        template_cache_info), so repeated deterministic schedules skip recomputing them. The returned array is
+        read-only because it is shared between callers. """
+    if kind == 'theta':
+        template = obtain_single_theta_command(length, radius, n_positions)
+    elif kind == 'phi':
+        template = obtain_single_phi_command(length, radius, n_positions)
+    else:
+        raise ValueError('Command templates exist for theta and phi workspaces only, not ' + str(kind))
+    template.setflags(write=False)
+    return template
+
+
+def template_cache_info():
+    """ Hit, miss, size and capacity statistics of the command template cache. """
+    return command_template.cache_info()
+
+
+def clear_template_cache():
+    """ Empties the command template cache and resets its statistics. """
+    command_template.cache_clear()
+
+
+def _tile_template(template, n_trials):
+    """ Writable (n_trials, n_positions, 3) schedule repeating template in every trial. """
+    return np.broadcast_to(template, (n_trials,) + template.shape).copy()
+
+
+def _interleave_planes(theta_commands, phi_commands, theta_odd):
+    """ Builds 2-D trials from theta and phi commands with one vectorized parity mask. Trials where theta_odd is set
+        take phi commands at even positions and theta commands at odd ones; the other trials take the reverse. """
+    even = (np.arange(theta_commands.shape[-2]) % 2 == 0)
+    from_phi = (even == theta_odd[:, None])[:, :, None]
+    return np.where(from_phi, phi_commands, theta_commands)
+
+
+def batch_theta_commands(length, radius, n_trials, n_positions, sample=True, extrema=True, rng=None,
+                         sampling='random'):
+    """ Vectorized counterpart of obtain_single_theta_command. Draws all n_trials theta (y-plane) commands at once
+        from a seedable numpy Generator, or from a scrambled quasi-random sequence over trials when sampling is
+        'halton' or 'sobol'. """
+    rng = get_rng(rng)
+    if not sample:
+        return _tile_template(command_template('theta', float(length), float(radius), int(n_positions)), n_trials)
+    rng = _sampling_rng(rng, sampling, n_trials, lambda counter: batch_theta_commands(
+        length, radius, 1, n_positions, sample=sample, extrema=extrema, rng=counter))
+    mid = int((n_positions - 1) / 2)
+    commands = np.zeros((n_trials, n_positions, 3))
+    y_positions = commands[:, :, 1]
+    if extrema:
+        y_positions[:, 0] = length
+        y_positions[:, n_positions - 1] = -1 * length
+        y_positions[:, 1:mid] = _uniform(rng, length - (length / 16), 0 + (length / 16), y_positions[:, 1:mid].shape)
+        y_positions[:, mid + 1:n_positions - 1] = _uniform(rng, 0 - (length / 16), -1 * length + (length / 16),
+                                                              y_positions[:, mid + 1:n_positions - 1].shape)
+    else:
+        y_positions[:, 0:mid] = _uniform(rng, length - (length / 16 * 2), 0 + (length / 16 * 2),
+                                            y_positions[:, 0:mid].shape)
+        y_positions[:, mid + 1:n_positions] = _uniform(rng, 0 - (length / 16 * 2), -1 * length + (length / 16 * 2),
+                                                          y_positions[:, mid + 1:n_positions].shape)
+    commands[:, :, 0] = circle_variablerad_xdim(y_positions, radius)
+    return commands
+
+
+def batch_phi_commands(length, radius, n_trials, n_positions, sample=True, rng=None, sampling='random'):
+    """ Vectorized counterpart of obtain_single_phi_command. Draws all n_trials phi (z-plane) commands at once
+        from a seedable numpy Generator, or from a scrambled quasi-random sequence over trials when sampling is
+        'halton' or 'sobol'. """
+    rng = get_rng(rng)
+    if not sample:
+        return _tile_template(command_template('phi', float(length), float(radius), int(n_positions)), n_trials)
+    rng = _sampling_rng(rng, sampling, n_trials, lambda counter: batch_phi_commands(
+        length, radius, 1, n_positions, sample=sample, rng=counter))
+    mid = int((n_positions - 1) / 2)
+    commands = np.zeros((n_trials, n_positions, 3))
+    z_positions = commands[:, :, 2]
+    z_positions[:, 0] = length
+    z_positions[:, n_positions - 1] = -1 * length
+    z_positions[:, 1:mid] = _uniform(rng, length - (length / 16), 0, z_positions[:, 1:mid].shape)
+    z_positions[:, mid + 1:n_positions - 1] = _uniform(rng, -1 * length + (length / 16), 0,
+                                                          z_positions[:, mid + 1:n_positions - 1].shape)
+    commands[:, :, 0] = circle_variablerad_xdim(z_positions, radius)
+    return commands
+
+
+def batch_2d_commands(z_length, y_length, radius, n_trials, n_positions, sample=False, extrema=True, rng=None,
+                      sampling='random'):
+    """ Vectorized counterpart of get_2d_commands. Theta and phi commands are drawn for every trial at once, then
+        interleaved using one binomial draw per trial to select which plane takes the even positions. Deterministic
+        schedules broadcast the two cached single-trial templates instead of materializing full theta and phi
+        schedules. With 'halton' or 'sobol' sampling every draw of a trial comes from one quasi-random point. """
+    rng = _sampling_rng(rng, sampling, n_trials, lambda counter: batch_2d_commands(
+        z_length, y_length, radius, 1, n_positions, sample=sample, extrema=extrema, rng=counter))
+    if sample:
+        phi_commands = batch_phi_commands(z_length, radius, n_trials, n_positions, sample=True, rng=rng)
+        theta_commands = batch_theta_commands(y_length, radius, n_trials, n_positions, sample=True, extrema=extrema,
+                                              rng=rng)
+    else:  # the deterministic structure uses the phi line for both planes, as in the per-trial implementation
+        phi_commands = command_template('phi', float(z_length), float(radius), int(n_positions))
+        theta_commands = command_template('phi', float(y_length), float(radius), int(n_positions))
+    s = rng.binomial(1, 0.5, n_trials)
+    return _interleave_planes(theta_commands, phi_commands, s < 1)  # odd split theta, even split phi
+
+
+def batch_3d_commands(stride, y_length, z_length, radius, n_trials, n_positions, sample=False, extrema=True,
+                      rng=None, sampling='random'):
+    """ Vectorized counterpart of sample_3d_structure. Each position of a 2-D schedule is shifted by +stride, 0 or
+        -stride along x with equal probability, using a single integer draw for the whole schedule. With 'halton' or
+        'sobol' sampling every draw of a trial comes from one quasi-random point. """
+    rng = _sampling_rng(rng, sampling, n_trials, lambda counter: batch_3d_commands(
+        stride, y_length, z_length, radius, 1, n_positions, sample=sample, extrema=extrema, rng=counter))
+    commands = batch_2d_commands(z_length, y_length, radius, n_trials, n_positions, sample=sample, extrema=extrema,
+                                 rng=rng)
+    choose_axis = rng.integers(0, 3, (n_trials, n_positions))  # 0: +x stride, 1: no stride, 2: -x stride
+    commands[:, :, 0] += stride * (1 - choose_axis)
+    return commands
+
+
+WORKSPACE_SAMPLERS = {'theta': batch_theta_commands, 'phi': batch_phi_commands, '2d': batch_2d_commands,
+                      '3d': batch_3d_commands}
+
+
+def sample_workspace(kind, n_trials, n_positions, rng=None, min_separation=None, max_rounds=100, **params):
+    """ Draws n_trials of a kind ('theta', 'phi', '2d' or '3d') workspace with the matching batched sampler. When
+        min_separation (cm) is given, trials holding two positions closer than min_separation are found with a
+        spatial hash and redrawn until every trial satisfies the constraint. A ValueError is raised when max_rounds
+        of redraws are not enough, e.g. because the deterministic structure itself violates the constraint. """
+    if kind not in WORKSPACE_SAMPLERS:
+        raise ValueError('Unknown workspace kind ' + str(kind) + ', expected one of ' + str(list(WORKSPACE_SAMPLERS)))
+    sampler = WORKSPACE_SAMPLERS[kind]
+    rng = get_rng(rng)
+    commands = sampler(n_trials=n_trials, n_positions=n_positions, rng=rng, **params)
+    if not min_separation:
+        return commands
+    pending = sp.close_trials(commands, min_separation)
+    for _ in range(max_rounds):
+        if not pending.size:
+            return commands
+        redrawn = sampler(n_trials=pending.size, n_positions=n_positions, rng=rng, **params)
+        commands[pending] = redrawn
+        pending = pending[sp.close_trials(redrawn, min_separation)]
+    if pending.size:
+        raise ValueError(str(pending.size) + ' trials still contain positions closer than ' + str(min_separation) +
+                         ' after ' + str(max_rounds) + ' redraws.')
+    return commands
+
+
+def iter_workspace_blocks(kind, n_trials, n_positions, block_size=10000, rng=None, **params):
+    """ Generator yielding a kind ('theta', 'phi', '2d' or '3d') workspace schedule lazily, in blocks of at most
+        block_size trials of size block_trials, n_positions, 3. Keyword parameters are passed to sample_workspace
+        (e.g. length, radius and sample for 'theta', or min_separation). All blocks are drawn from one Generator
+        stream. """
+    if kind not in WORKSPACE_SAMPLERS:
+        raise ValueError('Unknown workspace kind ' + str(kind) + ', expected one of ' + str(list(WORKSPACE_SAMPLERS)))
+    rng = get_rng(rng)
+    for start in range(0, n_trials, block_size):
+        yield sample_workspace(kind, min(block_size, n_trials - start), n_positions, rng=rng, **params)
 
 
 def make_plot_pilot(fig, ax, pilot_command_positions):
     """ Plotting function, typeset for pilot_command_positions. """
+    import matplotlib.pyplot as plt
     ax.scatter(pilot_command_positions[5, 0, :], pilot_command_positions[5, 1, :], pilot_command_positions[5, 2, :],
                color='r', label='3D Cone')
     ax.scatter(pilot_command_positions[1, 0, :], pilot_command_positions[1, 1, :], pilot_command_positions[1, 2, :],
@@ -229,8 +502,18 @@ def animate_a(ax, fig, i):
     return fig,
 
 
-def create_pilot_visualizations(pilot_command_positions, make_gif_animation=True):
-    """ This function visualizes the 3-D workspace of ReachMaster's pilot experiments. """
+def create_pilot_visualizations(pilot_command_positions, make_gif_animation=True, headless=False, n_workers=None):
+    """ This function visualizes the 3-D workspace of ReachMaster's pilot experiments. With headless=True nothing is
+        shown and the animation is rendered in parallel with the Agg backend (see utils.render_utils). """
+    import matplotlib.pyplot as plt
+    from matplotlib import animation
+    if headless:
+        if make_gif_animation:
+            from utils.render_utils import render_rotation
+            print('Rendering animation for pilot experiment workspace. ')
+            return render_rotation(make_plot_pilot, pilot_command_positions, 'visualizations/pilot_animations.mp4',
+                                   n_workers=n_workers)
+        return
     fig = plt.figure(figsize=(10, 10))
     ax = fig.add_subplot(1, 1, 1, projection='3d', label='Reaching Volume Projection')
     ax.view_init(10, 80)
@@ -240,13 +523,14 @@ def create_pilot_visualizations(pilot_command_positions, make_gif_animation=True
     if make_gif_animation:
         print('Creating animation for pilot experiment workspace. ')
         anim = animation.FuncAnimation(fig, animate_a, init_func=make_plot_pilot(fig, ax, pilot_command_positions),
-                                       frames=360, interval=20, blit=True)
+                                       frames=ANIMATION_FRAMES, interval=20, blit=True)
         anim.save('visualizations/pilot_animations.mp4', fps=30, extra_args=['-vcodec', 'libx264'])
     return
 
 
 def func_viz(fig, ax, positions):
     """ Function to visualize command positions using the scatter command. Function scatters entire command vector."""
+    import matplotlib.pyplot as plt
     ax.scatter(positions[:, :, 0], positions[:, :, 1], positions[:, :, 2], c='r', label='Positions')
     ax.scatter(0.2, 0, 0, color='y', s=55, label='Origin')
     plt.plot(np.zeros(30), np.linspace(-0.4, 0.4, 30), np.zeros(30), color='k', label='Enclosure Entrance')
@@ -259,10 +543,12 @@ def func_viz(fig, ax, positions):
 
 def func_viz_sample(fig, ax, positions):
     """ Function to visualize randomly sampled command positions using the scatter command. Function scatters entire
-        command. """
-    for ir in range(1, positions.shape[0] - 1):
-        ax.scatter(positions[ir, :, 0], positions[ir, :, 1], positions[ir, :, 2])
-    ax.scatter(positions[0, :, 0], positions[0, :, 1], positions[0, :, 2], label='Positions')
+        command in a single call, each trial coloured from a ten-colour cycle. """
+    import matplotlib.pyplot as plt
+    positions = np.asarray(positions)
+    trial_colors = np.repeat(np.arange(positions.shape[0]) % 10, positions.shape[1])
+    ax.scatter(positions[:, :, 0].ravel(), positions[:, :, 1].ravel(), positions[:, :, 2].ravel(), c=trial_colors,
+               cmap='tab10', vmin=0, vmax=9, label='Positions')
     ax.scatter(2, 0, 0, color='y', s=55, label='Origin')
     plt.plot(np.zeros(30), np.linspace(-0.4, 0.4, 30), np.zeros(30), color='k', label='Enclosure Entrance')
     plt.legend()
@@ -272,46 +558,126 @@ def func_viz_sample(fig, ax, positions):
     return fig,
 
 
-def visualize_commands(commands, sample=False, animate=False, animate_filename=False):
+def command_density(commands, bins=sp.DENSITY_BINS, bounds=None, max_outlier_count=1,
+                    max_outliers=sp.DENSITY_MAX_OUTLIERS):
+    """ Bins command positions into a utils.spatial_utils.DensityGrid for func_viz_density and
+        func_viz_projections, keeping up to max_outliers positions from voxels holding at most max_outlier_count
+        positions. A DensityGrid is returned unchanged. """
+    if isinstance(commands, sp.DensityGrid):
+        return commands
+    return sp.density_grid(commands, bins=bins, bounds=bounds, max_outlier_count=max_outlier_count,
+                           max_outliers=max_outliers)
+
+
+def func_viz_density(fig, ax, density):
+    """ Function to visualize command positions as a voxel density: one marker per occupied voxel, coloured by the
+        log of its count, plus the sparse outlier positions, in two scatter calls whatever the number of positions.
+        density is a DensityGrid (see command_density) or the positions themselves. """
+    import matplotlib.pyplot as plt
+    density = command_density(density)
+    centres, counts = density.occupied()
+    voxels = ax.scatter(centres[:, 0], centres[:, 1], centres[:, 2], c=np.log10(counts), cmap='viridis', marker='s',
+                        s=max(2., 4000. / max(density.shape)), alpha=0.6, label='Position density')
+    if len(density.outliers):
+        ax.scatter(density.outliers[:, 0], density.outliers[:, 1], density.outliers[:, 2], color='r', s=4,
+                   label='Sparse positions')
+    ax.scatter(0.2, 0, 0, color='y', s=55, label='Origin')
+    plt.plot(np.zeros(30), np.linspace(-0.4, 0.4, 30), np.zeros(30), color='k', label='Enclosure Entrance')
+    fig.colorbar(voxels, ax=ax, shrink=0.6, pad=0.1, label='log10(positions per voxel)')
+    plt.legend()
+    ax.set_zlabel('Z (cm)')
+    ax.set_xlabel('X (cm)')
+    ax.set_ylabel('Y (cm)')
+    return fig,
+
+
+def func_viz_projections(fig, density):
+    """ Function to visualize command positions as x-y, x-z and y-z projection density images (log scale) with the
+        sparse outlier positions overlaid. density is a DensityGrid (see command_density) or the positions. """
+    from matplotlib.colors import LogNorm
+    density = command_density(density)
+    edges = density.edges
+    axes = fig.subplots(1, 3)
+    for ax, (first, second) in zip(axes, ((0, 1), (0, 2), (1, 2))):
+        projected = density.projection((first, second)).T.astype(float)
+        image = ax.imshow(np.where(projected > 0, projected, np.nan), origin='lower', aspect='auto', cmap='viridis',
+                          norm=LogNorm(vmin=1, vmax=max(1, projected.max())),
+                          extent=(edges[first][0], edges[first][-1], edges[second][0], edges[second][-1]))
+        if len(density.outliers):
+            ax.scatter(density.outliers[:, first], density.outliers[:, second], color='r', s=2)
+        ax.set_xlabel('XYZ'[first] + ' (cm)')
+        ax.set_ylabel('XYZ'[second] + ' (cm)')
+    fig.colorbar(image, ax=axes, shrink=0.8, label='positions per bin')
+    return fig,
+
+
+def visualize_commands(commands, sample=False, animate=False, animate_filename=False, headless=False,
+                       n_workers=None, render='points', bins=sp.DENSITY_BINS):
     """ Function to visualize incoming vector-based x,y, z commands. Function takes in vector size n_trials, n_positions, 3.
-        Function outputs matlab-based visualization of positions within ReachMaster's 3-D workspace. """
-    fig1 = plt.figure(figsize=(10, 10))
+        Function outputs matlab-based visualization of positions within ReachMaster's 3-D workspace. With headless=True
+        the figure is not shown and the animation is rendered in parallel with the Agg backend, as MP4 when ffmpeg is
+        available and GIF otherwise (see utils.render_utils). render is 'points' to scatter every position, or
+        'voxels' or 'projections' to draw a density grid of bins voxels per axis (see command_density), whose drawing
+        time and memory depend on the grid rather than the number of positions; commands may then also be a
+        DensityGrid. Projections are not animated. """
+    import matplotlib.pyplot as plt
+    from matplotlib import animation
+    if render not in RENDER_MODES:
+        raise ValueError('Unknown render mode ' + str(render) + ', expected one of ' + str(RENDER_MODES))
+    if render == 'projections' and animate:
+        raise ValueError('Projection renderings are not animated, use render="voxels" to animate a density grid')
+    plot_function = func_viz
+    if render != 'points':
+        commands, plot_function = command_density(commands, bins=bins), func_viz_density
+    if headless:
+        if animate:
+            from utils.render_utils import render_rotation
+            return render_rotation(plot_function, commands if render != 'points' else np.asarray(commands),
+                                   animate_filename or 'visualizations/default_animations.mp4',
+                                   frames=ANIMATION_FRAMES, n_workers=n_workers)
+        return
+    fig1 = plt.figure(figsize=(10, 10) if render != 'projections' else (18, 6))
+    if render == 'projections':
+        func_viz_projections(fig1, commands)
+        plt.show()
+        return
     ax1 = fig1.add_subplot(1, 1, 1, projection='3d', label='Reaching Volume Projection: Created Experiment')
-    if sample:
+    if sample and render == 'points':
         func_viz_sample(fig1, ax1, commands)
     else:
-        func_viz(fig1, ax1, commands)
+        plot_function(fig1, ax1, commands)
     plt.show()
     if animate:
-        anim = animation.FuncAnimation(fig1, animate_a, init_func=func_viz(fig1, ax1, commands), frames=360,
-                                       interval=20,
-                                       blit=True)
+        anim = animation.FuncAnimation(fig1, animate_a, init_func=plot_function(fig1, ax1, commands),
+                                       frames=ANIMATION_FRAMES, interval=20, blit=True)
         if animate_filename:
             anim.save(animate_filename, fps=30, extra_args=['-vcodec', 'libx264'])
         else:
             anim.save('visualizations/default_animations.mp4', fps=30, extra_args=['-vcodec', 'libx264'])
 
 
-def histogram_command_files(commands, bin_num=25, density=False, comtype=None, save_file = None):
+def histogram_command_files(commands, bin_num=25, density=False, comtype=None, save_file = None, show=True):
     """ Function to create multi-class histogram to examine x, y, and z positions for a given set of commands.
-        These commands may be in any dimension. """
-    x_commands = commands[:, :, 0].reshape(commands.shape[0]*commands.shape[1]) - 2  # x_offset.
-    y_commands = commands[:, :, 1].reshape(commands.shape[0]*commands.shape[1])
-    z_commands = commands[:, :, 2].reshape(commands.shape[0]*commands.shape[1])
-    plt.hist(x_commands, bins=bin_num, density=density, color='r', histtype='barstacked', label='X Positions')
-    plt.hist(y_commands, bins=bin_num, density=density, color='g', histtype='barstacked', label='Y Positions')
-    plt.hist(z_commands, bins=bin_num, density=density, color='b', histtype='barstacked', label='Z Positions')
-    plt.xlabel('Positions relative to origin (cm)')
-    plt.ylabel('Counts')
-    plt.legend()
-    if comtype:
-        plt.title('Command Positions: ' + str(comtype))
-    else:
-        plt.title('Command Positions. ')
-
-    if save_file:
-        plt.savefig(save_file, dpi=400)
-    plt.show()
-
-
-
+        These commands may be in any dimension. Counts are accumulated with utils.stats_utils.CommandStatistics over
+        each axis' own range, without copying the axes, and the accumulated statistics are returned. """
+    from utils.stats_utils import CommandStatistics
+    commands = np.asarray(commands)
+    ranges = {}
+    for axis, (channel, offset) in enumerate((('x', 2), ('y', 0), ('z', 0))):  # x_offset.
+        low, high = commands[:, :, axis].min() - offset, commands[:, :, axis].max() - offset
+        ranges[channel] = (low - 0.5, high + 0.5) if low == high else (low, high)
+    statistics = CommandStatistics(bin_num=bin_num, ranges=ranges, joint=(), x_offset=2).update(commands)
+    statistics.plot(density=density, comtype=comtype, save_file=save_file, show=show)
+    return statistics
+
+
+def histogram_command_blocks(blocks, value_range, bin_num=25, density=False, comtype=None, save_file=None,
+                             x_offset=2, show=True):
+    """ Streaming counterpart of histogram_command_files. Accumulates fixed-bin x, y and z counts over value_range one
+        block of trials at a time, so the full schedule never needs to be in memory, then plots the counts. Returns
+        the accumulated utils.stats_utils.CommandStatistics. """
+    from utils.stats_utils import statistics_from_blocks
+    statistics = statistics_from_blocks(blocks, bin_num=bin_num, ranges=dict.fromkeys(('x', 'y', 'z'), value_range),
+                                        x_offset=x_offset)
+    statistics.plot(density=density, comtype=comtype, save_file=save_file, show=show)
+    return statistics
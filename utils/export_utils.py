@@ -0,0 +1,241 @@
+""" Functions to stream ReachMaster command schedules to disk. Commands are converted from x, y, z positions into
+    r, thetay, thetaz robot commands (mm and degrees, the convention read by read_command_file) a fixed-size chunk of
+    trials at a time, through one reused conversion buffer, so the memory used by an export does not depend on the
+    length of the schedule. For use with the ReachSample software. """
+import json
+import os
+import numpy as np
+import utils.command_utils as c_d
+import utils.instrument_utils as iu
+
+COMMAND_COLUMNS = ['r', 'thetay', 'thetaz']
+EXPORT_FORMATS = ('csv', 'npy', 'parquet', 'store')
+STORE_INDEX_SUFFIX = '.idx.npy'
+STORE_METADATA_SUFFIX = '.json'
+STORE_FORMAT_VERSION = 1
+DEFAULT_CHUNK_TRIALS = 10000
+
+
+class CommandExportWriter:
+    """ Streaming writer for robot command files. Blocks of x, y, z commands of shape (n_trials, n_positions, 3) are
+        passed to write(), converted to robot commands and appended to every requested output:
+
+        csv: the r,thetay,thetaz format of the command files read by read_command_file, indexed by command number.
+        npy: a (n_commands, 3) float64 array, written incrementally and finalized on close.
+        parquet: a three-column table, one row group per chunk (requires pyarrow).
+        store: the npy output plus a per-trial offsets index (.idx.npy) and JSON metadata, read back with random
+            access by utils.store_utils.ScheduleStore.
+
+        The csv output is written to filename; other formats replace its extension. When an instrumentation
+        (utils.instrument_utils.Instrumentation) is given, each chunk is timed as 'transform' and 'write' spans and
+        counted in the 'commands_exported' and 'bytes_written' counters. resume continues existing csv, npy and store
+        outputs from the progress returned by flush() (see utils.checkpoint_utils): each file is truncated to its
+        recorded offset, discarding anything written after it, and new commands are appended. """
+
+    def __init__(self, filename='new_export_commands.csv', formats=('csv',), chunk_trials=DEFAULT_CHUNK_TRIALS,
+                 instrumentation=None, resume=None):
+        for fmt in formats:
+            if fmt not in EXPORT_FORMATS:
+                raise ValueError('Unsupported export format ' + str(fmt) + ', expected one of ' + str(EXPORT_FORMATS))
+        self.filename = filename
+        self.formats = tuple(formats)
+        self.chunk_trials = chunk_trials
+        self.instrumentation = iu.get_instrumentation(instrumentation)
+        self.n_commands, self.bytes_written = 0, 0
+        self.filenames = {fmt: self._format_filename(fmt) for fmt in self.formats}
+        if 'store' in self.formats:
+            self.filenames.setdefault('npy', self._format_filename('npy'))
+        self._trial_blocks, self._block_metadata = [], {}
+        self._buffer = np.empty((0, 3))
+        self._csv_file, self._npy_file, self._parquet_writer = None, None, None
+        if resume is not None:
+            self._resume(resume)
+            return
+        if 'parquet' in self.formats:
+            self._open_parquet()
+        if 'csv' in self.formats:
+            self._csv_file = open(self.filenames['csv'], 'w', newline='')
+        if 'npy' in self.filenames:
+            self._npy_file = open(self.filenames['npy'], 'wb')
+            self._write_npy_header()
+
+    def _resume(self, progress):
+        """ Reopens the outputs recorded in progress (a dict from flush()) for appending. """
+        if 'parquet' in self.formats:
+            raise ValueError('Parquet exports cannot be resumed or appended to')
+        self.n_commands = progress['n_commands']
+        self._trial_blocks = [tuple(trial_block) for trial_block in progress.get('trial_blocks', [])]
+        if progress.get('kind') is not None or progress.get('seed') is not None:
+            self._block_metadata = {'kind': progress.get('kind'), 'seed': progress.get('seed')}
+        offsets = progress['offsets']
+        for fmt, filename in self.filenames.items():
+            if fmt in offsets and os.path.getsize(filename) < offsets[fmt]:
+                raise IOError(filename + ' is shorter than its recorded progress and cannot be resumed')
+        if 'csv' in self.formats:
+            self._csv_file = open(self.filenames['csv'], 'r+', newline='')
+            self._csv_file.truncate(offsets['csv'])
+            self._csv_file.seek(0, os.SEEK_END)
+        if 'npy' in self.filenames:
+            self._npy_file = open(self.filenames['npy'], 'r+b')
+            self._npy_file.truncate(offsets['npy'])
+            self._write_npy_header()
+            if self._npy_header_size + self.n_commands * 3 * 8 != offsets['npy']:
+                raise IOError(self.filenames['npy'] + ' does not hold the ' + str(self.n_commands) +
+                              ' commands recorded in its progress')
+            self._npy_file.seek(0, os.SEEK_END)
+
+    def _format_filename(self, fmt):
+        if fmt == 'csv':
+            return self.filename
+        if fmt == 'store':
+            return os.path.splitext(self.filename)[0] + STORE_METADATA_SUFFIX
+        return os.path.splitext(self.filename)[0] + '.' + fmt
+
+    def _write_npy_header(self):
+        """ Writes the .npy header for the commands exported so far. numpy pads the header so that the length of the
+            first axis can grow in place, letting the header be rewritten on close without moving any data. """
+        self._npy_file.seek(0)
+        np.lib.format.write_array_header_1_0(self._npy_file, {'descr': np.lib.format.dtype_to_descr(np.dtype('<f8')),
+                                                              'fortran_order': False,
+                                                              'shape': (self.n_commands, 3)})
+        self._npy_header_size = self._npy_file.tell()
+
+    def _open_parquet(self):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Parquet export requires pyarrow, install it with pip install pyarrow')
+        self._parquet_schema = pa.schema([(column, pa.float64()) for column in COMMAND_COLUMNS])
+        self._parquet_writer = pq.ParquetWriter(self.filenames['parquet'], self._parquet_schema)
+
+    def write(self, commands):
+        """ Converts and appends a block of x, y, z commands (n_trials, n_positions, 3), chunk_trials trials at a
+            time. Robot-space utils.block_utils.CommandBlocks are already r, thetay, thetaz commands and are written as
+            they are. """
+        robot = getattr(commands, 'space', 'euclidean') == 'robot'
+        if not self._block_metadata and hasattr(commands, 'metadata'):
+            self._block_metadata = commands.metadata()
+        commands = np.asarray(commands)
+        if 'store' in self.formats:
+            self._trial_blocks.append(commands.shape[:2])
+        instrumentation = self.instrumentation
+        for start in range(0, commands.shape[0], self.chunk_trials):
+            chunk = commands[start:start + self.chunk_trials].reshape(-1, 3)
+            with instrumentation.span('transform'):
+                robot_commands = chunk if robot else c_d.euclidean_to_robot(chunk, out=self._robot_buffer(len(chunk)))
+            bytes_written = self.bytes_written
+            with instrumentation.span('write'):
+                self._write_chunk(robot_commands)
+            instrumentation.count('commands_exported', robot_commands.shape[0])
+            instrumentation.count('bytes_written', self.bytes_written - bytes_written)
+
+    def _robot_buffer(self, n_commands):
+        """ Reused (n_commands, 3) float64 buffer the robot commands of each chunk are converted into. """
+        if self._buffer.shape[0] < n_commands:
+            self._buffer = np.empty((n_commands, 3))
+        return self._buffer[:n_commands]
+
+    def _write_chunk(self, robot_commands):
+        if self._csv_file is not None:
+            import pandas as pd
+            start = self._csv_file.tell()
+            pd.DataFrame(robot_commands, columns=COMMAND_COLUMNS,
+                         index=pd.RangeIndex(self.n_commands, self.n_commands + robot_commands.shape[0])).to_csv(
+                self._csv_file, header=self.n_commands == 0)
+            self.bytes_written += self._csv_file.tell() - start
+        if self._npy_file is not None:
+            data = np.ascontiguousarray(robot_commands, dtype='<f8')
+            data.tofile(self._npy_file)
+            self.bytes_written += data.nbytes
+        if self._parquet_writer is not None:
+            import pyarrow as pa
+            self._parquet_writer.write_table(pa.Table.from_arrays(
+                [pa.array(robot_commands[:, i]) for i in range(3)], schema=self._parquet_schema))
+            self.bytes_written += robot_commands.nbytes
+        self.n_commands += robot_commands.shape[0]
+
+    def flush(self):
+        """ Flushes every output to disk and returns the progress needed to resume the export after this point: the
+            number of commands, the byte offset reached in each file, the trial layout written so far and the kind and
+            seed of the first block (recorded in the store metadata). """
+        offsets = {}
+        for fmt, output in (('csv', self._csv_file), ('npy', self._npy_file)):
+            if output is not None:
+                output.flush()
+                os.fsync(output.fileno())
+                offsets[fmt] = output.tell()
+        trial_blocks = {}
+        for n_trials, n_positions in self._trial_blocks:  # merged, so the progress stays small
+            trial_blocks[n_positions] = trial_blocks.get(n_positions, 0) + n_trials
+        if len(trial_blocks) == 1:
+            self._trial_blocks = [(n_trials, n_positions) for n_positions, n_trials in trial_blocks.items()]
+        return {'n_commands': self.n_commands, 'offsets': offsets,
+                'trial_blocks': [list(trial_block) for trial_block in self._trial_blocks],
+                'kind': self._block_metadata.get('kind'), 'seed': self._block_metadata.get('seed')}
+
+    def close(self):
+        """ Flushes and closes every output, finalizing the .npy header with the number of commands written. """
+        if self._csv_file is not None:
+            self._csv_file.close()
+            self._csv_file = None
+        if self._npy_file is not None:
+            header_size = self._npy_header_size
+            self._write_npy_header()
+            if self._npy_header_size != header_size:
+                raise IOError('Could not finalize .npy header for ' + self.filenames['npy'])
+            self._npy_file.close()
+            self._npy_file = None
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+        if 'store' in self.formats and self._trial_blocks is not None:
+            self._write_store_index()
+            self._trial_blocks = None
+
+    def _write_store_index(self):
+        """ Writes the store sidecars: the offset of every trial's first command in the npy array (plus the total
+            number of commands) and the JSON metadata describing the schedule. """
+        sizes = [np.full(n_trials, n_positions, dtype=np.int64) for n_trials, n_positions in self._trial_blocks]
+        sizes = np.concatenate(sizes) if sizes else np.zeros(0, dtype=np.int64)
+        base = os.path.splitext(self.filenames['npy'])[0]
+        np.save(base + STORE_INDEX_SUFFIX, np.concatenate(([0], np.cumsum(sizes))))
+        positions = np.unique(sizes)
+        metadata = {'format': 'reach_sample_store', 'version': STORE_FORMAT_VERSION,
+                    'commands': os.path.basename(self.filenames['npy']),
+                    'index': os.path.basename(base + STORE_INDEX_SUFFIX),
+                    'columns': COMMAND_COLUMNS, 'units': ['mm', 'deg', 'deg'], 'dtype': 'float64',
+                    'n_trials': int(sizes.size), 'n_commands': self.n_commands,
+                    'n_positions': int(positions[0]) if positions.size == 1 else None,
+                    'kind': self._block_metadata.get('kind'), 'seed': self._block_metadata.get('seed')}
+        with open(self.filenames['store'], 'w') as metadata_file:
+            json.dump(metadata, metadata_file, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def export_commands(commands, filename=None, formats=('csv',), chunk_trials=DEFAULT_CHUNK_TRIALS,
+                    instrumentation=None):
+    """ Exports x, y, z commands as robot commands, streaming chunk_trials trials at a time. commands may be a single
+        (n_trials, n_positions, 3) array or an iterable of such blocks, e.g. from ReachSample.iter_workspace. Returns
+        the mapping of format to written filename. """
+    filename = filename or 'new_export_commands.csv'
+    if isinstance(commands, np.ndarray):
+        commands = [commands]
+    with CommandExportWriter(filename, formats=formats, chunk_trials=chunk_trials,
+                             instrumentation=instrumentation) as writer:
+        for block in commands:
+            writer.write(block)
+    return writer.filenames
+
+
+def write_through(blocks, writer):
+    """ Generator that writes each block of commands with writer and yields it on unchanged, so an export can share a
+        single pass over a streamed schedule with other consumers (histograms, visualizations). """
+    for block in blocks:
+        writer.write(block)
+        yield block
@@ -0,0 +1,133 @@
+""" Lightweight instrumentation for ReachMaster command generation. An Instrumentation object times named spans around
+    each phase of a run (sampling, coordinate transforms, writing, histogramming, rendering), keeps per-phase counters
+    such as points generated, bytes written or frames rendered, forwards every event to optional sink callbacks and
+    summarizes the run as a JSON report. A disabled instance hands out one shared no-op context manager and ignores
+    counts, so instrumented code costs next to nothing when instrumentation is off. For use with the ReachSample
+    software. """
+import contextlib
+import json
+import time
+
+SPAN_SEPARATOR = '/'
+
+
+class _Span:
+    """ Context manager timing one span of an enabled Instrumentation. """
+
+    __slots__ = ('instrumentation', 'name', 'attributes', 'path', 'start')
+
+    def __init__(self, instrumentation, name, attributes):
+        self.instrumentation, self.name, self.attributes = instrumentation, name, attributes
+
+    def __enter__(self):
+        stack = self.instrumentation._stack
+        stack.append(self.name)
+        self.path = SPAN_SEPARATOR.join(stack)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        self.instrumentation._stack.pop()
+        self.instrumentation._record(self.path, self.name, seconds, self.attributes, exc_type is not None)
+        return False
+
+
+class Instrumentation:
+    """ Collects span timings and counters for a run. Spans nest, and each is reported under its path of enclosing
+        span names (e.g. 'create_theta_workspace/sample') with its number of calls and total, minimum and maximum
+        seconds. sinks are callables receiving one dict per event: {'event': 'span', 'name', 'path', 'seconds',
+        'attributes', 'error'} when a span closes and {'event': 'count', 'name', 'value', 'path'} for each count. """
+
+    def __init__(self, enabled=True, sinks=()):
+        self.enabled = enabled
+        self.sinks = list(sinks)
+        self.reset()
+
+    def reset(self):
+        """ Clears every recorded span and counter. """
+        self.spans, self.counters, self._stack = {}, {}, []
+        self.started = time.time()
+
+    def span(self, name, **attributes):
+        """ Returns a context manager timing the enclosed code as span name. """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, attributes)
+
+    def count(self, name, value=1):
+        """ Adds value to counter name. """
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + value
+        if self.sinks:
+            self._emit({'event': 'count', 'name': name, 'value': value, 'path': SPAN_SEPARATOR.join(self._stack)})
+
+    def add_sink(self, sink):
+        """ Adds a callable that receives every following event. """
+        self.sinks.append(sink)
+
+    @contextlib.contextmanager
+    def sink(self, sink):
+        """ Context manager attaching sink for the duration of the enclosed code. """
+        self.add_sink(sink)
+        try:
+            yield sink
+        finally:
+            self.sinks.remove(sink)
+
+    def _record(self, path, name, seconds, attributes, error):
+        entry = self.spans.get(path)
+        if entry is None:
+            self.spans[path] = {'calls': 1, 'seconds': seconds, 'min': seconds, 'max': seconds}
+        else:
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['min'] = min(entry['min'], seconds)
+            entry['max'] = max(entry['max'], seconds)
+        if self.sinks:
+            self._emit({'event': 'span', 'name': name, 'path': path, 'seconds': seconds, 'attributes': attributes,
+                        'error': error})
+
+    def _emit(self, event):
+        for sink in self.sinks:
+            sink(event)
+
+    def report(self):
+        """ Returns the recorded spans and counters as a JSON-serializable dict. """
+        return {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'elapsed': time.time() - self.started,
+                'spans': {path: dict(entry) for path, entry in self.spans.items()},
+                'counters': dict(self.counters)}
+
+    def to_json(self, filename=None):
+        """ Returns the run report as a JSON string, also writing it to filename when given. """
+        serialized = json.dumps(self.report(), indent=2)
+        if filename:
+            with open(filename, 'w') as json_file:
+                json_file.write(serialized)
+        return serialized
+
+
+_NULL_SPAN = contextlib.nullcontext()
+NULL_INSTRUMENTATION = Instrumentation(enabled=False)
+
+
+def get_instrumentation(instrumentation=None):
+    """ Returns instrumentation itself, a new enabled Instrumentation for True, or the shared disabled instance for
+        None or False. """
+    if isinstance(instrumentation, Instrumentation):
+        return instrumentation
+    return Instrumentation() if instrumentation else NULL_INSTRUMENTATION
+
+
+def time_through(blocks, instrumentation, name):
+    """ Generator yielding the blocks of an iterator unchanged while timing the production of each one as span name,
+        so lazily generated phases of a streamed pass are timed separately from their consumers. """
+    iterator = iter(blocks)
+    while True:
+        with instrumentation.span(name):
+            block = next(iterator, None)
+        if block is None:
+            return
+        yield block
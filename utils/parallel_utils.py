@@ -0,0 +1,111 @@
+""" Functions to generate ReachMaster command schedules across processes. A schedule is split into fixed-size chunks of
+    trials and every chunk draws from its own independent stream, spawned from a root np.random.SeedSequence. Because
+    the chunking does not depend on the number of workers, a schedule is bit-identical for a given root seed however
+    many processes build it. Workers write straight into a shared-memory buffer, so no command data is pickled
+    between processes. For use with the ReachSample software. """
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import utils.command_utils as c_d
+
+DEFAULT_CHUNK_TRIALS = 10000
+
+
+def root_seed_sequence(seed=None):
+    """ Returns the root SeedSequence for a seed given as None, an integer or a SeedSequence. """
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    return np.random.SeedSequence(seed)
+
+
+def chunk_seed_sequences(seed, n_chunks):
+    """ Spawns one independent SeedSequence per chunk from the root seed. Spawning is done from a fresh copy of the
+        root so repeated calls with the same seed always return the same streams. """
+    root = root_seed_sequence(seed)
+    return np.random.SeedSequence(root.entropy, spawn_key=root.spawn_key, pool_size=root.pool_size).spawn(n_chunks)
+
+
+def schedule_chunks(n_trials, chunk_trials=DEFAULT_CHUNK_TRIALS):
+    """ Returns the (start, n_trials) chunks a schedule of n_trials is generated in. """
+    return [(start, min(chunk_trials, n_trials - start)) for start in range(0, n_trials, chunk_trials)]
+
+
+def generate_chunk(kind, n_trials, n_positions, seed_sequence, params):
+    """ Generates one chunk of a kind workspace from its own SeedSequence. """
+    return c_d.sample_workspace(kind, n_trials, n_positions, rng=np.random.default_rng(seed_sequence), **params)
+
+
+def _generate_chunk_shared(shm_name, n_points, offset, task):
+    """ Worker entry point: generates a chunk and writes its points into the shared buffer starting at offset. """
+    kind, n_trials, n_positions, seed_sequence, params = task
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        points = np.ndarray((n_points, 3), dtype=np.float64, buffer=shm.buf)
+        points[offset:offset + n_trials * n_positions] = generate_chunk(*task).reshape(-1, 3)
+        del points
+    finally:
+        shm.close()
+    return n_trials
+
+
+def _run_tasks(tasks, n_workers):
+    """ Generates every task into one flat (n_points, 3) array in task order, in-process when a single worker is
+        requested and through a process pool writing into shared memory otherwise. """
+    sizes = [n_trials * n_positions for _, n_trials, n_positions, _, _ in tasks]
+    offsets = np.cumsum([0] + sizes)
+    n_points = int(offsets[-1])
+    n_workers = min(n_workers or os.cpu_count() or 1, len(tasks))
+    if n_workers <= 1:
+        points = np.empty((n_points, 3))
+        for offset, size, task in zip(offsets, sizes, tasks):
+            points[offset:offset + size] = generate_chunk(*task).reshape(-1, 3)
+        return points
+    shm = shared_memory.SharedMemory(create=True, size=max(1, n_points * 3 * 8))
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            for future in [pool.submit(_generate_chunk_shared, shm.name, n_points, int(offset), task)
+                           for offset, task in zip(offsets, tasks)]:
+                future.result()
+        return np.ndarray((n_points, 3), dtype=np.float64, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _schedule_tasks(kind, n_trials, n_positions, seed, chunk_trials, params):
+    """ Splits one schedule into chunk tasks, each carrying the SeedSequence spawned for its chunk index. """
+    chunks = schedule_chunks(n_trials, chunk_trials)
+    return [(kind, size, n_positions, seed_sequence, params)
+            for (_, size), seed_sequence in zip(chunks, chunk_seed_sequences(seed, len(chunks)))]
+
+
+def generate_schedule(kind, n_trials, n_positions, seed=None, n_workers=None, chunk_trials=DEFAULT_CHUNK_TRIALS,
+                      **params):
+    """ Generates a kind ('theta', 'phi', '2d' or '3d') schedule of size n_trials, n_positions, 3 across n_workers
+        processes (default: all cores). Keyword parameters are passed to the matching batched sampler. The output
+        depends only on seed and chunk_trials, never on n_workers. """
+    tasks = _schedule_tasks(kind, n_trials, n_positions, seed, chunk_trials, params)
+    points = _run_tasks(tasks, n_workers) if tasks else np.empty((0, 3))
+    return points.reshape((n_trials, n_positions, 3))
+
+
+def generate_sessions(sessions, seed=None, n_workers=None, chunk_trials=DEFAULT_CHUNK_TRIALS):
+    """ Generates several schedules (e.g. one per animal or session) on a shared process pool, so chunks from every
+        session are balanced across workers. sessions is a list of dicts holding kind, n_trials, n_positions and the
+        sampler's keyword parameters. Session i draws from the i-th stream spawned from seed, which makes it identical
+        to generate_schedule(seed=chunk_seed_sequences(seed, len(sessions))[i]) whatever the other sessions or the
+        number of workers, unless the session holds its own seed. Returns one (n_trials, n_positions, 3) array per
+        session. """
+    tasks, shapes = [], []
+    for session, session_seed in zip(sessions, chunk_seed_sequences(seed, len(sessions))):
+        params = dict(session)
+        kind, n_trials, n_positions = params.pop('kind'), params.pop('n_trials'), params.pop('n_positions')
+        if params.get('seed') is not None:
+            session_seed = params['seed']
+        params.pop('seed', None)
+        tasks.extend(_schedule_tasks(kind, n_trials, n_positions, session_seed, chunk_trials, params))
+        shapes.append((n_trials, n_positions, 3))
+    points = _run_tasks(tasks, n_workers) if tasks else np.empty((0, 3))
+    bounds = np.cumsum([0] + [n_trials * n_positions for n_trials, n_positions, _ in shapes])
+    return [points[start:stop].reshape(shape) for start, stop, shape in zip(bounds[:-1], bounds[1:], shapes)]
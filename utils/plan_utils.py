@@ -0,0 +1,174 @@
+""" Declarative experiment plans for ReachMaster. A plan is a JSON (or YAML) document describing the ordered blocks of
+    an experiment, e.g. a theta block followed by 2-D and 3-D blocks for each animal, with their parameters and seeds:
+
+        {"seed": 2024, "output": "session.csv", "formats": ["csv", "store"],
+         "defaults": {"n_positions": 9, "radius": 2, "sample": true},
+         "blocks": [{"name": "rat1-theta", "kind": "theta", "n_trials": 200, "length": 0.4},
+                    {"name": "rat1-3d", "kind": "3d", "n_trials": 1000, "stride": 0.5, "y_length": 0.4,
+                     "z_length": 1},
+                    {"name": "probe", "kind": "2d", "n_trials": 50, "y_length": 0.4, "z_length": 1, "seed": 7}]}
+
+    Every block is a dict of kind, n_trials, n_positions, an optional name and seed, and the keyword parameters of the
+    matching batched sampler; defaults are merged into every block. A block without a seed draws from the stream
+    spawned from the plan seed for its position in the plan. Blocks with the same kind, size, parameters and seed are
+    generated once and shared, and the remaining blocks are generated concurrently on one process pool (see
+    utils.parallel_utils.generate_sessions). Each block is identical to utils.parallel_utils.generate_schedule with its
+    seed and the plan chunk_trials. compile_plan returns the blocks in plan order; export_plan writes them as one
+    schedule with a manifest of the block boundaries and seeds. The reach-sample-plan console script runs export_plan.
+    For use with the ReachSample software. """
+import argparse
+import json
+import os
+import numpy as np
+import utils.block_utils as bu
+import utils.command_utils as c_d
+import utils.export_utils as ex
+import utils.instrument_utils as iu
+import utils.parallel_utils as pu
+
+PLAN_MANIFEST_SUFFIX = '.plan.json'
+BLOCK_FIELDS = ('name', 'kind', 'n_trials', 'n_positions', 'seed')
+
+
+def load_plan(path):
+    """ Reads a plan from a JSON file, or from a YAML file (.yaml or .yml, requires PyYAML). """
+    with open(path) as plan_file:
+        if str(path).endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('YAML plans require PyYAML, install it with pip install pyyaml')
+            return yaml.safe_load(plan_file)
+        return json.load(plan_file)
+
+
+def manifest_filename(filename):
+    """ Returns the plan manifest written beside an export filename. """
+    return os.path.splitext(str(filename))[0] + PLAN_MANIFEST_SUFFIX
+
+
+def _seed_to_json(seed):
+    if isinstance(seed, np.random.SeedSequence):
+        return {'entropy': seed.entropy, 'spawn_key': list(seed.spawn_key)}
+    return seed
+
+
+def _resolve_blocks(plan, seed):
+    """ Returns the plan blocks with the defaults merged in, validated and given a name and seed, blocks without a
+        seed drawing from the streams spawned from the root seed. """
+    entries = plan.get('blocks') or []
+    if not entries:
+        raise ValueError('The plan holds no blocks')
+    spawned = pu.chunk_seed_sequences(seed, len(entries))
+    blocks = []
+    for i, entry in enumerate(entries):
+        block = dict(plan.get('defaults') or {}, **entry)
+        for field in ('kind', 'n_trials', 'n_positions'):
+            if field not in block:
+                raise ValueError('Block ' + str(i) + ' of the plan has no ' + field)
+        if block['kind'] not in c_d.WORKSPACE_SAMPLERS:
+            raise ValueError('Block ' + str(i) + ' has unknown kind ' + str(block['kind']) + ', expected one of ' +
+                             str(list(c_d.WORKSPACE_SAMPLERS)))
+        block.setdefault('name', block['kind'] + '-' + str(i))
+        if block.get('seed') is None:
+            block['seed'] = spawned[i]
+        blocks.append(block)
+    return blocks
+
+
+def _block_key(block):
+    """ Identifies the blocks that generate identical commands: same kind, size, sampler parameters and seed. """
+    return json.dumps({key: _seed_to_json(value) for key, value in block.items() if key != 'name'}, sort_keys=True)
+
+
+def compile_plan(plan, n_workers=None, chunk_trials=None, instrumentation=None):
+    """ Compiles a plan (a dict, or the path of a plan file) into its blocks. Returns the list of euclidean
+        CommandBlocks in plan order, each tagged with its kind and seed, and a JSON-serializable manifest giving the
+        name, first trial, size, seed and parameters of every block. Parameter-identical blocks share one array.
+        Generation runs on n_workers processes (default: all cores) in chunks of chunk_trials trials (default: the
+        plan chunk_trials, or utils.parallel_utils.DEFAULT_CHUNK_TRIALS). """
+    if not isinstance(plan, dict):
+        plan = load_plan(plan)
+    instrumentation = iu.get_instrumentation(instrumentation)
+    chunk_trials = chunk_trials or plan.get('chunk_trials') or pu.DEFAULT_CHUNK_TRIALS
+    seed = pu.root_seed_sequence(plan.get('seed'))
+    blocks = _resolve_blocks(plan, seed)
+    keys = [_block_key(block) for block in blocks]
+    unique = list(dict.fromkeys(keys))
+    sessions = [blocks[keys.index(key)] for key in unique]
+    with instrumentation.span('compile_plan', n_blocks=len(blocks), n_generated=len(sessions)):
+        with instrumentation.span('sample'):
+            schedules = pu.generate_sessions([{key: value for key, value in session.items() if key != 'name'}
+                                              for session in sessions], n_workers=n_workers,
+                                             chunk_trials=chunk_trials)
+    instrumentation.count('points_generated', sum(schedule.shape[0] * schedule.shape[1] for schedule in schedules))
+    commands, manifest_blocks, first_trial = [], [], 0
+    for block, key in zip(blocks, keys):
+        index = unique.index(key)
+        commands.append(bu.CommandBlock(schedules[index], kind=block['kind'], seed=block['seed']))
+        manifest_blocks.append({'name': block['name'], 'kind': block['kind'], 'first_trial': first_trial,
+                                'n_trials': block['n_trials'], 'n_positions': block['n_positions'],
+                                'seed': _seed_to_json(block['seed']),
+                                'shared_with': sessions[index]['name'] if sessions[index] is not block else None,
+                                'params': {key: value for key, value in block.items() if key not in BLOCK_FIELDS}})
+        first_trial += block['n_trials']
+    manifest = {'seed': _seed_to_json(seed), 'chunk_trials': chunk_trials,
+                'n_trials': first_trial, 'n_generated': len(sessions), 'blocks': manifest_blocks}
+    return commands, manifest
+
+
+def write_plan(commands, manifest, filename='new_export_commands.csv', formats=('csv',), instrumentation=None):
+    """ Exports compiled plan blocks in order as one schedule to filename in the given formats (see
+        utils.export_utils.CommandExportWriter) and writes the manifest beside it (see manifest_filename), recording
+        the output filenames in it. Returns the manifest. """
+    instrumentation = iu.get_instrumentation(instrumentation)
+    with instrumentation.span('export'):
+        with ex.CommandExportWriter(filename, formats=formats, chunk_trials=manifest['chunk_trials'],
+                                    instrumentation=instrumentation) as writer:
+            for block in commands:
+                writer.write(block)
+    manifest['output'] = dict(writer.filenames)
+    with open(manifest_filename(filename), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
+
+def export_plan(plan, filename=None, formats=None, n_workers=None, chunk_trials=None, instrumentation=None):
+    """ Compiles a plan (a dict, or the path of a plan file) and exports it with write_plan to filename in the given
+        formats, defaulting to the plan output and formats. Returns the manifest. """
+    if not isinstance(plan, dict):
+        plan = load_plan(plan)
+    commands, manifest = compile_plan(plan, n_workers=n_workers, chunk_trials=chunk_trials,
+                                      instrumentation=instrumentation)
+    return write_plan(commands, manifest, filename=filename or plan.get('output') or 'new_export_commands.csv',
+                      formats=formats or plan.get('formats') or ('csv',), instrumentation=instrumentation)
+
+
+def main(argv=None):
+    """ Entry point of the reach-sample-plan console script. """
+    parser = argparse.ArgumentParser(prog='reach-sample-plan',
+                                     description='Compile a JSON or YAML experiment plan into one command schedule.')
+    parser.add_argument('plan', help='plan file (.json, .yaml or .yml)')
+    parser.add_argument('-o', '--output', help='export filename (default: the plan output)')
+    parser.add_argument('-f', '--formats', nargs='+', choices=ex.EXPORT_FORMATS,
+                        help='export formats (default: the plan formats, or csv)')
+    parser.add_argument('-w', '--workers', type=int, help='number of processes (default: all cores)')
+    parser.add_argument('--chunk-trials', type=int, help='trials per generated chunk')
+    parser.add_argument('--seed', type=int, help='plan seed, overriding the one in the plan file')
+    parser.add_argument('--report', help='write the JSON run report (phase timings and counters) to this file')
+    args = parser.parse_args(argv)
+    plan = load_plan(args.plan)
+    if args.seed is not None:
+        plan['seed'] = args.seed
+    instrumentation = iu.Instrumentation() if args.report else None
+    manifest = export_plan(plan, filename=args.output, formats=args.formats, n_workers=args.workers,
+                           chunk_trials=args.chunk_trials, instrumentation=instrumentation)
+    if args.report:
+        instrumentation.to_json(args.report)
+    print('Exported ' + str(manifest['n_trials']) + ' trials in ' + str(len(manifest['blocks'])) + ' blocks (' +
+          str(manifest['n_generated']) + ' generated) to ' + ', '.join(manifest['output'].values()))
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,154 @@
+""" Quasi-random (low-discrepancy) draws for the ReachMaster batched samplers. The batched samplers draw every random
+    coordinate of a schedule from a numpy Generator through random, binomial and integers calls, one
+    (n_trials, k) array at a time. QuasiRandomDraws offers the same three calls but answers them from a scrambled
+    Halton or Sobol point set over trials: trial i takes point i, and each call consumes the next k dimensions of it.
+    The random coordinates of a trial therefore form one point of a low-discrepancy sequence, so the workspace is
+    covered evenly with far fewer trials than independent uniform draws need, while every range, extremum and radius
+    constraint of the samplers is kept. Halton points are computed here with random digit permutations drawn from the
+    Generator; Sobol points require scipy. For use with the ReachSample software. """
+import math
+import warnings
+import numpy as np
+
+SAMPLING_MODES = ('random', 'halton', 'sobol')
+HALTON_TABLE_SIZE = 4096
+
+
+def primes(n):
+    """ Returns the first n primes. """
+    found = []
+    candidate = 2
+    while len(found) < n:
+        if all(candidate % p for p in found if p * p <= candidate):
+            found.append(candidate)
+        candidate += 1
+    return found
+
+
+def scrambled_halton(n, n_dims, rng, first_dim=0):
+    """ Returns n points (n, n_dims) in [0, 1) of the Halton sequence in dimensions first_dim to first_dim + n_dims,
+        scrambled with an independent random permutation of the digits at every level of every dimension and a random
+        offset within the finest cell, so the points are uniformly distributed yet keep the stratification of the
+        sequence. Several digits are scrambled per pass through a lookup table of HALTON_TABLE_SIZE entries at most. """
+    index = np.arange(n, dtype=np.int32 if n < 2 ** 31 else np.int64)
+    points = np.empty((n, n_dims))
+    for dim, base in enumerate(primes(first_dim + n_dims)[first_dim:]):
+        n_digits = max(1, math.ceil(math.log(max(n, 2), base)))
+        digits_per_pass = max(1, int(math.log(HALTON_TABLE_SIZE, base)))
+        column = rng.random(n)  # offset within the finest cell, scaled below
+        remaining, level = index, 0
+        while level < n_digits:
+            n_pass = min(digits_per_pass, n_digits - level)
+            values = np.arange(base ** n_pass)
+            table = np.zeros(base ** n_pass)
+            for j in range(n_pass):
+                table += rng.permutation(base)[values // base ** j % base] * float(base) ** (n_digits - level - j - 1)
+            remaining, digits = np.divmod(remaining, base ** n_pass)
+            column += table[digits]
+            level += n_pass
+        points[:, dim] = column / float(base) ** n_digits
+    return points
+
+
+def scrambled_sobol(n, n_dims, rng):
+    """ Returns n points (n, n_dims) in [0, 1) of a scrambled Sobol sequence (requires scipy). """
+    try:
+        from scipy.stats import qmc
+    except ImportError:
+        raise ImportError('Sobol sampling requires scipy, install it with pip install scipy, or use halton sampling')
+    with warnings.catch_warnings():  # the balance properties warning for n that are not powers of two
+        warnings.simplefilter('ignore', UserWarning)
+        return qmc.Sobol(n_dims, scramble=True, seed=rng).random(n)
+
+
+def unit_draws(rng, n, n_dims, sampling='random'):
+    """ Returns n points (n, n_dims) in [0, 1) drawn with a sampling mode from SAMPLING_MODES. """
+    if sampling == 'random':
+        return rng.random((n, n_dims))
+    if sampling == 'halton':
+        return scrambled_halton(n, n_dims, rng)
+    if sampling == 'sobol':
+        return scrambled_sobol(n, n_dims, rng)
+    raise ValueError('Unknown sampling mode ' + str(sampling) + ', expected one of ' + str(SAMPLING_MODES))
+
+
+def centered_discrepancy(points):
+    """ Centered L2 discrepancy of points (n, n_dims) in [0, 1): lower values mean the points fill the unit cube
+        more evenly. Computed in row blocks, so memory stays linear in n. """
+    points = np.asarray(points, dtype=float)
+    n, n_dims = points.shape
+    offsets = np.abs(points - 0.5)
+    single = np.prod(1 + 0.5 * offsets - 0.5 * offsets ** 2, axis=1).sum()
+    pairs = 0.
+    for start in range(0, n, 1024):
+        block = offsets[start:start + 1024, None, :]
+        spread = np.abs(points[start:start + 1024, None, :] - points[None, :, :])
+        pairs += np.prod(1 + 0.5 * block + 0.5 * offsets[None, :, :] - 0.5 * spread, axis=2).sum()
+    return float(np.sqrt((13. / 12.) ** n_dims - 2. / n * single + pairs / n ** 2))
+
+
+class DimensionCounter:
+    """ Stand-in for a Generator that only counts the dimensions a sampler consumes per trial. """
+
+    def __init__(self):
+        self.n_dims = 0
+
+    def random(self, size):
+        size = np.atleast_1d(size)
+        self.n_dims += int(np.prod(size[1:]))
+        return np.zeros(tuple(size))
+
+    def binomial(self, n, p, size):
+        return self.random(size).astype(np.int64)
+
+    def integers(self, low, high, size):
+        return self.random(size).astype(np.int64) + low
+
+
+def count_dimensions(sampler):
+    """ Returns the number of dimensions per trial sampler(rng) consumes, running it once against a counter. """
+    counter = DimensionCounter()
+    sampler(counter)
+    return counter.n_dims
+
+
+class QuasiRandomDraws:
+    """ Low-discrepancy replacement for the Generator of a batched sampler drawing n_trials trials. random,
+        binomial and integers answer draws of shape (n_trials, ...) from consecutive dimensions of a scrambled
+        'halton' or 'sobol' point set, scrambled with rng. Halton dimensions are computed as they are consumed;
+        Sobol needs the number of dimensions up front (see count_dimensions). """
+
+    def __init__(self, rng, n_trials, sampling='halton', n_dims=None):
+        if sampling not in SAMPLING_MODES[1:]:
+            raise ValueError('Unknown quasi-random sampling mode ' + str(sampling) + ', expected one of ' +
+                             str(SAMPLING_MODES[1:]))
+        self.rng, self.n_trials, self.sampling = rng, n_trials, sampling
+        self.n_used = 0
+        self._points = unit_draws(rng, n_trials, n_dims, sampling) if sampling == 'sobol' else None
+
+    def random(self, size):
+        """ (n_trials, ...) uniform draws in [0, 1) from the next dimensions of the point set. """
+        size = tuple(np.atleast_1d(size))
+        if size[0] != self.n_trials:
+            raise ValueError('Quasi-random draws are made for all ' + str(self.n_trials) + ' trials at once, not ' +
+                             str(size[0]))
+        n_dims = int(np.prod(size[1:]))
+        if self._points is None:
+            points = scrambled_halton(self.n_trials, n_dims, self.rng, first_dim=self.n_used)
+        else:
+            if self.n_used + n_dims > self._points.shape[1]:
+                raise ValueError('The sampler consumed more than the ' + str(self._points.shape[1]) +
+                                 ' dimensions counted for it')
+            points = self._points[:, self.n_used:self.n_used + n_dims]
+        self.n_used += n_dims
+        return points.reshape(size)
+
+    def binomial(self, n, p, size):
+        """ Bernoulli (n == 1) draws from the next dimension of the point set. """
+        if n != 1:
+            raise ValueError('Quasi-random binomial draws support n == 1 only')
+        return (self.random(size) < p).astype(np.int64)
+
+    def integers(self, low, high, size):
+        """ Integers in [low, high), one dimension of the point set per value. """
+        return low + np.floor(self.random(size) * (high - low)).astype(np.int64)
@@ -0,0 +1,98 @@
+""" Headless renderer for rotating 3-D workspace animations. Frames are drawn with the Agg backend in worker processes,
+    each worker rendering a contiguous range of azimuths, and are then assembled into an MP4 through an ffmpeg pipe
+    when ffmpeg is installed, or into a GIF or a PNG sequence when it is not. No window is ever opened, so the
+    renderer can run on machines without a display. For use with the ReachSample software. """
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+RENDER_FORMATS = ('mp4', 'gif', 'png')
+FRAME_NAME = 'frame_%05d.png'
+
+
+def split_frames(frames, n_workers):
+    """ Splits frame indices 0..frames-1 into at most n_workers contiguous (start, stop) ranges. """
+    n_workers = max(1, min(n_workers, frames))
+    bounds = [round(i * frames / n_workers) for i in range(n_workers + 1)]
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def render_frame_range(plot_function, data, frame_range, frame_dir, elev=15., figsize=(10, 10), dpi=100):
+    """ Worker entry point. Draws the workspace once with plot_function(fig, ax, data), then saves one PNG per azimuth
+        in frame_range, rotating the camera as animate_a does. Returns the number of frames rendered. """
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    fig = plt.figure(figsize=figsize)
+    ax = fig.add_subplot(1, 1, 1, projection='3d', label='Reaching Volume Projection')
+    plot_function(fig, ax, data)
+    for azim in range(*frame_range):
+        ax.view_init(elev=elev, azim=azim)
+        fig.savefig(os.path.join(frame_dir, FRAME_NAME % azim), dpi=dpi)
+    plt.close(fig)
+    return frame_range[1] - frame_range[0]
+
+
+def _assemble_mp4(frame_files, filename, fps):
+    """ Streams PNG frames into ffmpeg's stdin and encodes them with libx264. """
+    command = [shutil.which('ffmpeg'), '-y', '-loglevel', 'error', '-f', 'image2pipe', '-framerate', str(fps),
+               '-vcodec', 'png', '-i', '-', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-vcodec', 'libx264',
+               '-pix_fmt', 'yuv420p', filename]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        for frame_file in frame_files:
+            with open(frame_file, 'rb') as frame:
+                process.stdin.write(frame.read())
+    finally:
+        process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError('ffmpeg failed to encode ' + filename)
+
+
+def _assemble_gif(frame_files, filename, fps):
+    """ Writes the frames as a looping GIF with pillow, loading one frame at a time. """
+    from PIL import Image
+    frames = (Image.open(frame_file).convert('RGB') for frame_file in frame_files)
+    first = next(frames)
+    first.save(filename, save_all=True, append_images=frames, duration=int(1000 / fps), loop=0)
+
+
+def render_rotation(plot_function, data, filename, frames=360, fps=30, elev=15., n_workers=None, output_format=None,
+                    figsize=(10, 10), dpi=100):
+    """ Renders a rotating view of a 3-D workspace without a display. plot_function(fig, ax, data) draws the scene
+        (e.g. func_viz or make_plot_pilot) and must be a module-level function so that it can be sent to the worker
+        processes. output_format is 'mp4', 'gif' or 'png'; by default MP4 is written when ffmpeg is available and
+        GIF otherwise, replacing the extension of filename. 'png' keeps the frames in a <filename>_frames directory.
+        Returns the path written. """
+    if output_format is None:
+        output_format = 'mp4' if shutil.which('ffmpeg') else 'gif'
+    if output_format not in RENDER_FORMATS:
+        raise ValueError('Unsupported render format ' + str(output_format) + ', expected one of ' + str(RENDER_FORMATS))
+    if output_format == 'mp4' and not shutil.which('ffmpeg'):
+        raise RuntimeError('MP4 rendering requires ffmpeg on the PATH, use output_format="gif" or "png" instead.')
+    base = os.path.splitext(filename)[0]
+    if output_format == 'png':
+        frame_dir = base + '_frames'
+        os.makedirs(frame_dir, exist_ok=True)
+    else:
+        frame_dir = tempfile.mkdtemp(prefix='reach_sample_frames_')
+    try:
+        frame_ranges = split_frames(frames, n_workers or os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=len(frame_ranges)) as pool:
+            futures = [pool.submit(render_frame_range, plot_function, data, frame_range, frame_dir, elev, figsize,
+                                   dpi) for frame_range in frame_ranges]
+            for future in futures:
+                future.result()
+        frame_files = [os.path.join(frame_dir, FRAME_NAME % i) for i in range(frames)]
+        if output_format == 'png':
+            return frame_dir
+        filename = base + '.' + output_format
+        if output_format == 'mp4':
+            _assemble_mp4(frame_files, filename, fps)
+        else:
+            _assemble_gif(frame_files, filename, fps)
+        return filename
+    finally:
+        if output_format != 'png':
+            shutil.rmtree(frame_dir, ignore_errors=True)
@@ -0,0 +1,227 @@
+""" Local command server for ReachMaster sessions. A CommandServer hands out one trial of robot commands per request to
+    the ReachMaster controller over a local TCP socket. Upcoming blocks of trials are generated, transformed into
+    r, thetay, thetaz commands and encoded by a background thread into a bounded prefetch queue, so a request only
+    takes the next ready line off the queue and the controller never waits on sampling. Request latency is recorded
+    and reported as percentiles. CommandClient is a minimal client for the controller side and for tests. For use
+    with the ReachSample software.
+
+    Protocol: newline-terminated text over TCP. The client sends NEXT, STATS or QUIT. NEXT is answered with
+    {"trial": k, "commands": [[r, thetay, thetaz], ...]} or {"done": true} once the schedule is exhausted, STATS with
+    the latency statistics, each as one JSON line. """
+import collections
+import json
+import queue
+import socket
+import socketserver
+import threading
+import time
+import numpy as np
+import utils.command_utils as c_d
+
+DEFAULT_PREFETCH_BLOCKS = 4
+DEFAULT_BLOCK_TRIALS = 256
+MAX_LATENCY_SAMPLES = 100000
+QUEUE_POLL_SECONDS = 0.1
+DONE_LINE = b'{"done": true}\n'
+_DONE = object()
+
+
+def encode_block(robot_commands, first_trial):
+    """ Encodes a block of robot commands (n_trials, n_positions, 3) as one JSON response line per trial. """
+    return [json.dumps({'trial': first_trial + i, 'commands': trial}).encode() + b'\n'
+            for i, trial in enumerate(np.asarray(robot_commands).tolist())]
+
+
+class _CommandRequestHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        command_server = self.server.command_server
+        for line in self.rfile:
+            start = time.perf_counter()
+            request = line.strip().upper()
+            if request == b'NEXT':
+                self.wfile.write(command_server.next_line())
+                command_server.record_latency(time.perf_counter() - start)
+            elif request == b'STATS':
+                self.wfile.write(json.dumps(command_server.stats()).encode() + b'\n')
+            elif request == b'QUIT':
+                return
+            else:
+                self.wfile.write(json.dumps({'error': 'unknown request ' + request.decode(errors='replace')})
+                                 .encode() + b'\n')
+
+
+class _CommandTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class CommandServer:
+    """ Serves the trials of blocks, an iterable of command blocks (n_trials, n_positions, 3) such as
+        ReachSample.iter_workspace, one per NEXT request on host:port (port 0 picks a free port, see address).
+        Euclidean x, y, z blocks are transformed to robot commands by the prefetch thread; robot-space CommandBlocks
+        (e.g. from a utils.store_utils.ScheduleStore) are served as they are. At most prefetch_blocks blocks are
+        prepared ahead of the controller. Use start() and close(), or the server as a context manager. """
+
+    def __init__(self, blocks, host='127.0.0.1', port=0, prefetch_blocks=DEFAULT_PREFETCH_BLOCKS):
+        self._blocks = blocks
+        self._queue = queue.Queue(maxsize=prefetch_blocks)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()  # statistics: latencies and counters
+        self._fetch_lock = threading.Lock()  # the queue and the lines of the current block
+        self._lines = collections.deque()
+        self._done = False
+        self.latencies = collections.deque(maxlen=MAX_LATENCY_SAMPLES)
+        self.n_served, self.n_waits = 0, 0
+        self.error = None
+        self._server = _CommandTCPServer((host, port), _CommandRequestHandler)
+        self._server.command_server = self
+        self._threads = []
+
+    @property
+    def address(self):
+        """ (host, port) the server listens on. """
+        return self._server.server_address
+
+    def start(self):
+        """ Starts the prefetch thread and begins serving requests in the background. """
+        if self._threads:
+            return self
+        self._threads = [threading.Thread(target=self._prefetch, name='command-prefetch', daemon=True),
+                         threading.Thread(target=self._server.serve_forever, name='command-server', daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def _prefetch(self):
+        """ Producer thread: generates, transforms and encodes blocks ahead of the controller. """
+        first_trial = 0
+        try:
+            for block in self._blocks:
+                robot = getattr(block, 'space', 'euclidean') == 'robot'
+                block = np.asarray(block)
+                if not robot:
+                    block = c_d.euclidean_to_robot(block.reshape(-1, 3)).reshape(block.shape)
+                self._put(encode_block(block, first_trial))
+                first_trial += block.shape[0]
+                if self._stop.is_set():
+                    return
+        except Exception as error:  # surfaced to the controller as the end of the schedule and kept in self.error
+            self.error = error
+        self._put(_DONE)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=QUEUE_POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def next_line(self):
+        """ Returns the encoded response for the next trial, waiting for the prefetch thread only when it has fallen
+            behind (counted in n_waits). Requests take trials one at a time, in order, but wait outside the lock that
+            guards the statistics, so STATS is never held up; once the server is closed a waiting request is answered
+            with done. """
+        with self._fetch_lock:
+            if not self._lines and not self._done:
+                item = self._next_block()
+                if item is _DONE:
+                    self._done = True
+                else:
+                    self._lines.extend(item)
+            if not self._lines:
+                return DONE_LINE
+            with self._lock:
+                self.n_served += 1
+            return self._lines.popleft()
+
+    def _next_block(self):
+        """ Takes the next encoded block off the queue, polling so that closing the server ends the wait. """
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                self.n_waits += 1
+        while not self._stop.is_set():
+            try:
+                return self._queue.get(timeout=QUEUE_POLL_SECONDS)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def record_latency(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def stats(self):
+        """ Request latency percentiles in milliseconds, with the trials served, the number of requests that had to
+            wait for the prefetch thread and the number of blocks ready in the queue. The counters and latencies are
+            read under the lock the request handlers update them with. """
+        with self._lock:
+            latencies = np.array(self.latencies) * 1000.
+            n_served, n_waits = self.n_served, self.n_waits
+        percentiles = np.percentile(latencies, (50, 99)).tolist() if latencies.size else [None, None]
+        return {'n_served': n_served, 'n_waits': n_waits, 'prefetched_blocks': self._queue.qsize(),
+                'p50_ms': percentiles[0], 'p99_ms': percentiles[1],
+                'max_ms': float(latencies.max()) if latencies.size else None,
+                'error': repr(self.error) if self.error else None}
+
+    def close(self):
+        """ Stops serving and the prefetch thread. """
+        self._stop.set()
+        if self._threads:
+            self._server.shutdown()
+        self._server.server_close()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CommandClient:
+    """ Minimal controller-side client of a CommandServer. """
+
+    def __init__(self, address, timeout=10.):
+        self._socket = socket.create_connection(address, timeout=timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._socket.makefile('rwb')
+
+    def _request(self, request):
+        self._file.write(request + b'\n')
+        self._file.flush()
+        return json.loads(self._file.readline())
+
+    def next_trial(self):
+        """ Returns the next trial's (n_positions, 3) robot commands, or None once the schedule is exhausted. """
+        response = self._request(b'NEXT')
+        if response.get('done'):
+            return None
+        return np.array(response['commands'])
+
+    def stats(self):
+        return self._request(b'STATS')
+
+    def close(self):
+        try:
+            self._file.write(b'QUIT\n')
+            self._file.flush()
+        except OSError:
+            pass
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
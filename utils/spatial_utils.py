@@ -0,0 +1,344 @@
+""" Spatial indexing for ReachMaster command positions. SpatialHash buckets points into a uniform grid of cubic cells
+    (optionally keyed by a group such as the trial index) so that close pairs and nearest neighbours are found by
+    comparing points in neighbouring cells only, instead of all O(n^2) pairs. The coverage functions built on it
+    (nearest-neighbour distances, duplicate detection and empty-voxel reports) stay fast for millions of points.
+    DensityGrid bins positions into a fixed voxel grid for rendering schedules of any size. For use with the
+    ReachSample software. """
+import itertools
+import numpy as np
+
+NEIGHBOR_OFFSETS = np.array(list(itertools.product((-1, 0, 1), repeat=3)), dtype=np.int64)
+# Half of the neighbourhood (the zero offset plus one of each +/- pair), so every unordered pair is visited once.
+HALF_NEIGHBOR_OFFSETS = NEIGHBOR_OFFSETS[13:]
+MAX_MEAN_OCCUPANCY = 4.
+MAX_PAIRS = 4000000
+OCCUPANCY_SAMPLE_POINTS = 100000
+BRUTE_FORCE_QUERIES = 64
+DENSITY_BINS = 64
+DENSITY_CHUNK_POINTS = 1 << 20
+DENSITY_MAX_OUTLIERS = 5000
+
+
+class SpatialHash:
+    """ Uniform grid hash over an (n, 3) array of points with cubic cells of side cell_size. Points are sorted by cell
+        key once; the neighbouring cell at an offset is then found for every occupied cell at once with a binary search
+        of the sorted cell keys, so points are only mapped to their cell. When groups (one integer per point) are
+        given, only points sharing a group are ever compared. """
+
+    def __init__(self, points, cell_size, groups=None):
+        self.points = np.asarray(points, dtype=float).reshape(-1, 3)
+        if cell_size <= 0:
+            raise ValueError('cell_size must be positive.')
+        self.cell_size = float(cell_size)
+        self.groups = np.zeros(len(self.points), dtype=np.int64) if groups is None else \
+            np.asarray(groups, dtype=np.int64).ravel()
+        origin = self.points.min(axis=0) if len(self.points) else np.zeros(3)
+        self.cells = np.floor((self.points - origin) / self.cell_size).astype(np.int64) + 1  # pad for -1 offsets
+        self._dims = (self.cells.max(axis=0) + 2) if len(self.points) else np.ones(3, dtype=np.int64)
+        keys = self._keys(self.cells, self.groups)
+        self.order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[self.order]
+        first = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1]))) if len(keys) else \
+            np.zeros(0, dtype=np.int64)
+        self.cell_keys = sorted_keys[first]
+        self.cell_start = first
+        self.cell_count = np.diff(np.append(first, len(keys)))
+        self.point_cell = np.empty(len(keys), dtype=np.int64)  # index into cell_keys of every point's cell
+        self.point_cell[self.order] = np.repeat(np.arange(len(first)), self.cell_count)
+
+    def _keys(self, cells, groups):
+        return ((groups * self._dims[0] + cells[:, 0]) * self._dims[1] + cells[:, 1]) * self._dims[2] + cells[:, 2]
+
+    def neighbor_cells(self, offset):
+        """ Index into cell_keys of the cell at offset from every occupied cell, -1 where that cell is empty. Keys are
+            linear in the cell coordinates and the grid is padded, so the queried keys are the sorted cell keys shifted
+            by a constant and the binary search walks them in order. """
+        keys = self.cell_keys + (offset[0] * self._dims[1] + offset[1]) * self._dims[2] + offset[2]
+        found = np.minimum(np.searchsorted(self.cell_keys, keys), max(len(self.cell_keys) - 1, 0))
+        return np.where(self.cell_keys[found] == keys, found, -1) if len(keys) else found
+
+    def neighbors(self, query, offset, max_pairs=MAX_PAIRS):
+        """ Generator of (i, j) point index arrays pairing every point index in query with every point of the cell at
+            offset from its own cell. Pairs are yielded in batches of about max_pairs, grouped by query point in query
+            order, to bound memory. """
+        found = self.neighbor_cells(offset)[self.point_cell[query]]
+        hit = found >= 0
+        query, found = query[hit], found[hit]
+        counts = self.cell_count[found]
+        cumulative = np.cumsum(counts)
+        start = 0
+        while start < len(query):
+            done = cumulative[start - 1] if start else 0
+            stop = max(start + 1, int(np.searchsorted(cumulative, done + max_pairs, side='right')))
+            batch_counts = counts[start:stop]
+            local = np.arange(batch_counts.sum()) - np.repeat(np.cumsum(batch_counts) - batch_counts, batch_counts)
+            yield np.repeat(query[start:stop], batch_counts), \
+                self.order[np.repeat(self.cell_start[found[start:stop]], batch_counts) + local]
+            start = stop
+
+    def pairs_within(self, radius):
+        """ Returns (i, j) index arrays of all pairs of points closer than radius, each pair once. radius must not
+            exceed cell_size. """
+        if radius > self.cell_size:
+            raise ValueError('radius may not exceed the cell size of the hash.')
+        pairs_i, pairs_j = [], []
+        everything = np.arange(len(self.points))
+        for offset in HALF_NEIGHBOR_OFFSETS:
+            for i, j in self.neighbors(everything, offset):
+                if not offset.any():
+                    keep = i < j
+                    i, j = i[keep], j[keep]
+                difference = self.points[i] - self.points[j]
+                close = np.einsum('ij,ij->i', difference, difference) < radius ** 2
+                pairs_i.append(i[close])
+                pairs_j.append(j[close])
+        if not pairs_i:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+
+def unique_points(points):
+    """ Groups identical rows of an (n, 3) array by sorting a byte view of each row. Returns the unique points, the
+        index of each point's unique row, the count of each unique row and the index of its first occurrence. """
+    points = np.ascontiguousarray(points, dtype=float).reshape(-1, 3)
+    rows = points.view(np.dtype((np.void, points.dtype.itemsize * 3))).ravel()
+    order = np.argsort(rows, kind='stable')
+    new = np.concatenate(([True], rows[order][1:] != rows[order][:-1])) if len(rows) else np.zeros(0, dtype=bool)
+    first = order[new]
+    inverse = np.empty(len(points), dtype=np.int64)
+    inverse[order] = np.cumsum(new) - 1
+    return points[first], inverse, np.diff(np.append(np.flatnonzero(new), len(points))), first
+
+
+def close_trials(commands, min_separation):
+    """ Returns the indices of trials in commands (n_trials, n_positions, 3) that contain two positions closer than
+        min_separation. """
+    commands = np.asarray(commands)
+    groups = np.repeat(np.arange(commands.shape[0]), commands.shape[1])
+    i, _ = SpatialHash(commands.reshape(-1, 3), min_separation, groups=groups).pairs_within(min_separation)
+    return np.unique(groups[i])
+
+
+def _default_cell_size(points, points_per_cell=1.):
+    """ Cell size giving roughly points_per_cell points per cell over the occupied dimensions of the bounding box. """
+    extent = np.ptp(points, axis=0)
+    extent = extent[extent > 0]
+    if not extent.size:
+        return 1.
+    return float((np.prod(extent) * points_per_cell / len(points)) ** (1. / extent.size))
+
+
+def _mean_occupancy(spatial_hash):
+    """ Average number of points sharing a cell with a point, which sets the cost of a neighbourhood search. """
+    return np.square(spatial_hash.cell_count).sum() / max(1, spatial_hash.cell_count.sum())
+
+
+def _packed_cell_size(points):
+    """ Default cell size, halved while a point would share its cell with more than MAX_MEAN_OCCUPANCY points on
+        average (points packed on lines or planes). The occupancy is measured on an evenly strided sample of at most
+        OCCUPANCY_SAMPLE_POINTS points and scaled up, so the full hash is built only once. """
+    cell_size = _default_cell_size(points)
+    sample = points[::max(1, len(points) // OCCUPANCY_SAMPLE_POINTS)]
+    fraction = len(sample) / len(points)
+    while (_mean_occupancy(SpatialHash(sample, cell_size)) - 1 + fraction) / fraction > MAX_MEAN_OCCUPANCY:
+        cell_size /= 2
+    return cell_size
+
+
+def nearest_neighbor_distances(points, cell_size=None):
+    """ Returns the distance from each point to its nearest other point. Identical points are collapsed first (their
+        distance is 0), then nearest neighbours are searched in the 27 surrounding cells of a SpatialHash, doubling the
+        cell size for any point whose neighbour may lie further away; the last BRUTE_FORCE_QUERIES points at most are
+        compared with every point. Points are processed in cell order, so neighbouring points are close in memory, and
+        the first pass visits each pair of cells once. scipy's cKDTree is used instead when scipy is installed and no
+        cell_size is given. """
+    unique, inverse, counts, _ = unique_points(points)
+    distances = _distinct_nearest_neighbor_distances(unique, cell_size)[inverse]
+    distances[counts[inverse] > 1] = 0.
+    return distances
+
+
+def _distinct_nearest_neighbor_distances(unique, cell_size=None):
+    """ nearest_neighbor_distances of points that are known to be distinct. """
+    try:
+        from scipy.spatial import cKDTree
+    except ImportError:
+        cKDTree = None
+    if cKDTree is not None and cell_size is None and len(unique) > 1:
+        return cKDTree(unique).query(unique, k=2)[0][:, 1]
+    nearest = np.full(len(unique), np.inf)  # squared distances, in cell order, until the end
+    order = np.arange(len(unique))
+    if len(unique) > 1:
+        cell_size = cell_size or _packed_cell_size(unique)
+        order = SpatialHash(unique, cell_size).order
+        x, y, z = (np.ascontiguousarray(column) for column in unique[order].T)
+        pending = np.arange(len(unique))
+        while pending.size > BRUTE_FORCE_QUERIES:
+            spatial_hash = SpatialHash(np.column_stack((x, y, z)), cell_size)
+            # every point is queried in the first pass, so each pair of cells is visited once and updates both points
+            symmetric = pending.size == len(unique)
+            for offset in HALF_NEIGHBOR_OFFSETS if symmetric else NEIGHBOR_OFFSETS:
+                for i, j in spatial_hash.neighbors(pending, offset):
+                    squared = np.square(x[i] - x[j]) + np.square(y[i] - y[j]) + np.square(z[i] - z[j])
+                    if not offset.any():
+                        squared[i == j] = np.inf
+                    np.minimum.at(nearest, i, squared)
+                    if symmetric:
+                        np.minimum.at(nearest, j, squared)
+            pending = pending[nearest[pending] > cell_size ** 2]
+            # when most points are still pending (a sparse majority beside a dense minority), their own spacing sets
+            # the next cell size, instead of doubling through every size in between
+            cell_size = max(2 * cell_size, _packed_cell_size(np.column_stack((x[pending], y[pending], z[pending])))
+                            if 2 * pending.size > len(unique) else 0.)
+        for i in pending:  # the few isolated points left are compared with every point rather than rehashed again
+            squared = np.square(x - x[i]) + np.square(y - y[i]) + np.square(z - z[i])
+            squared[i] = np.inf
+            nearest[i] = squared.min()
+    distances = np.empty(len(unique))
+    distances[order] = np.sqrt(nearest)
+    return distances
+
+
+def find_duplicates(points, tolerance=0., groups=None):
+    """ Returns a boolean mask of points that repeat an earlier point, after rounding to tolerance (exact comparison
+        when tolerance is 0). When groups are given (e.g. the trial index) only points within a group are compared. """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    keys = np.round(points / tolerance) * tolerance if tolerance else points
+    if groups is not None:  # shift each group far apart so that rows from different groups never compare equal
+        keys = np.column_stack((np.asarray(groups, dtype=float).ravel(), keys))
+        rows = np.ascontiguousarray(keys).view(np.dtype((np.void, keys.dtype.itemsize * 4))).ravel()
+        _, first = np.unique(rows, return_index=True)
+    else:
+        first = unique_points(keys)[3]
+    duplicates = np.ones(len(points), dtype=bool)
+    duplicates[first] = False
+    return duplicates
+
+
+def voxel_coverage(points, voxel_size, bounds=None):
+    """ Counts points in a grid of cubic voxels of side voxel_size over bounds ((x0, x1), (y0, y1), (z0, z1)), by
+        default the bounding box of the points. Returns the count grid, the voxel edges, the number and centres of
+        empty voxels and the fraction of voxels covered. Points outside bounds are ignored. """
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    if bounds is None:
+        bounds = np.column_stack((points.min(axis=0), points.max(axis=0)))
+    bounds = np.asarray(bounds, dtype=float)
+    shape = np.maximum(1, np.ceil((bounds[:, 1] - bounds[:, 0]) / voxel_size - 1e-9).astype(np.int64))
+    edges = [bounds[axis, 0] + voxel_size * np.arange(shape[axis] + 1) for axis in range(3)]
+    index = np.floor((points - bounds[:, 0]) / voxel_size).astype(np.int64)
+    index = np.where(points == bounds[:, 1], shape - 1, index)  # close the upper bound
+    inside = np.all((index >= 0) & (index < shape), axis=1)
+    counts = np.bincount(np.ravel_multi_index(index[inside].T, shape), minlength=int(np.prod(shape))).reshape(shape)
+    empty = np.argwhere(counts == 0)
+    return {'counts': counts, 'edges': edges, 'n_voxels': int(counts.size), 'n_empty': int(len(empty)),
+            'empty_voxels': bounds[:, 0] + (empty + 0.5) * voxel_size,
+            'coverage': float(np.count_nonzero(counts)) / counts.size}
+
+
+def coverage_report(commands, voxel_size=0.05, bounds=None, tolerance=1e-9):
+    """ Summarizes how a schedule (n_trials, n_positions, 3) covers the workspace: nearest-neighbour distance
+        distribution over distinct positions, duplicate positions across the schedule and within trials, and the
+        occupied and empty voxels of side voxel_size. Returns a JSON-serializable dict. """
+    commands = np.asarray(commands, dtype=float)
+    points = commands.reshape(-1, 3)
+    groups = np.repeat(np.arange(commands.shape[0]), commands.shape[1])
+    distinct = points[~find_duplicates(points, tolerance)]
+    distances = _distinct_nearest_neighbor_distances(distinct) if len(distinct) > 1 else np.zeros(0)
+    voxels = voxel_coverage(points, voxel_size, bounds)
+    percentiles = dict(zip(('p1', 'p5', 'p50', 'p95'), np.percentile(distances, (1, 5, 50, 95)).tolist())) \
+        if distances.size else {}
+    return {'n_points': int(len(points)), 'n_distinct': int(len(distinct)),
+            'n_duplicates': int(len(points) - len(distinct)),
+            'n_within_trial_duplicates': int(find_duplicates(points, tolerance, groups=groups).sum()),
+            'nearest_neighbor': dict(percentiles, min=float(distances.min()) if distances.size else None,
+                                     mean=float(distances.mean()) if distances.size else None),
+            'voxel_size': voxel_size, 'n_voxels': voxels['n_voxels'], 'n_empty_voxels': voxels['n_empty'],
+            'coverage': voxels['coverage']}
+
+
+class DensityGrid:
+    """ Fixed-resolution 3-D histogram of positions for rendering large schedules. Points are binned into bins voxels
+        per axis (an integer or one per axis) over bounds ((x0, x1), (y0, y1), (z0, z1)) with update(), any number of
+        points at a time, so memory is set by the grid and not by the number of points. Points outside bounds are
+        counted in n_outside. collect_outliers keeps a decimated sample of the points in sparse voxels, which a
+        density rendering would otherwise fade out. """
+
+    def __init__(self, bounds, bins=DENSITY_BINS):
+        self.bounds = np.asarray(bounds, dtype=float).reshape(3, 2)
+        self.shape = tuple(int(n) for n in np.broadcast_to(bins, 3))
+        self.voxel_size = (self.bounds[:, 1] - self.bounds[:, 0]) / self.shape
+        if np.any(self.voxel_size <= 0):
+            raise ValueError('Density grid bounds must have a positive extent on every axis, got ' + str(bounds))
+        self.counts = np.zeros(self.shape, dtype=np.int64)
+        self.n_points, self.n_outside = 0, 0
+        self.outliers = np.empty((0, 3))
+
+    def _voxels(self, points):
+        """ Flat voxel index of every point, -1 for points outside bounds. """
+        index = np.floor((points - self.bounds[:, 0]) / self.voxel_size).astype(np.int64)
+        index = np.where(points == self.bounds[:, 1], np.array(self.shape) - 1, index)  # close the upper bound
+        inside = np.all((index >= 0) & (index < self.shape), axis=1)
+        flat = np.full(len(points), -1, dtype=np.int64)
+        flat[inside] = np.ravel_multi_index(index[inside].T, self.shape)
+        return flat
+
+    def update(self, points):
+        """ Adds points (any shape ending in 3) to the grid, DENSITY_CHUNK_POINTS at a time. Returns the grid. """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        counts = self.counts.reshape(-1)
+        for start in range(0, len(points), DENSITY_CHUNK_POINTS):
+            flat = self._voxels(points[start:start + DENSITY_CHUNK_POINTS])
+            inside = flat[flat >= 0]
+            counts += np.bincount(inside, minlength=counts.size)
+            self.n_outside += len(flat) - len(inside)
+        self.n_points += len(points)
+        return self
+
+    def counts_at(self, points):
+        """ Count of the voxel each point falls in (0 outside bounds). """
+        flat = self._voxels(np.asarray(points, dtype=float).reshape(-1, 3))
+        return np.where(flat >= 0, self.counts.reshape(-1)[np.maximum(flat, 0)], 0)
+
+    def collect_outliers(self, points, max_count=1, max_points=DENSITY_MAX_OUTLIERS):
+        """ Keeps the points lying outside bounds or in voxels holding at most max_count points, decimated evenly so
+            that no more than max_points outliers are kept in total. Call after every point has been added. Returns
+            the outliers kept so far. """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        kept = [self.outliers]
+        for start in range(0, len(points), DENSITY_CHUNK_POINTS):
+            chunk = points[start:start + DENSITY_CHUNK_POINTS]
+            kept.append(chunk[self.counts_at(chunk) <= max_count])
+        outliers = np.concatenate(kept)
+        self.outliers = outliers[::-(-len(outliers) // max_points)] if len(outliers) > max_points else outliers
+        return self.outliers
+
+    @property
+    def edges(self):
+        """ Voxel edges along x, y and z. """
+        return [np.linspace(low, high, n + 1) for (low, high), n in zip(self.bounds, self.shape)]
+
+    def occupied(self):
+        """ Centres (k, 3) and counts (k,) of the k occupied voxels. """
+        index = np.nonzero(self.counts)
+        return self.bounds[:, 0] + (np.column_stack(index) + 0.5) * self.voxel_size, self.counts[index]
+
+    def projection(self, axes):
+        """ 2-D density of the points projected onto two axes, e.g. (0, 1) for the x-y plane, indexed [axes[0],
+            axes[1]]. """
+        summed = tuple(axis for axis in range(3) if axis not in axes)
+        projected = self.counts.sum(axis=summed)
+        return projected if axes[0] < axes[1] else projected.T
+
+
+def density_grid(commands, bins=DENSITY_BINS, bounds=None, max_outlier_count=0, max_outliers=DENSITY_MAX_OUTLIERS):
+    """ Bins a schedule (n_trials, n_positions, 3), or any array of points, into a DensityGrid over bounds (default:
+        the bounding box of the points). When max_outlier_count is positive, up to max_outliers points in voxels
+        holding at most max_outlier_count points are kept as the grid outliers. """
+    points = np.asarray(commands, dtype=float).reshape(-1, 3)
+    if bounds is None:
+        low, high = (points.min(axis=0), points.max(axis=0)) if len(points) else (np.zeros(3), np.ones(3))
+        bounds = np.column_stack((low, np.where(high > low, high, low + 1.)))
+    grid = DensityGrid(bounds, bins).update(points)
+    if max_outlier_count > 0:
+        grid.collect_outliers(points, max_count=max_outlier_count, max_points=max_outliers)
+    return grid
@@ -0,0 +1,172 @@
+""" Streaming statistics for ReachMaster command schedules. CommandStatistics accumulates fixed-bin histograms of the
+    x, y, z positions and of the r, thetay, thetaz robot commands, joint 2-D histograms and running mean, variance,
+    minimum and maximum one block of trials at a time, so summary statistics never require the whole schedule in
+    memory. Results can be exported as arrays or JSON; plotting is an optional last step that only reads the counts.
+    For use with the ReachSample software. """
+import json
+import numpy as np
+import utils.command_utils as c_d
+import utils.instrument_utils as iu
+
+CHANNELS = ('x', 'y', 'z', 'r', 'thetay', 'thetaz')
+DEFAULT_RANGES = {'x': (-3., 3.), 'y': (-3., 3.), 'z': (-3., 3.), 'r': (0., 40.), 'thetay': (-90., 90.),
+                  'thetaz': (-90., 90.)}
+DEFAULT_JOINT = (('x', 'y'), ('x', 'z'), ('y', 'z'), ('thetay', 'thetaz'))
+
+
+class CommandStatistics:
+    """ Incremental accumulator of command statistics. Each channel ('x', 'y', 'z' in cm, 'r' in mm, 'thetay' and
+        'thetaz' in degrees, the exported robot commands of euclidean_to_robot) is binned into bin_num fixed bins over
+        its range in ranges (defaults in DEFAULT_RANGES); values outside the range are counted as underflow or
+        overflow. joint lists the channel pairs that get a 2-D histogram. x_offset is subtracted from x before
+        binning, as in histogram_command_files. Statistics from separate accumulators (e.g. one per worker) combine
+        with merge(). """
+
+    def __init__(self, bin_num=25, ranges=None, joint=DEFAULT_JOINT, x_offset=0.):
+        ranges = dict(DEFAULT_RANGES, **(ranges or {}))
+        self.bin_num, self.x_offset = bin_num, x_offset
+        self.joint = tuple(tuple(pair) for pair in joint)
+        self.edges = {channel: np.linspace(ranges[channel][0], ranges[channel][1], bin_num + 1)
+                      for channel in CHANNELS}
+        self.counts = {channel: np.zeros(bin_num, dtype=np.int64) for channel in CHANNELS}
+        self.joint_counts = {pair: np.zeros((bin_num, bin_num), dtype=np.int64) for pair in self.joint}
+        self.underflow = dict.fromkeys(CHANNELS, 0)
+        self.overflow = dict.fromkeys(CHANNELS, 0)
+        self.n = dict.fromkeys(CHANNELS, 0)
+        self.mean = dict.fromkeys(CHANNELS, 0.)
+        self._m2 = dict.fromkeys(CHANNELS, 0.)
+        self.min = dict.fromkeys(CHANNELS, np.inf)
+        self.max = dict.fromkeys(CHANNELS, -np.inf)
+        self.n_trials = 0
+
+    def _channel_values(self, block):
+        points = block.reshape(-1, 3)
+        robot = c_d.euclidean_to_robot(points)
+        return {'x': points[:, 0] - self.x_offset, 'y': points[:, 1], 'z': points[:, 2], 'r': robot[:, 0],
+                'thetay': robot[:, 1], 'thetaz': robot[:, 2]}
+
+    def update(self, block):
+        """ Adds a block of x, y, z commands of size n_trials, n_positions, 3 to the statistics. """
+        block = np.asarray(block, dtype=float)
+        values = self._channel_values(block)
+        for channel in CHANNELS:
+            channel_values = values[channel][np.isfinite(values[channel])]
+            edges = self.edges[channel]
+            self.counts[channel] += np.histogram(channel_values, bins=edges)[0]
+            self.underflow[channel] += int(np.count_nonzero(channel_values < edges[0]))
+            self.overflow[channel] += int(np.count_nonzero(channel_values > edges[-1]))
+            if channel_values.size:
+                self._combine(channel, channel_values.size, channel_values.mean(),
+                              np.square(channel_values - channel_values.mean()).sum(), channel_values.min(),
+                              channel_values.max())
+        for first, second in self.joint:
+            self.joint_counts[(first, second)] += np.histogram2d(
+                values[first], values[second], bins=[self.edges[first], self.edges[second]])[0].astype(np.int64)
+        self.n_trials += block.shape[0]
+        return self
+
+    def _combine(self, channel, n, mean, m2, minimum, maximum):
+        """ Combines running moments with those of another sample (Chan et al. parallel variance update). """
+        total = self.n[channel] + n
+        delta = mean - self.mean[channel]
+        self._m2[channel] += m2 + delta ** 2 * self.n[channel] * n / total
+        self.mean[channel] += delta * n / total
+        self.n[channel] = total
+        self.min[channel] = min(self.min[channel], float(minimum))
+        self.max[channel] = max(self.max[channel], float(maximum))
+
+    def merge(self, other):
+        """ Adds the statistics of another accumulator with the same bins. """
+        for channel in CHANNELS:
+            if not np.array_equal(self.edges[channel], other.edges[channel]):
+                raise ValueError('Cannot merge statistics with different ' + channel + ' bins.')
+            self.counts[channel] += other.counts[channel]
+            self.underflow[channel] += other.underflow[channel]
+            self.overflow[channel] += other.overflow[channel]
+            if other.n[channel]:
+                self._combine(channel, other.n[channel], other.mean[channel], other._m2[channel], other.min[channel],
+                              other.max[channel])
+        for pair in self.joint:
+            self.joint_counts[pair] += other.joint_counts[pair]
+        self.n_trials += other.n_trials
+        return self
+
+    def variance(self, channel):
+        """ Population variance of a channel. """
+        return self._m2[channel] / self.n[channel] if self.n[channel] else float('nan')
+
+    def arrays(self):
+        """ Returns the accumulated histograms as numpy arrays, keyed by channel and by 'first_second' for joint
+            histograms, each with its bin edges. """
+        histograms = {channel: (self.counts[channel], self.edges[channel]) for channel in CHANNELS}
+        for first, second in self.joint:
+            histograms[first + '_' + second] = (self.joint_counts[(first, second)], self.edges[first],
+                                                self.edges[second])
+        return histograms
+
+    def to_dict(self):
+        """ Returns every accumulated statistic as a JSON-serializable dict. """
+        summary = {'n_trials': self.n_trials, 'bin_num': self.bin_num, 'x_offset': self.x_offset, 'channels': {}}
+        for channel in CHANNELS:
+            summary['channels'][channel] = {
+                'n': self.n[channel], 'mean': self.mean[channel] if self.n[channel] else None,
+                'variance': self.variance(channel) if self.n[channel] else None,
+                'min': self.min[channel] if self.n[channel] else None,
+                'max': self.max[channel] if self.n[channel] else None,
+                'underflow': self.underflow[channel], 'overflow': self.overflow[channel],
+                'edges': self.edges[channel].tolist(), 'counts': self.counts[channel].tolist()}
+        summary['joint'] = {first + '_' + second: self.joint_counts[(first, second)].tolist()
+                            for first, second in self.joint}
+        return summary
+
+    def to_json(self, filename=None):
+        """ Returns the statistics as a JSON string, also writing it to filename when given. """
+        serialized = json.dumps(self.to_dict())
+        if filename:
+            with open(filename, 'w') as json_file:
+                json_file.write(serialized)
+        return serialized
+
+    def plot(self, channels=('x', 'y', 'z'), density=False, comtype=None, save_file=None, show=True):
+        """ Plots the accumulated counts of the given channels as in histogram_command_files. Only the bin counts are
+            read, so plotting cost does not depend on the number of commands. """
+        import matplotlib.pyplot as plt
+        labels = {'x': 'X Positions', 'y': 'Y Positions', 'z': 'Z Positions', 'r': 'R Commands',
+                  'thetay': 'Thetay Commands', 'thetaz': 'Thetaz Commands'}
+        colors = {'x': 'r', 'y': 'g', 'z': 'b', 'r': 'r', 'thetay': 'g', 'thetaz': 'b'}
+        for channel in channels:
+            edges = self.edges[channel]
+            plt.hist(edges[:-1], bins=edges, weights=self.counts[channel], density=density, color=colors[channel],
+                     histtype='barstacked', label=labels[channel])
+        plt.xlabel('Positions relative to origin (cm)')
+        plt.ylabel('Counts')
+        plt.legend()
+        if comtype:
+            plt.title('Command Positions: ' + str(comtype))
+        else:
+            plt.title('Command Positions. ')
+
+        if save_file:
+            plt.savefig(save_file, dpi=400)
+        if show:
+            plt.show()
+        else:
+            plt.close()
+
+
+def accumulate_through(blocks, statistics, instrumentation=None):
+    """ Generator that adds each block to statistics and yields it on unchanged, so statistics can share a single
+        pass over a streamed schedule with an export. Updates are timed as 'histogram' spans of instrumentation. """
+    instrumentation = iu.get_instrumentation(instrumentation)
+    for block in blocks:
+        with instrumentation.span('histogram'):
+            statistics.update(block)
+        yield block
+
+
+def statistics_from_blocks(blocks, **kwargs):
+    """ Accumulates CommandStatistics over an iterable of command blocks. Keyword arguments go to CommandStatistics."""
+    statistics = CommandStatistics(**kwargs)
+    for block in blocks:
+        statistics.update(block)
+    return statistics
@@ -0,0 +1,110 @@
+""" Memory-mapped schedule store for ReachMaster command schedules. A store is the npy export of a schedule (a
+    (n_commands, 3) float64 array of r, thetay, thetaz robot commands) with two small sidecars written next to it: an
+    index holding the offset of every trial's first command and a JSON file of metadata. ScheduleStore maps the array
+    without reading it, so the commands of any trial are a constant-time, zero-copy view however large the schedule.
+    Stores are written with the 'store' export format (see utils.export_utils) or converted from existing command
+    CSVs with csv_to_store. For use with the ReachSample software. """
+import json
+import os
+import numpy as np
+import utils.block_utils as bu
+import utils.export_utils as ex
+
+
+def store_filenames(path):
+    """ Returns the (commands, index, metadata) filenames of the store at path, given as the base name or as any of the
+        store files. """
+    base = path
+    for suffix in (ex.STORE_INDEX_SUFFIX, ex.STORE_METADATA_SUFFIX, '.npy', '.csv'):
+        if base.endswith(suffix):
+            base = base[:-len(suffix)]
+            break
+    return base + '.npy', base + ex.STORE_INDEX_SUFFIX, base + ex.STORE_METADATA_SUFFIX
+
+
+class ScheduleStore:
+    """ Read-only random access to a stored schedule. len(store) is the number of trials; store[k] (or trial(k)) is
+        the (n_positions, 3) commands of trial k and store[start:stop] (or trials(start, stop)) a robot-space
+        CommandBlock of consecutive trials, all views into the memory map. metadata holds the JSON sidecar. """
+
+    def __init__(self, path):
+        commands_filename, index_filename, metadata_filename = store_filenames(path)
+        with open(metadata_filename) as metadata_file:
+            self.metadata = json.load(metadata_file)
+        self.commands = np.load(commands_filename, mmap_mode='r')
+        self.offsets = np.load(index_filename, mmap_mode='r')
+        if self.offsets[-1] != self.commands.shape[0]:
+            raise ValueError('Index ' + index_filename + ' does not match the ' + str(self.commands.shape[0]) +
+                             ' commands in ' + commands_filename)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def trial(self, k):
+        """ Commands of trial k (negative k counts from the end) as a read-only (n_positions, 3) view. """
+        n_trials = len(self)
+        if not -n_trials <= k < n_trials:
+            raise IndexError('Trial ' + str(k) + ' is out of range for a store of ' + str(n_trials) + ' trials')
+        k %= n_trials
+        return self.commands[self.offsets[k]:self.offsets[k + 1]]
+
+    def trials(self, start, stop):
+        """ Trials start to stop as a read-only robot-space CommandBlock view. Requires the trials to have the same
+            number of positions. """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        commands = self.commands[self.offsets[start]:self.offsets[stop]]
+        n_positions = self.metadata.get('n_positions') or (int(self.offsets[start + 1] - self.offsets[start])
+                                                           if stop > start else 0)
+        if stop > start and commands.shape[0] != (stop - start) * n_positions:
+            raise ValueError('Trials ' + str(start) + ' to ' + str(stop) + ' have different numbers of positions')
+        return bu.CommandBlock(np.asarray(commands).reshape(stop - start, n_positions, 3),
+                               kind=self.metadata.get('kind'), space='robot', seed=self.metadata.get('seed'))
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                raise ValueError('Stores are sliced by consecutive trials only')
+            return self.trials(key.start, key.stop)
+        return self.trial(int(key))
+
+    def iter_blocks(self, block_trials=ex.DEFAULT_CHUNK_TRIALS):
+        """ Generator of consecutive robot-space CommandBlock views of at most block_trials trials, e.g. to serve a
+            stored schedule with utils.server_utils.CommandServer. """
+        for start in range(0, len(self), block_trials):
+            yield self.trials(start, start + block_trials)
+
+    def close(self):
+        """ Releases the memory maps. Views taken from the store keep their map open until they are released. """
+        self.commands, self.offsets = None, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_store(path):
+    """ Opens the schedule store at path (base name or any store file) for random access by trial. """
+    return ScheduleStore(path)
+
+
+def csv_to_store(csv_filename, store_path=None, n_positions=9, chunk_trials=ex.DEFAULT_CHUNK_TRIALS, kind=None):
+    """ Converts an r,thetay,thetaz command CSV (as written by create_robot_command or the csv export) into a schedule
+        store of n_positions commands per trial, streaming chunk_trials trials at a time so the CSV is never loaded
+        whole. store_path defaults to the CSV name without its extension. Returns the store filenames. """
+    import pandas as pd
+    store_path = store_path or os.path.splitext(csv_filename)[0]
+    commands_filename, index_filename, metadata_filename = store_filenames(store_path)
+    reader = pd.read_csv(csv_filename, usecols=ex.COMMAND_COLUMNS, chunksize=chunk_trials * n_positions,
+                         float_precision='round_trip')
+    with ex.CommandExportWriter(os.path.splitext(commands_filename)[0] + '.csv', formats=('store',),
+                                chunk_trials=chunk_trials) as writer:
+        for chunk in reader:
+            robot_commands = chunk[ex.COMMAND_COLUMNS].to_numpy(dtype=float)
+            if robot_commands.shape[0] % n_positions:
+                raise ValueError(csv_filename + ' holds ' + str(writer.n_commands + robot_commands.shape[0]) +
+                                 ' commands, which is not a whole number of ' + str(n_positions) + '-position trials')
+            writer.write(bu.CommandBlock(robot_commands.reshape(-1, n_positions, 3), kind=kind, space='robot'))
+    return commands_filename, index_filename, metadata_filename